@@ -4,6 +4,16 @@ from wbia.control import controller_inject  # NOQA
 from os.path import abspath, join, exists, split
 import wbia_curvrank.functional as F
 from wbia_curvrank import imutils
+from wbia_curvrank.registry import MODEL_REGISTRY, INDEX_REGISTRY
+from wbia_curvrank.executors import EXECUTOR_STATS, run_stage
+from wbia_curvrank.instrumentation import INSTRUMENTATION, instrument_stage
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import threading
+import tempfile
+import logging
+import fcntl
+import os
 
 # import wbia.constants as const
 from scipy import interpolate
@@ -16,16 +26,26 @@ import cv2
 # We want to register the depc plugin functions as well, so import it here for IBEIS
 import wbia_curvrank._plugin_depc  # NOQA
 from wbia_curvrank._plugin_depc import (
+    DEFAULT_WIDTH,
+    DEFAULT_HEIGHT,
     DEFAULT_SCALES,
     INDEX_NUM_TREES,
     INDEX_SEARCH_K,
     INDEX_LNBNN_K,
+    INDEX_NUM_WORKERS,
+    INDEX_NUM_JOBS,
+    INDEX_BUILD_CHUNKSIZE,
+    INDEX_DELTA_MAX_ANNOTS,
+    INDEX_COMPACTION_NUM_JOBS,
     INDEX_SEARCH_D,
     INDEX_NUM_ANNOTS,
+    PIPELINE_MAX_IN_FLIGHT,
+    STAGE_EXECUTORS,
     _convert_kwargs_config_to_depc_config,
 )
 
 (print, rrr, profile) = ut.inject2(__name__)
+logger = logging.getLogger(__name__)
 
 _, register_ibs_method = controller_inject.make_ibs_register_decorator(__name__)
 register_api = controller_inject.get_wbia_flask_api(__name__)
@@ -41,6 +61,19 @@ FORCE_SERIAL = FORCE_SERIAL or 'macosx' in ut.get_plat_specifier().lower()
 CHUNKSIZE = 16
 
 
+def _run_stage(ibs, stage, func, zipped, kwargs):
+    # Run func over zipped with the executor configured for the stage as
+    # '<stage>_executor', serial whenever the controller or platform asks for it
+    backend = kwargs.get('%s_executor' % (stage,), None)
+    if backend is None:
+        backend = STAGE_EXECUTORS[stage]
+    if ibs.force_serial or FORCE_SERIAL:
+        backend = 'serial'
+    return run_stage(
+        stage, func, zipped, backend=backend, chunksize=CHUNKSIZE, progkw={'freq': 10}
+    )
+
+
 RIGHT_FLIP_LIST = [  # CASE IN-SINSITIVE
     'right',
     'r',
@@ -72,7 +105,150 @@ if not HYBRID_FINFINDR_EXTRACTION_FAILURE_CURVRANK_FALLBACK:
     URL_DICT['dorsalfinfindrhybrid']['segmentation'] = None
 
 
+WEIGHT_FILEPATH_DICT = {}
+
+
+def _grab_weight_filepath(model_url):
+    # grab_file_url re-validates the hash on every call, only do it once per process
+    weight_filepath = WEIGHT_FILEPATH_DICT.get(model_url, None)
+    if weight_filepath is None or not exists(weight_filepath):
+        weight_filepath = ut.grab_file_url(
+            model_url, appname='wbia_curvrank', check_hash=True
+        )
+        WEIGHT_FILEPATH_DICT[model_url] = weight_filepath
+    return weight_filepath
+
+
+def _build_localization_func(height, width, weight_filepath):
+    from wbia_curvrank import localization, model, theano_funcs
+
+    # Make sure resized images all have the same shape
+    layers = localization.build_model((None, 3, height, width))
+    model.load_weights([layers['trans'], layers['loc']], weight_filepath)
+    localization_func = theano_funcs.create_localization_infer_func(layers)
+    return localization_func
+
+
+def _build_segmentation_func(height, width, weight_filepath):
+    from wbia_curvrank import segmentation, model, theano_funcs
+
+    segmentation_layers = segmentation.build_model_batchnorm_full(
+        (None, 3, height, width)
+    )
+
+    # I am not sure these are the correct args to load_weights
+    model.load_weights(segmentation_layers['seg_out'], weight_filepath)
+    segmentation_func = theano_funcs.create_segmentation_func(segmentation_layers)
+    return segmentation_func
+
+
+MODEL_BUILD_FUNC_DICT = {
+    'localization': _build_localization_func,
+    'segmentation': _build_segmentation_func,
+}
+
+
+def _get_model_func(model_type, model_tag, height, width, model_url, build_func):
+    weight_filepath = _grab_weight_filepath(model_url)
+    model_func = MODEL_REGISTRY.get(
+        model_type, model_tag, height, width, weight_filepath, build_func
+    )
+    return model_func
+
+
 @register_ibs_method
+def wbia_plugin_curvrank_warmup(ibs, model_type_list=None, **kwargs):
+    r"""
+    Build and compile the CurvRank networks ahead of the first depc chunk
+
+    Compiled networks are cached for the life of the process (see
+    wbia_curvrank.registry.ModelRegistry), so warming up moves the compilation
+    cost out of the first localization and segmentation calls.
+
+    Args:
+        ibs       (IBEISController): IBEIS controller object
+        model_type_list (list of str): model types to compile, defaults to all
+            model types in URL_DICT
+
+    Returns:
+        stats (dict): model registry hit / miss / eviction / compile-time counters
+
+    CommandLine:
+        python -m wbia_curvrank._plugin --test-wbia_plugin_curvrank_warmup
+
+    Example0:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank._plugin import *  # NOQA
+        >>> import wbia
+        >>> from wbia.init import sysres
+        >>> dbdir = sysres.ensure_testdb_curvrank()
+        >>> ibs = wbia.opendb(dbdir=dbdir)
+        >>> stats = ibs.wbia_plugin_curvrank_warmup(['dorsal'])
+        >>> stats = ibs.wbia_plugin_curvrank_warmup(['dorsal'])
+        >>> assert stats['hits'] >= 2
+    """
+    if model_type_list is None:
+        model_type_list = sorted(URL_DICT.keys())
+
+    for model_type in model_type_list:
+        height = DEFAULT_HEIGHT.get(model_type, DEFAULT_HEIGHT['dorsal'])
+        width = DEFAULT_WIDTH.get(model_type, DEFAULT_WIDTH['dorsal'])
+        for model_tag, build_func in MODEL_BUILD_FUNC_DICT.items():
+            model_url = URL_DICT.get(model_type, {}).get(model_tag, None)
+            if model_url is None:
+                continue
+            with ut.Timer('Warming up %s %s' % (model_type, model_tag)):
+                _get_model_func(
+                    model_type, model_tag, height, width, model_url, build_func
+                )
+
+    return MODEL_REGISTRY.stats()
+
+
+@register_ibs_method
+def wbia_plugin_curvrank_registry_stats(ibs):
+    r"""
+    Reuse and load-latency counters for the compiled networks and Annoy indices
+    cached in this process, and the wall time and payload of each pipeline stage
+
+    Returns:
+        stats (dict): {'models': ..., 'indices': ..., 'executors': ...}
+    """
+    stats = {
+        'models': MODEL_REGISTRY.stats(),
+        'indices': INDEX_REGISTRY.stats(),
+        'executors': EXECUTOR_STATS.stats(),
+        'stages': INSTRUMENTATION.stats(),
+    }
+    return stats
+
+
+@register_ibs_method
+def wbia_plugin_curvrank_instrumentation_snapshot(ibs, fmt='json', reset=False):
+    r"""
+    Snapshot of the per-stage wall time, CPU time, item and failure counts,
+    peak RSS growth and output bytes of the pipeline, recorded only while
+    INSTRUMENTATION is enabled (CURVRANK_INSTRUMENT=1)
+
+    Args:
+        fmt (str): 'json' or 'prometheus'
+        reset (bool): clear the counters after taking the snapshot
+
+    Returns:
+        snapshot (str)
+    """
+    assert fmt in ['json', 'prometheus'], 'Unsupported format %r' % (fmt,)
+    if fmt == 'json':
+        snapshot = INSTRUMENTATION.to_json(include_batches=True)
+    else:
+        snapshot = INSTRUMENTATION.to_prometheus()
+    if reset:
+        INSTRUMENTATION.reset_stats()
+    return snapshot
+
+
+@register_ibs_method
+@instrument_stage('preprocessing')
 def wbia_plugin_curvrank_preprocessing(
     ibs, aid_list, width=256, height=256, greyscale=False, **kwargs
 ):
@@ -155,13 +331,7 @@ def wbia_plugin_curvrank_preprocessing(
 
     zipped = zip(image_list, flip_list, height_list, width_list)
 
-    config_ = {
-        'ordered': True,
-        'chunksize': CHUNKSIZE,
-        'force_serial': ibs.force_serial or FORCE_SERIAL,
-        'progkw': {'freq': 10},
-    }
-    generator = ut.generate2(F.preprocess_image, zipped, nTasks=len(aid_list), **config_)
+    generator = _run_stage(ibs, 'preprocessing', F.preprocess_image, zipped, kwargs)
 
     resized_images, resized_masks, pre_transforms = [], [], []
     for resized_image, resized_mask, pre_transform in generator:
@@ -173,6 +343,7 @@ def wbia_plugin_curvrank_preprocessing(
 
 
 @register_ibs_method
+@instrument_stage('localization')
 def wbia_plugin_curvrank_localization(
     ibs,
     resized_images,
@@ -181,6 +352,8 @@ def wbia_plugin_curvrank_localization(
     height=256,
     model_type='dorsal',
     model_tag='localization',
+    batch_size=None,
+    max_bytes=None,
     **kwargs
 ):
     r"""
@@ -191,6 +364,9 @@ def wbia_plugin_curvrank_localization(
         model_tag  (string): Key to URL_DICT entry for this model
         resized_images (list of np.ndarray): (height, width, 3) BGR images
         resized_masks (list of np.ndarray): (height, width) binary masks
+        batch_size (int): maximum number of images per network call, defaults to
+            all images at once
+        max_bytes (int): maximum size of the network input buffer in bytes
 
     Returns:
         localized_images
@@ -262,18 +438,17 @@ def wbia_plugin_curvrank_localization(
         localized_masks = resized_masks
         loc_transforms = [np.eye(3, dtype=np.float32)] * len(localized_images)
     else:
-        from wbia_curvrank import localization, model, theano_funcs
-
-        weight_filepath = ut.grab_file_url(
-            model_url, appname='wbia_curvrank', check_hash=True
+        localization_func = _get_model_func(
+            model_type, model_tag, height, width, model_url, _build_localization_func
         )
-
-        # Make sure resized images all have the same shape
-        layers = localization.build_model((None, 3, height, width))
-        model.load_weights([layers['trans'], layers['loc']], weight_filepath)
-        localization_func = theano_funcs.create_localization_infer_func(layers)
         values = F.localize(
-            resized_images, resized_masks, height, width, localization_func
+            resized_images,
+            resized_masks,
+            height,
+            width,
+            localization_func,
+            batch_size=batch_size,
+            max_bytes=max_bytes,
         )
         localized_images, localized_masks, loc_transforms = values
 
@@ -281,6 +456,7 @@ def wbia_plugin_curvrank_localization(
 
 
 @register_ibs_method
+@instrument_stage('refinement')
 def wbia_plugin_curvrank_refinement(
     ibs,
     aid_list,
@@ -290,6 +466,7 @@ def wbia_plugin_curvrank_refinement(
     height=256,
     scale=4,
     greyscale=False,
+    refinement_compact=False,
     **kwargs
 ):
     r"""
@@ -301,6 +478,8 @@ def wbia_plugin_curvrank_refinement(
         pre_transforms (list of np.ndarray): (3, 3) similarity matrices
         loc_transforms (list of np.ndarray): (3, 3) affine matrices
         scale (int): upsampling factor from coarse to fine-grained (default to 4).
+        refinement_compact (bool): warp uint8 chips as uint8 and fill in the masks
+            from their outline, see imutils.refine_localization (default False).
 
     Returns:
         refined_localizations
@@ -371,6 +550,7 @@ def wbia_plugin_curvrank_refinement(
     scale_list = [scale] * len(aid_list)
     height_list = [height] * len(aid_list)
     width_list = [width] * len(aid_list)
+    compact_list = [refinement_compact] * len(aid_list)
 
     zipped = zip(
         image_list,
@@ -380,18 +560,10 @@ def wbia_plugin_curvrank_refinement(
         scale_list,
         height_list,
         width_list,
+        compact_list,
     )
 
-    config_ = {
-        'ordered': True,
-        'chunksize': CHUNKSIZE,
-        'force_serial': ibs.force_serial or FORCE_SERIAL,
-        'futures_threaded': True,
-        'progkw': {'freq': 10},
-    }
-    generator = ut.generate2(
-        F.refine_localization, zipped, nTasks=len(aid_list), **config_
-    )
+    generator = _run_stage(ibs, 'refinement', F.refine_localization, zipped, kwargs)
 
     refined_localizations, refined_masks = [], []
     for refined_localization, refined_mask in generator:
@@ -470,6 +642,7 @@ def wbia_plugin_curvrank_test_cleanup_groundtruth(ibs, values=None):
 
 
 @register_ibs_method
+@instrument_stage('segmentation')
 def wbia_plugin_curvrank_segmentation(
     ibs,
     aid_list,
@@ -487,6 +660,8 @@ def wbia_plugin_curvrank_segmentation(
     groundtruth_smooth=True,
     groundtruth_smooth_margin=0.001,
     greyscale=False,
+    batch_size=None,
+    max_bytes=None,
     **kwargs
 ):
     r"""
@@ -498,6 +673,9 @@ def wbia_plugin_curvrank_segmentation(
         refined_masks: output of wbia_plugin_curvrank_refinement
         model_tag  (string): Key to URL_DICT entry for this model
         scale (int): upsampling factor from coarse to fine-grained (default to 4).
+        batch_size (int): maximum number of images per network call, defaults to
+            all images at once
+        max_bytes (int): maximum size of the network input buffer in bytes
 
     Returns:
         segmentations
@@ -721,19 +899,9 @@ def wbia_plugin_curvrank_segmentation(
             segmentations = [segmentation_] * len(aid_list)
             refined_segmentations = [refined_segmentation] * len(aid_list)
         else:
-            from wbia_curvrank import segmentation, model, theano_funcs
-
-            weight_filepath = ut.grab_file_url(
-                model_url, appname='wbia_curvrank', check_hash=True
+            segmentation_func = _get_model_func(
+                model_type, model_tag, height, width, model_url, _build_segmentation_func
             )
-
-            segmentation_layers = segmentation.build_model_batchnorm_full(
-                (None, 3, height, width)
-            )
-
-            # I am not sure these are the correct args to load_weights
-            model.load_weights(segmentation_layers['seg_out'], weight_filepath)
-            segmentation_func = theano_funcs.create_segmentation_func(segmentation_layers)
             values = F.segment_contour(
                 refined_localizations,
                 refined_masks,
@@ -741,6 +909,8 @@ def wbia_plugin_curvrank_segmentation(
                 height,
                 width,
                 segmentation_func,
+                batch_size=batch_size,
+                max_bytes=max_bytes,
             )
 
             segmentations, refined_segmentations = values
@@ -766,6 +936,7 @@ def wbia_plugin_curvrank_keypoints_worker(model_type, segmentation, localized_ma
 
 
 @register_ibs_method
+@instrument_stage('keypoints', success_index=0)
 def wbia_plugin_curvrank_keypoints(
     ibs, segmentations, localized_masks, model_type='dorsal', **kwargs
 ):
@@ -905,14 +1076,8 @@ def wbia_plugin_curvrank_keypoints(
 
         zipped = zip(model_type_list, segmentations, localized_masks)
 
-        config_ = {
-            'ordered': True,
-            'chunksize': CHUNKSIZE,
-            'force_serial': ibs.force_serial or FORCE_SERIAL,
-            'progkw': {'freq': 10},
-        }
-        generator = ut.generate2(
-            wbia_plugin_curvrank_keypoints_worker, zipped, nTasks=num_total, **config_
+        generator = _run_stage(
+            ibs, 'keypoints', wbia_plugin_curvrank_keypoints_worker, zipped, kwargs
         )
 
         starts, ends, success_list = [], [], []
@@ -963,6 +1128,7 @@ def wbia_plugin_curvrank_outline_worker(
 
 
 @register_ibs_method
+@instrument_stage('outline', success_index=0)
 def wbia_plugin_curvrank_outline(
     ibs,
     success_list,
@@ -1126,16 +1292,8 @@ def wbia_plugin_curvrank_outline(
             allow_diagonal_list,
         )
 
-        config_ = {
-            'ordered': True,
-            'chunksize': CHUNKSIZE,
-            # 'force_serial': ibs.force_serial or FORCE_SERIAL,
-            # 'futures_threaded': True,
-            'force_serial': True,
-            'progkw': {'freq': 10},
-        }
-        generator = ut.generate2(
-            wbia_plugin_curvrank_outline_worker, zipped, nTasks=num_total, **config_
+        generator = _run_stage(
+            ibs, 'outline', wbia_plugin_curvrank_outline_worker, zipped, kwargs
         )
 
         success_list_, outlines = [], []
@@ -1163,6 +1321,7 @@ def wbia_plugin_curvrank_trailing_edges_worker(success, outline):
 
 
 @register_ibs_method
+@instrument_stage('trailing_edges', success_index=0)
 def wbia_plugin_curvrank_trailing_edges(
     ibs,
     aid_list,
@@ -1284,17 +1443,12 @@ def wbia_plugin_curvrank_trailing_edges(
     if model_type in model_tpe_list:
         zipped = zip(success_list, outlines)
 
-        config_ = {
-            'ordered': True,
-            'chunksize': CHUNKSIZE,
-            'force_serial': ibs.force_serial or FORCE_SERIAL,
-            'progkw': {'freq': 10},
-        }
-        generator = ut.generate2(
+        generator = _run_stage(
+            ibs,
+            'trailing_edges',
             wbia_plugin_curvrank_trailing_edges_worker,
             zipped,
-            nTasks=len(success_list),
-            **config_
+            kwargs,
         )
 
         success_list_ = []
@@ -1500,6 +1654,7 @@ def wbia_plugin_curvrank_trailing_edges(
 
 
 @register_ibs_method
+@instrument_stage('curvatures', success_index=0)
 def wbia_plugin_curvrank_curvatures(
     ibs,
     success_list,
@@ -1593,17 +1748,8 @@ def wbia_plugin_curvrank_curvatures(
     transpose_dims_list = [transpose_dims] * len(success_list)
     zipped = zip(success_list, trailing_edges, scales_list, transpose_dims_list)
 
-    config_ = {
-        'ordered': True,
-        'chunksize': CHUNKSIZE,
-        'force_serial': ibs.force_serial or FORCE_SERIAL,
-        'progkw': {'freq': 10},
-    }
-    generator = ut.generate2(
-        wbia_plugin_curvrank_curvatures_worker,
-        zipped,
-        nTasks=len(success_list),
-        **config_
+    generator = _run_stage(
+        ibs, 'curvatures', wbia_plugin_curvrank_curvatures_worker, zipped, kwargs
     )
 
     success_list_ = []
@@ -1631,6 +1777,7 @@ def wbia_plugin_curvrank_curvatures_worker(
 
 
 @register_ibs_method
+@instrument_stage('curvature_descriptors', success_index=0)
 def wbia_plugin_curvrank_curvature_descriptors(
     ibs,
     success_list,
@@ -1751,17 +1898,12 @@ def wbia_plugin_curvrank_curvature_descriptors(
         feat_dim_list,
     )
 
-    config_ = {
-        'ordered': True,
-        'chunksize': CHUNKSIZE,
-        'force_serial': ibs.force_serial or FORCE_SERIAL,
-        'progkw': {'freq': 10},
-    }
-    generator = ut.generate2(
+    generator = _run_stage(
+        ibs,
+        'curvature_descriptors',
         wbia_plugin_curvrank_curvature_descriptors_worker,
         zipped,
-        nTasks=len(success_list),
-        **config_
+        kwargs,
     )
 
     success_list_ = []
@@ -1805,12 +1947,15 @@ def wbia_plugin_curvrank_curvature_descriptors_worker(
 
 
 @register_ibs_method
-def wbia_plugin_curvrank_pipeline_compute(ibs, aid_list, config={}):
+def wbia_plugin_curvrank_pipeline_compute(ibs, aid_list, config={}, max_in_flight=None):
     r"""
     Args:
         ibs       (IBEISController): IBEIS controller object
         success_list: output of wbia_plugin_curvrank_outline
         outlines (list of np.ndarray): output of wbia_plugin_curvrank_outline
+        max_in_flight (int): if given, the annotations are pushed through every
+            stage max_in_flight at a time, so that the full-resolution
+            intermediates of at most that many annotations are held at once
 
     Returns:
         success_list_
@@ -1923,6 +2068,22 @@ def wbia_plugin_curvrank_pipeline_compute(ibs, aid_list, config={}):
         >>> ]
         >>> assert ut.hash_data(hash_list) in ['zacdsfedcywqdyqozfhdirrcqnypaazw']
     """
+    if max_in_flight is None or len(aid_list) <= max_in_flight:
+        return _pipeline_compute(ibs, aid_list, config)
+
+    success_list = []
+    curvature_descriptor_list = []
+    for aid_chunk in ut.ichunks(aid_list, max_in_flight):
+        success, curvature_descriptors = _pipeline_compute(ibs, aid_chunk, config)
+        success_list.extend(success)
+        curvature_descriptor_list.extend(curvature_descriptors)
+
+    return success_list, curvature_descriptor_list
+
+
+def _pipeline_compute(ibs, aid_list, config):
+    # Every intermediate is deleted right after its last consumer, the refined
+    # localizations and segmentations are at full resolution
     values = ibs.wbia_plugin_curvrank_preprocessing(aid_list, **config)
     resized_images, resized_masks, pre_transforms = values
 
@@ -1930,6 +2091,7 @@ def wbia_plugin_curvrank_pipeline_compute(ibs, aid_list, config={}):
         resized_images, resized_masks, **config
     )
     localized_images, localized_masks, loc_transforms = values
+    del resized_images, resized_masks, localized_images
 
     values = ibs.wbia_plugin_curvrank_refinement(
         aid_list, pre_transforms, loc_transforms, **config
@@ -1945,9 +2107,11 @@ def wbia_plugin_curvrank_pipeline_compute(ibs, aid_list, config={}):
         **config
     )
     segmentations, refined_segmentations = values
+    del pre_transforms, loc_transforms
 
     values = ibs.wbia_plugin_curvrank_keypoints(segmentations, localized_masks, **config)
     success, starts, ends = values
+    del segmentations, localized_masks
 
     args = (
         success,
@@ -1958,14 +2122,18 @@ def wbia_plugin_curvrank_pipeline_compute(ibs, aid_list, config={}):
         refined_segmentations,
     )
     success, outlines = ibs.wbia_plugin_curvrank_outline(*args, **config)
+    del args, starts, ends
+    del refined_localizations, refined_masks, refined_segmentations
 
     values = ibs.wbia_plugin_curvrank_trailing_edges(
         aid_list, success, outlines, **config
     )
     success, trailing_edges = values
+    del outlines
 
     values = ibs.wbia_plugin_curvrank_curvatures(success, trailing_edges, **config)
     success, curvatures = values
+    del trailing_edges
 
     values = ibs.wbia_plugin_curvrank_curvature_descriptors(success, curvatures, **config)
     success, curvature_descriptors = values
@@ -2242,7 +2410,10 @@ def wbia_plugin_curvrank_pipeline(
             table_name, aid_list, 'descriptor', config=config_
         )
     else:
-        values = ibs.wbia_plugin_curvrank_pipeline_compute(aid_list, config=config)
+        max_in_flight = config.get('max_in_flight', PIPELINE_MAX_IN_FLIGHT)
+        values = ibs.wbia_plugin_curvrank_pipeline_compute(
+            aid_list, config=config, max_in_flight=max_in_flight
+        )
         success_list, descriptor_dict_list = values
 
     if verbose:
@@ -2255,6 +2426,302 @@ def wbia_plugin_curvrank_pipeline(
     return lnbnn_dict, aid_list
 
 
+@register_ibs_method
+def wbia_plugin_curvrank_pipeline_aggregate_memmap(
+    ibs,
+    aid_list,
+    output_path,
+    config={},
+    use_depc=USE_DEPC,
+    use_depc_optimized=USE_DEPC_OPTIMIZED,
+    chunksize=INDEX_BUILD_CHUNKSIZE,
+    verbose=False,
+):
+    r"""
+    Same as wbia_plugin_curvrank_pipeline, but the descriptors of each scale are
+    written into a memory-mapped float32 matrix with a parallel int32 aid array
+
+    The annotations go through the pipeline chunksize at a time, once.  Each
+    chunk is appended to raw per-scale spool files in output_path while the
+    descriptors are counted, then the spools are copied into the preallocated
+    .npy files and deleted.  Only one chunk of descriptors is ever held in
+    memory.  Building the LNBNN indices does not need the matrices,
+    wbia_plugin_curvrank_scores adds the chunks to the indices as they arrive.
+
+    Args:
+        ibs       (IBEISController): IBEIS controller object
+        aid_list  (list of int): annotations to aggregate
+        output_path (str): directory for descriptors_scale_<scale>.npy and
+            aids_scale_<scale>.npy
+
+    Returns:
+        lnbnn_dict (dict): scale -> (descriptors, aids), both read-only memmaps
+
+    CommandLine:
+        python -m wbia_curvrank._plugin --test-wbia_plugin_curvrank_pipeline_aggregate_memmap
+
+    Example0:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank._plugin import *  # NOQA
+        >>> import wbia
+        >>> from wbia.init import sysres
+        >>> dbdir = sysres.ensure_testdb_curvrank()
+        >>> ibs = wbia.opendb(dbdir=dbdir)
+        >>> aid_list = ibs.get_image_aids(1)
+        >>> output_path = ut.ensure_app_resource_dir('wbia_curvrank', 'aggregate_memmap')
+        >>> lnbnn_dict = ibs.wbia_plugin_curvrank_pipeline_aggregate_memmap(aid_list, output_path, chunksize=1)
+        >>> lnbnn_dict_, _ = ibs.wbia_plugin_curvrank_pipeline(aid_list=aid_list)
+        >>> for scale in lnbnn_dict_:
+        >>>     descriptors, aids = lnbnn_dict[scale]
+        >>>     assert np.all(descriptors == lnbnn_dict_[scale][0])
+        >>>     assert np.all(aids == lnbnn_dict_[scale][1]) and aids.dtype == np.int32
+    """
+    ut.ensuredir(output_path)
+
+    def _filepaths(scale, ext):
+        descriptors_filepath = join(output_path, 'descriptors_scale_%s%s' % (scale, ext))
+        aids_filepath = join(output_path, 'aids_scale_%s%s' % (scale, ext))
+        return descriptors_filepath, aids_filepath
+
+    # Single pass, append the descriptors of each scale to the spools and count them
+    shape_dict = {}
+    spool_dict = {}
+    try:
+        with ut.Timer('Spooling LNBNN descriptors to %r' % (output_path,)):
+            for aid_chunk in ut.ichunks(aid_list, chunksize):
+                values = ibs.wbia_plugin_curvrank_pipeline(
+                    aid_list=aid_chunk,
+                    config=config,
+                    verbose=verbose,
+                    use_depc=use_depc,
+                    use_depc_optimized=use_depc_optimized,
+                )
+                lnbnn_dict, _ = values
+                for scale in lnbnn_dict:
+                    descriptors, aids = lnbnn_dict[scale]
+                    if scale not in spool_dict:
+                        spool_dict[scale] = [
+                            open(filepath, 'wb')
+                            for filepath in _filepaths(scale, '.spool')
+                        ]
+                    num, fdim = shape_dict.get(scale, (0, descriptors.shape[1]))
+                    assert fdim == descriptors.shape[1]
+                    shape_dict[scale] = (num + descriptors.shape[0], fdim)
+                    descriptors_file, aids_file = spool_dict[scale]
+                    np.asarray(descriptors, dtype=np.float32).tofile(descriptors_file)
+                    np.asarray(aids, dtype=np.int32).tofile(aids_file)
+                del lnbnn_dict, values
+
+        for scale in spool_dict:
+            for spool_file in spool_dict[scale]:
+                spool_file.close()
+
+        # Copy the spools into the preallocated matrices
+        lnbnn_dict = {}
+        with ut.Timer('Writing LNBNN descriptors to %r' % (output_path,)):
+            for scale in shape_dict:
+                shape = shape_dict[scale]
+                descriptors_filepath, aids_filepath = _filepaths(scale, '.npy')
+                descriptors_spool, aids_spool = _filepaths(scale, '.spool')
+                for filepath, spool, dtype, shape_ in [
+                    (descriptors_filepath, descriptors_spool, np.float32, shape),
+                    (aids_filepath, aids_spool, np.int32, shape[:1]),
+                ]:
+                    arr = np.lib.format.open_memmap(
+                        filepath, mode='w+', dtype=dtype, shape=shape_
+                    )
+                    if shape[0] > 0:
+                        arr[:] = np.memmap(spool, dtype=dtype, mode='r', shape=shape_)
+                    arr.flush()
+                    del arr
+                lnbnn_dict[scale] = (
+                    np.load(descriptors_filepath, mmap_mode='r'),
+                    np.load(aids_filepath, mmap_mode='r'),
+                )
+    finally:
+        for scale in spool_dict:
+            for spool_file in spool_dict[scale]:
+                spool_file.close()
+                ut.delete(spool_file.name)
+
+    return lnbnn_dict
+
+
+INDEX_BASE_AIDS_FILENAME = 'base_aids.pkl'
+INDEX_FUTURE_PREFIX = '__future__'
+INDEX_LOCK_PREFIX = '__lock__'
+INDEX_COMPACTION_THREADS = {}
+
+
+def _stage_lnbnn_index(cache_path, index_directory):
+    # Every writer stages into its own directory, so builds and compactions of the
+    # same index, in this or another process, never write into the same files
+    prefix = '%s%s_' % (INDEX_FUTURE_PREFIX, index_directory)
+    return tempfile.mkdtemp(dir=cache_path, prefix=prefix)
+
+
+def _publish_lnbnn_index(future_index_path, index_path):
+    r"""
+    Atomically rename the staged index to index_path
+
+    Returns:
+        bool: False if another writer published index_path first, the staged
+            index is deleted as the published one is equivalent
+    """
+    try:
+        os.rename(future_index_path, index_path)
+    except OSError:
+        if not exists(index_path):
+            raise
+        ut.delete(future_index_path)
+        return False
+    return True
+
+
+def _lnbnn_index_lock_path(index_path):
+    cache_path, index_directory = split(index_path)
+    return join(cache_path, '%s%s' % (INDEX_LOCK_PREFIX, index_directory))
+
+
+def _lock_lnbnn_index(index_path):
+    r"""
+    Non-blocking exclusive lock of an index, held while the index is compacted so
+    that neither another compaction nor the TTL sweep touches it
+
+    Returns:
+        file: the open lock file, closing it releases the lock (as does the end of
+            the process), or None if the index is already locked
+    """
+    lock_file = open(_lnbnn_index_lock_path(index_path), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def _find_lnbnn_base_index(cache_path, config_hash, db_aid_list, scale_list, num_trees):
+    r"""
+    Find the largest live index (with the same config) that was built from a
+    subset of db_aid_list and has an index for every scale
+
+    Returns:
+        tuple: (index path, {scale: index directory}) or (None, None)
+    """
+    db_aid_set = set(db_aid_list)
+    best = None, None
+    best_num = -1
+    # Directories start with their timestamp, so the newest wins ties
+    for path in sorted(ut.glob(join(cache_path, 'index_*_config_%s' % (config_hash,)))):
+        base_aids_filepath = join(path, INDEX_BASE_AIDS_FILENAME)
+        if not exists(base_aids_filepath):
+            continue
+
+        base_directory_dict = {}
+        for scale in scale_list:
+            args = (scale, num_trees)
+            base_path_list = ut.glob(join(path, 'db_index_scale_%s_trees_%s' % args))
+            if len(base_path_list) != 1:
+                break
+            base_path = base_path_list[0]
+            if not exists(join(base_path, 'index.ann')):
+                break
+            if not exists(join(base_path, 'aids.pkl')):
+                break
+            base_directory_dict[scale] = split(base_path)[1]
+        if len(base_directory_dict) != len(scale_list):
+            continue
+
+        try:
+            base_aid_list = ut.load_cPkl(base_aids_filepath)
+        except Exception:
+            continue
+        if not set(base_aid_list).issubset(db_aid_set):
+            continue
+
+        if len(base_aid_list) >= best_num:
+            best = path, base_directory_dict
+            best_num = len(base_aid_list)
+
+    return best
+
+
+def _compact_lnbnn_index(
+    base_index_path,
+    base_directory_dict,
+    base_aid_list,
+    delta_aid_list,
+    delta_dict,
+    index_path,
+    num_jobs,
+):
+    r"""
+    Fold the delta annotations into a new base index
+
+    The base descriptors are read back from the base Annoy indices, so this does
+    not touch the depc and is safe to run in a background thread.  It is run in a
+    non-daemon thread, so the process does not exit before it finishes, and its
+    Annoy build uses only num_jobs (INDEX_COMPACTION_NUM_JOBS by default) cores
+    to leave the others to the queries being scored.  The base is locked for the
+    duration, a base that is already locked is being compacted by another thread
+    or process and is skipped.
+    """
+    lock_file = _lock_lnbnn_index(base_index_path)
+    if lock_file is None:
+        logger.info('Index %r is already being compacted', base_index_path)
+        return
+
+    future_index_path = None
+    try:
+        if not exists(base_index_path):
+            # deleted by the TTL sweep before it could be locked
+            return
+        cache_path, index_directory = split(index_path)
+        future_index_path = _stage_lnbnn_index(cache_path, index_directory)
+        with ut.Timer('Compacting index %r into %r' % (base_index_path, index_path)):
+            for scale in base_directory_dict:
+                base_directory = base_directory_dict[scale]
+                base_path = join(base_index_path, base_directory)
+                future_path = join(future_index_path, base_directory)
+                ut.ensuredir(future_path)
+
+                if scale not in delta_dict:
+                    ut.copy(join(base_path, 'index.ann'), join(future_path, 'index.ann'))
+                    ut.copy(join(base_path, 'aids.pkl'), join(future_path, 'aids.pkl'))
+                    continue
+
+                descriptors, aids = delta_dict[scale]
+                num_trees = int(base_directory.split('_')[-1])
+                fdim = descriptors.shape[1]
+                base_index = INDEX_REGISTRY.get(join(base_path, 'index.ann'), fdim)
+                chunks = itertools.chain(F.lnbnn_index_items(base_index), [descriptors])
+                index = F.build_lnbnn_index(
+                    chunks,
+                    join(future_path, 'index.ann'),
+                    num_trees=num_trees,
+                    n_jobs=num_jobs,
+                )
+                index.unload()
+
+                base_aids = ut.load_cPkl(join(base_path, 'aids.pkl'))
+                ut.save_cPkl(join(future_path, 'aids.pkl'), np.hstack((base_aids, aids)))
+
+            base_aid_list_ = list(base_aid_list) + list(delta_aid_list)
+            base_aids_filepath = join(future_index_path, INDEX_BASE_AIDS_FILENAME)
+            ut.save_cPkl(base_aids_filepath, base_aid_list_)
+
+            _publish_lnbnn_index(future_index_path, index_path)
+            future_index_path = None
+    except Exception:
+        logger.exception('Compacting index %r failed', base_index_path)
+    finally:
+        # the staging directory is unique to this compaction
+        if future_index_path is not None and exists(future_index_path):
+            ut.delete(future_index_path)
+        lock_file.close()
+
+
 @register_ibs_method
 def wbia_plugin_curvrank_scores(
     ibs,
@@ -2442,7 +2909,7 @@ def wbia_plugin_curvrank_scores(
     cache_path = abspath(join(ibs.get_cachedir(), 'curvrank'))
     ut.ensuredir(cache_path)
 
-    FUTURE_PREFIX = '__future__'
+    FUTURE_PREFIX = INDEX_FUTURE_PREFIX
     TTL_HOUR_DELETE = 7 * 24
     TTL_HOUR_PREVIOUS = 2 * 24
 
@@ -2453,6 +2920,10 @@ def wbia_plugin_curvrank_scores(
     num_trees = config.pop('num_trees', INDEX_NUM_TREES)
     search_k = config.pop('search_k', INDEX_SEARCH_K)
     lnbnn_k = config.pop('lnbnn_k', INDEX_LNBNN_K)
+    num_workers = config.pop('num_workers', INDEX_NUM_WORKERS)
+    num_jobs = config.pop('num_jobs', INDEX_NUM_JOBS)
+    delta_max_annots = config.pop('delta_max_annots', INDEX_DELTA_MAX_ANNOTS)
+    compaction_num_jobs = config.pop('compaction_num_jobs', INDEX_COMPACTION_NUM_JOBS)
 
     args = (
         use_daily_cache,
@@ -2466,6 +2937,10 @@ def wbia_plugin_curvrank_scores(
     print('CurvRank num_trees   : %r' % (num_trees,))
     print('CurvRank search_k    : %r' % (search_k,))
     print('CurvRank lnbnn_k     : %r' % (lnbnn_k,))
+    print('CurvRank num_workers : %r' % (num_workers,))
+    print('CurvRank num_jobs    : %r' % (num_jobs,))
+    print('CurvRank delta_max_annots : %r' % (delta_max_annots,))
+    print('CurvRank compaction_num_jobs : %r' % (compaction_num_jobs,))
     print('CurvRank algo config : %s' % (ut.repr3(config),))
 
     config_hash = ut.hash_data(ut.repr3(config))
@@ -2502,8 +2977,14 @@ def wbia_plugin_curvrank_scores(
                 print('Checking %r (%r)' % (directory, then,))
 
                 if then < past_delete:
-                    print('\ttoo old, deleting %r...' % (path,))
-                    ut.delete(path)
+                    lock_file = _lock_lnbnn_index(path)
+                    if lock_file is None:
+                        print('\ttoo old, but being compacted, keeping %r...' % (path,))
+                    else:
+                        print('\ttoo old, deleting %r...' % (path,))
+                        ut.delete(path)
+                        ut.delete(_lnbnn_index_lock_path(path))
+                        lock_file.close()
                 else:
                     if past_previous <= then:
                         daily_index_search_str = '_hash_%s_config_' % (daily_index_hash,)
@@ -2603,6 +3084,38 @@ def wbia_plugin_curvrank_scores(
             qr_lnbnn_data_list.append(qr_lnbnn_data)
         scale_list = sorted(list(scale_set))
 
+    # Instead of rebuilding the index whenever the database changes, use the largest
+    # existing index built from a subset of the database as the base and search the
+    # annotations added since then (the delta) exhaustively
+    base_index_path, base_directory_dict = None, None
+    delta_aid_list = []
+    if not use_daily_cache and not force_cache_recompute:
+        trees = '*' if daily_cache_tag in ['global'] else num_trees
+        values = _find_lnbnn_base_index(
+            cache_path, config_hash, db_aid_list, scale_list, trees
+        )
+        base_index_path, base_directory_dict = values
+        if base_index_path is not None:
+            base_aids_filepath = join(base_index_path, INDEX_BASE_AIDS_FILENAME)
+            base_aid_list = ut.load_cPkl(base_aids_filepath)
+            base_aid_set = set(base_aid_list)
+            delta_aid_list = [aid for aid in db_aid_list if aid not in base_aid_set]
+            if len(delta_aid_list) > delta_max_annots:
+                # Searching the delta exhaustively costs more than the index, so
+                # rebuild the full index for this database instead
+                print(
+                    'Ignoring base index %r, its %d delta annotations exceed %d'
+                    % (base_index_path, len(delta_aid_list), delta_max_annots)
+                )
+                base_index_path, base_directory_dict = None, None
+                delta_aid_list = []
+            else:
+                print(
+                    'Using base index %r with %d delta annotations'
+                    % (base_index_path, len(delta_aid_list))
+                )
+                index_path = base_index_path
+
     if not exists(index_path):
         force_cache_recompute = True
 
@@ -2673,45 +3186,81 @@ def wbia_plugin_curvrank_scores(
 
         if compute:
             # Cache as a future job until it is complete, in case other threads are looking at this cache as well
-            future_index_directory = '%s%s' % (FUTURE_PREFIX, index_directory,)
-            future_index_path = join(cache_path, future_index_directory)
-            ut.ensuredir(future_index_path)
+            future_index_path = _stage_lnbnn_index(cache_path, index_directory)
 
-            with ut.Timer('Loading database LNBNN descriptors from depc'):
-                values = ibs.wbia_plugin_curvrank_pipeline(
-                    aid_list=db_aid_list,
-                    config=config,
-                    verbose=verbose,
-                    use_depc=use_depc,
-                    use_depc_optimized=use_depc_optimized,
+            future_index_filepath_dict = {}
+            future_aids_filepath_dict = {}
+            for scale in scale_list:
+                index_filepath = index_filepath_dict[scale]
+                aids_filepath = aids_filepath_dict[scale]
+
+                future_index_filepath = index_filepath.replace(
+                    index_path, future_index_path
+                )
+                future_aids_filepath = aids_filepath.replace(
+                    index_path, future_index_path
                 )
-                db_lnbnn_data, _ = values
 
-            with ut.Timer('Creating Annoy indices'):
-                for scale in scale_list:
-                    assert scale in db_lnbnn_data
-                    index_filepath = index_filepath_dict[scale]
-                    aids_filepath = aids_filepath_dict[scale]
+                ut.ensuredir(split(future_index_filepath)[0])
+                ut.ensuredir(split(future_aids_filepath)[0])
+
+                future_index_filepath_dict[scale] = future_index_filepath
+                future_aids_filepath_dict[scale] = future_aids_filepath
 
-                    future_index_filepath = index_filepath.replace(
-                        index_path, future_index_path
+            # Stream the database descriptors from the depc in chunks of annotations
+            # and add them to the (on-disk) indices as they arrive, so the whole
+            # database is never held in memory at once
+            builder_dict = {}
+            aids_list_dict = {}
+            for scale in scale_list:
+                if not exists(index_filepath_dict[scale]):
+                    print(
+                        'Writing computed Annoy scale=%r index to %r...'
+                        % (scale, future_index_filepath_dict[scale],)
                     )
-                    future_aids_filepath = aids_filepath.replace(
-                        index_path, future_index_path
+                    builder_dict[scale] = F.LNBNNIndexBuilder(
+                        future_index_filepath_dict[scale],
+                        num_trees=num_trees,
+                        n_jobs=num_jobs,
                     )
-
-                    ut.ensuredir(split(future_index_filepath)[0])
-                    ut.ensuredir(split(future_aids_filepath)[0])
-
-                    if not exists(index_filepath):
-                        print(
-                            'Writing computed Annoy scale=%r index to %r...'
-                            % (scale, future_index_filepath,)
-                        )
-                        descriptors, aids = db_lnbnn_data[scale]
-                        F.build_lnbnn_index(
-                            descriptors, future_index_filepath, num_trees=num_trees
+                if not exists(aids_filepath_dict[scale]):
+                    aids_list_dict[scale] = []
+
+            if len(builder_dict) > 0 or len(aids_list_dict) > 0:
+                with ut.Timer('Streaming database LNBNN descriptors from depc'):
+                    db_aid_chunks = ut.ichunks(db_aid_list, INDEX_BUILD_CHUNKSIZE)
+                    for db_aid_chunk in db_aid_chunks:
+                        values = ibs.wbia_plugin_curvrank_pipeline(
+                            aid_list=db_aid_chunk,
+                            config=config,
+                            verbose=verbose,
+                            use_depc=use_depc,
+                            use_depc_optimized=use_depc_optimized,
                         )
+                        db_lnbnn_data, _ = values
+                        for scale in scale_list:
+                            if scale not in db_lnbnn_data:
+                                continue
+                            descriptors, aids = db_lnbnn_data[scale]
+                            if scale in builder_dict:
+                                builder_dict[scale].add(descriptors)
+                            if scale in aids_list_dict:
+                                aids_list_dict[scale].append(aids)
+                        del db_lnbnn_data, values
+
+            with ut.Timer('Creating Annoy indices'):
+                for scale in scale_list:
+                    index_filepath = index_filepath_dict[scale]
+                    aids_filepath = aids_filepath_dict[scale]
+                    future_index_filepath = future_index_filepath_dict[scale]
+                    future_aids_filepath = future_aids_filepath_dict[scale]
+
+                    if scale in builder_dict:
+                        builder = builder_dict.pop(scale)
+                        msg = 'No database descriptors for scale=%r' % (scale,)
+                        assert builder.num_items > 0, msg
+                        index = builder.build()
+                        index.unload()
                     else:
                         ut.copy(index_filepath, future_index_filepath)
                         print(
@@ -2719,11 +3268,12 @@ def wbia_plugin_curvrank_scores(
                             % (scale, index_filepath,)
                         )
 
-                    if not exists(aids_filepath):
+                    if scale in aids_list_dict:
                         print(
                             'Writing computed AIDs scale=%r to %r...'
                             % (scale, future_aids_filepath,)
                         )
+                        aids = np.hstack(aids_list_dict.pop(scale))
                         ut.save_cPkl(future_aids_filepath, aids)
                         print('\t...saved')
                     else:
@@ -2733,66 +3283,170 @@ def wbia_plugin_curvrank_scores(
                             % (scale, aids_filepath,)
                         )
 
+            base_aids_filepath = join(future_index_path, INDEX_BASE_AIDS_FILENAME)
+            ut.save_cPkl(base_aids_filepath, db_aid_list)
+
             with ut.Timer('Activating index by setting from future to live'):
-                ut.delete(index_path)
-                ut.move(future_index_path, index_path, verbose=True)
+                if exists(index_path):
+                    # incomplete or forced to recompute
+                    ut.delete(index_path)
+                _publish_lnbnn_index(future_index_path, index_path)
+
+        delta_dict = {}
+        if len(delta_aid_list) > 0:
+            with ut.Timer('Loading delta LNBNN descriptors'):
+                delta_chunks_dict = {scale: [] for scale in scale_list}
+                delta_aid_chunks = ut.ichunks(delta_aid_list, INDEX_BUILD_CHUNKSIZE)
+                for delta_aid_chunk in delta_aid_chunks:
+                    values = ibs.wbia_plugin_curvrank_pipeline(
+                        aid_list=delta_aid_chunk,
+                        config=config,
+                        verbose=verbose,
+                        use_depc=use_depc,
+                        use_depc_optimized=use_depc_optimized,
+                    )
+                    delta_lnbnn_data, _ = values
+                    for scale in scale_list:
+                        if scale in delta_lnbnn_data:
+                            delta_chunks_dict[scale].append(delta_lnbnn_data[scale])
+                    del delta_lnbnn_data, values
+                for scale in scale_list:
+                    chunks = delta_chunks_dict.pop(scale)
+                    if len(chunks) > 0:
+                        descriptors = np.vstack([chunk[0] for chunk in chunks])
+                        aids = np.hstack([chunk[1] for chunk in chunks])
+                        delta_dict[scale] = (descriptors, aids)
+
+            if 2 * len(delta_aid_list) > delta_max_annots:
+                # Fold the delta into a new base in the background before it grows
+                # past delta_max_annots, this query keeps using the current base
+                # and delta
+                thread = INDEX_COMPACTION_THREADS.get(base_index_path, None)
+                if thread is None or not thread.is_alive():
+                    args = (
+                        base_index_path,
+                        base_directory_dict,
+                        base_aid_list,
+                        delta_aid_list,
+                        delta_dict,
+                        join(cache_path, index_directory),
+                        compaction_num_jobs,
+                    )
+                    # Not a daemon, so that an interrupted compaction never leaves
+                    # a half-written index behind: the process does not exit until
+                    # the compaction finishes
+                    thread = threading.Thread(target=_compact_lnbnn_index, args=args)
+                    thread.start()
+                    INDEX_COMPACTION_THREADS[base_index_path] = thread
 
         with ut.Timer('Loading database AIDs from cache'):
             aids_dict = {}
+            name_index_dict = {}
             for scale in scale_list:
                 aids_filepath = aids_filepath_dict[scale]
                 assert exists(aids_filepath)
-                aids_dict[scale] = ut.load_cPkl(aids_filepath)
+                db_aids = ut.load_cPkl(aids_filepath)
+                if scale in delta_dict:
+                    # Delta items follow the base index's own items
+                    _, delta_aids = delta_dict[scale]
+                    db_aids = np.hstack((db_aids, delta_aids))
+                aids_dict[scale] = db_aids
+
+                # The database side of the LNBNN votes is the same for every query
+                if use_names:
+                    db_rowids = ibs.get_annot_nids(db_aids)
+                else:
+                    db_rowids = db_aids
+                name_index_dict[scale] = (db_rowids, F.lnbnn_name_index(db_rowids))
 
     assert exists(index_path)
 
-    with ut.Timer('Computing scores'):
-        zipped = list(zip(qr_aids_list, qr_lnbnn_data_list))
-        for qr_aid_list, qr_lnbnn_data in ut.ProgressIter(
-            zipped, lbl='CurvRank Vectored Scoring', freq=1000
-        ):
+    # Split the workers between the scales and the descriptors of each scale, the
+    # Annoy lookups release the GIL so threads are enough.  The descriptor chunks
+    # of every query and scale share one pool, separate from the scale pool whose
+    # tasks wait on them
+    scale_workers = max(1, min(num_workers, len(scale_list)))
+    descriptor_workers = max(1, num_workers // scale_workers)
+    if scale_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=scale_workers)
+    else:
+        executor = None
+    if descriptor_workers > 1:
+        descriptor_executor = ThreadPoolExecutor(
+            max_workers=scale_workers * descriptor_workers
+        )
+    else:
+        descriptor_executor = None
 
-            # Run LNBNN identification for each scale independently and aggregate
-            score_dict = {}
-            for scale in ut.ProgressIter(
-                scale_list, lbl='Performing ANN inference', freq=1
+    # The finally also runs when the caller stops consuming the scores early
+    try:
+        with ut.Timer('Computing scores'):
+            zipped = list(zip(qr_aids_list, qr_lnbnn_data_list))
+            for qr_aid_list, qr_lnbnn_data in ut.ProgressIter(
+                zipped, lbl='CurvRank Vectored Scoring', freq=1000
             ):
-                assert scale in qr_lnbnn_data
-                assert scale in index_filepath_dict
-                assert scale in aids_dict
 
-                qr_descriptors, _ = qr_lnbnn_data[scale]
-                index_filepath = index_filepath_dict[scale]
+                # Run LNBNN identification for each scale independently and aggregate
+                def _identify(scale):
+                    assert scale in qr_lnbnn_data
+                    assert scale in index_filepath_dict
+                    assert scale in aids_dict
 
-                assert exists(index_filepath)
-                db_aids = aids_dict[scale]
+                    qr_descriptors, _ = qr_lnbnn_data[scale]
+                    index_filepath = index_filepath_dict[scale]
+                    delta_descriptors, _ = delta_dict.get(scale, (None, None))
+
+                    assert exists(index_filepath)
+                    db_rowids, name_index = name_index_dict[scale]
+
+                    return F.lnbnn_identify(
+                        index_filepath,
+                        lnbnn_k,
+                        qr_descriptors,
+                        db_rowids,
+                        search_k=search_k,
+                        name_index=name_index,
+                        num_workers=descriptor_workers,
+                        delta=delta_descriptors,
+                        executor=descriptor_executor,
+                    )
 
-                if use_names:
-                    db_rowids = ibs.get_annot_nids(db_aids)
+                if executor is None:
+                    score_dict_list = map(_identify, scale_list)
                 else:
-                    db_rowids = db_aids
-
-                score_dict_ = F.lnbnn_identify(
-                    index_filepath, lnbnn_k, qr_descriptors, db_rowids, search_k=search_k
-                )
-                for rowid in score_dict_:
-                    if rowid not in score_dict:
-                        score_dict[rowid] = 0.0
-                    score_dict[rowid] += score_dict_[rowid]
-
-            if verbose:
-                print('Returning scores...')
-
-            # Sparsify
-            qr_aid_set = set(qr_aid_list)
-            rowid_list = list(score_dict.keys())
-            for rowid in rowid_list:
-                score = score_dict[rowid]
-                # Scores are non-positive floats (unless errored), delete scores that are 0.0 or positive.
-                if score >= minimum_score or rowid in qr_aid_set:
-                    score_dict.pop(rowid)
-
-            yield qr_aid_list, score_dict
+                    score_dict_list = executor.map(_identify, scale_list)
+
+                # Merge in scale order so the summed scores do not depend on the workers
+                score_dict = {}
+                for score_dict_ in ut.ProgressIter(
+                    score_dict_list,
+                    lbl='Performing ANN inference',
+                    freq=1,
+                    length=len(scale_list),
+                ):
+                    for rowid in score_dict_:
+                        if rowid not in score_dict:
+                            score_dict[rowid] = 0.0
+                        score_dict[rowid] += score_dict_[rowid]
+
+                if verbose:
+                    print('Returning scores...')
+
+                # Sparsify
+                qr_aid_set = set(qr_aid_list)
+                rowid_list = list(score_dict.keys())
+                for rowid in rowid_list:
+                    score = score_dict[rowid]
+                    # Scores are non-positive floats (unless errored), delete scores that are 0.0 or positive.
+                    if score >= minimum_score or rowid in qr_aid_set:
+                        score_dict.pop(rowid)
+
+                yield qr_aid_list, score_dict
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if descriptor_executor is not None:
+            descriptor_executor.shutdown()
 
 
 @register_ibs_method
@@ -5,6 +5,13 @@ import numpy as np
 import utool as ut
 import vtool as vt
 from wbia import dtool
+from wbia_curvrank.storage import (
+    STORAGE_MASK_SCALE,
+    STORAGE_PROBABILITY_SCALE,
+    encode_array,
+    load_array,
+    save_array,
+)
 import wbia
 
 
@@ -39,11 +46,36 @@ DEFAULT_TRANSPOSE_DIMS = {
 }
 
 
+LOCALIZATION_BATCH_SIZE = 64
+SEGMENTATION_BATCH_SIZE = 32
+# annotations pushed through the whole pipeline at once, a multiple of both batch
+# sizes so the networks still see full batches
+PIPELINE_MAX_IN_FLIGHT = 64
+# executor backend of the per-annotation CPU work of each stage, see executors.py;
+# the process pools (and the serial outline) the stages have always used, threads
+# avoid pickling the images but are only worth it where measured to be faster
+STAGE_EXECUTORS = {
+    'preprocessing': 'processes',
+    'refinement': 'processes',
+    'keypoints': 'processes',
+    'outline': 'serial',
+    'trailing_edges': 'processes',
+    'curvatures': 'processes',
+    'curvature_descriptors': 'processes',
+}
+
+
 INDEX_NUM_TREES = 10
 INDEX_NUM_ANNOTS = 2500  # 1000
 INDEX_LNBNN_K = 2
 INDEX_SEARCH_D = 1  # 1
 INDEX_SEARCH_K = INDEX_LNBNN_K * INDEX_NUM_TREES * INDEX_SEARCH_D
+INDEX_NUM_WORKERS = 1
+INDEX_NUM_JOBS = -1
+INDEX_BUILD_CHUNKSIZE = 256
+INDEX_DELTA_MAX_ANNOTS = 500
+# the background compaction shares the cores with the queries being scored
+INDEX_COMPACTION_NUM_JOBS = 1
 
 
 DEFAULT_DORSAL_TEST_CONFIG = {
@@ -73,6 +105,10 @@ DEFAULT_DORSAL_TEST_CONFIG = {
     'index_trees': INDEX_NUM_TREES,
     'index_search_k': INDEX_SEARCH_K,
     'index_lnbnn_k': INDEX_LNBNN_K,
+    'index_num_workers': INDEX_NUM_WORKERS,
+    'index_num_jobs': INDEX_NUM_JOBS,
+    'index_delta_max_annots': INDEX_DELTA_MAX_ANNOTS,
+    'index_compaction_num_jobs': INDEX_COMPACTION_NUM_JOBS,
 }
 
 
@@ -103,6 +139,10 @@ DEFAULT_FLUKE_TEST_CONFIG = {
     'index_trees': INDEX_NUM_TREES,
     'index_search_k': INDEX_SEARCH_K,
     'index_lnbnn_k': INDEX_LNBNN_K,
+    'index_num_workers': INDEX_NUM_WORKERS,
+    'index_num_jobs': INDEX_NUM_JOBS,
+    'index_delta_max_annots': INDEX_DELTA_MAX_ANNOTS,
+    'index_compaction_num_jobs': INDEX_COMPACTION_NUM_JOBS,
 }
 
 
@@ -115,6 +155,7 @@ DEFAULT_DEPC_KEY_MAPPING = {
     'curvrank_height': 'height',
     'curvrank_greyscale': 'greyscale',
     'curvrank_scale': 'scale',
+    'curvrank_refinement_compact': 'refinement_compact',
     'curvature_scales': 'scales',
     'outline_allow_diagonal': 'allow_diagonal',
     'curvatute_transpose_dims': 'transpose_dims',
@@ -131,6 +172,18 @@ DEFAULT_DEPC_KEY_MAPPING = {
     'index_trees': 'num_trees',
     'index_search_k': 'search_k',
     'index_lnbnn_k': 'lnbnn_k',
+    'index_num_workers': 'num_workers',
+    'index_num_jobs': 'num_jobs',
+    'index_delta_max_annots': 'delta_max_annots',
+    'index_compaction_num_jobs': 'compaction_num_jobs',
+    'curvrank_executor_preprocessing': 'preprocessing_executor',
+    'curvrank_executor_refinement': 'refinement_executor',
+    'curvrank_executor_keypoints': 'keypoints_executor',
+    'curvrank_executor_outline': 'outline_executor',
+    'curvrank_executor_trailing_edges': 'trailing_edges_executor',
+    'curvrank_executor_curvatures': 'curvatures_executor',
+    'curvrank_executor_curvature_descriptors': 'curvature_descriptors_executor',
+    'curvrank_max_in_flight': 'max_in_flight',
 }
 
 
@@ -295,6 +348,13 @@ class LocalizationConfig(dtool.Config):
             ut.ParamInfo('curvrank_height', DEFAULT_HEIGHT['dorsal']),
             ut.ParamInfo('curvrank_width', DEFAULT_WIDTH['dorsal']),
             ut.ParamInfo('localization_model_tag', 'localization'),
+            ut.ParamInfo(
+                'localization_batch_size',
+                LOCALIZATION_BATCH_SIZE,
+                hideif=LOCALIZATION_BATCH_SIZE,
+            ),
+            ut.ParamInfo('localization_max_bytes', None, hideif=None),
+            ut.ParamInfo('curvrank_storage', 'native', hideif='native'),
             ut.ParamInfo('ext', '.npy', hideif='.npy'),
         ]
 
@@ -312,10 +372,10 @@ class LocalizationConfig(dtool.Config):
         'transform',
     ],
     coltypes=[
-        ('extern', np.load, np.save),
+        ('extern', load_array, save_array),
         int,
         int,
-        ('extern', np.load, np.save),
+        ('extern', ut.partial(load_array, scale=STORAGE_MASK_SCALE), save_array),
         int,
         int,
         np.ndarray,
@@ -389,6 +449,9 @@ def wbia_plugin_curvrank_localization_depc(depc, preprocess_rowid_list, config=N
     width = config['curvrank_width']
     height = config['curvrank_height']
     model_tag = config['localization_model_tag']
+    batch_size = config['localization_batch_size']
+    max_bytes = config['localization_max_bytes']
+    storage = config['curvrank_storage']
 
     resized_images = depc.get_native('preprocess', preprocess_rowid_list, 'resized_img')
     resized_masks = depc.get_native('preprocess', preprocess_rowid_list, 'mask_img')
@@ -400,6 +463,8 @@ def wbia_plugin_curvrank_localization_depc(depc, preprocess_rowid_list, config=N
         height=height,
         model_type=model_type,
         model_tag=model_tag,
+        batch_size=batch_size,
+        max_bytes=max_bytes,
     )
     localized_images, localized_masks, loc_transforms = values
 
@@ -412,7 +477,7 @@ def wbia_plugin_curvrank_localization_depc(depc, preprocess_rowid_list, config=N
             localized_image,
             localized_width,
             localized_height,
-            localized_mask,
+            encode_array(localized_mask, storage, STORAGE_MASK_SCALE),
             mask_width,
             mask_height,
             loc_transform,
@@ -426,6 +491,7 @@ class RefinementConfig(dtool.Config):
             ut.ParamInfo('curvrank_height', DEFAULT_WIDTH['dorsal']),
             ut.ParamInfo('curvrank_scale', DEFAULT_SCALE['dorsal']),
             ut.ParamInfo('curvrank_greyscale', False, hideif=False),
+            ut.ParamInfo('curvrank_refinement_compact', False, hideif=False),
             ut.ParamInfo('ext', '.npy', hideif='.npy'),
         ]
 
@@ -442,10 +508,10 @@ class RefinementConfig(dtool.Config):
         'mask_height',
     ],
     coltypes=[
-        ('extern', np.load, np.save),
+        ('extern', load_array, save_array),
         int,
         int,
-        ('extern', np.load, np.save),
+        ('extern', load_array, save_array),
         int,
         int,
     ],
@@ -507,6 +573,7 @@ def wbia_plugin_curvrank_refinement_depc(
     height = config['curvrank_height']
     scale = config['curvrank_scale']
     greyscale = config['curvrank_greyscale']
+    refinement_compact = config['curvrank_refinement_compact']
 
     aid_list = depc.get_ancestor_rowids('preprocess', preprocess_rowid_list)
     loc_transforms = depc.get_native('localization', localization_rowid_list, 'transform')
@@ -520,6 +587,7 @@ def wbia_plugin_curvrank_refinement_depc(
         height=height,
         scale=scale,
         greyscale=greyscale,
+        refinement_compact=refinement_compact,
     )
     refined_localizations, refined_masks = values
 
@@ -552,6 +620,13 @@ class SegmentationConfig(dtool.Config):
             ut.ParamInfo('segmentation_gt_smooth', True),
             ut.ParamInfo('segmentation_gt_smooth_margin', 0.001),
             ut.ParamInfo('curvrank_greyscale', False, hideif=False),
+            ut.ParamInfo(
+                'segmentation_batch_size',
+                SEGMENTATION_BATCH_SIZE,
+                hideif=SEGMENTATION_BATCH_SIZE,
+            ),
+            ut.ParamInfo('segmentation_max_bytes', None, hideif=None),
+            ut.ParamInfo('curvrank_storage', 'native', hideif='native'),
             ut.ParamInfo('ext', '.npy', hideif='.npy'),
         ]
 
@@ -568,10 +643,10 @@ class SegmentationConfig(dtool.Config):
         'refined_segmentations_height',
     ],
     coltypes=[
-        ('extern', np.load, np.save),
+        ('extern', ut.partial(load_array, scale=STORAGE_PROBABILITY_SCALE), save_array),
         int,
         int,
-        ('extern', np.load, np.save),
+        ('extern', ut.partial(load_array, scale=STORAGE_PROBABILITY_SCALE), save_array),
         int,
         int,
     ],
@@ -678,6 +753,9 @@ def wbia_plugin_curvrank_segmentation_depc(
     gt_smooth = config['segmentation_gt_smooth']
     gt_smooth_margin = config['segmentation_gt_smooth_margin']
     greyscale = config['curvrank_greyscale']
+    batch_size = config['segmentation_batch_size']
+    max_bytes = config['segmentation_max_bytes']
+    storage = config['curvrank_storage']
 
     aid_list = depc.get_ancestor_rowids('refinement', refinement_rowid_list)
     refined_localizations = depc.get_native(
@@ -703,6 +781,8 @@ def wbia_plugin_curvrank_segmentation_depc(
         groundtruth_smooth=gt_smooth,
         groundtruth_smooth_margin=gt_smooth_margin,
         greyscale=greyscale,
+        batch_size=batch_size,
+        max_bytes=max_bytes,
     )
     segmentations, refined_segmentations = values
 
@@ -720,10 +800,10 @@ def wbia_plugin_curvrank_segmentation_depc(
             ) = refined_segmentation.shape[:2]
 
         yield (
-            segmentation,
+            encode_array(segmentation, storage, STORAGE_PROBABILITY_SCALE),
             segmentation_width,
             segmentation_height,
-            refined_segmentation,
+            encode_array(refined_segmentation, storage, STORAGE_PROBABILITY_SCALE),
             refined_segmentation_width,
             refined_segmentation_height,
         )
@@ -1297,7 +1377,19 @@ class CurvatuveDescriptorOptimizedConfig(dtool.Config):
             ut.ParamInfo('curvature_descriptor_num_keypoints', 32),
             ut.ParamInfo('curvature_descriptor_uniform', False),
             ut.ParamInfo('curvature_descriptor_feat_dim', 32),
+            ut.ParamInfo('curvrank_refinement_compact', False, hideif=False),
+            # does not change the descriptors either, only the peak memory
+            ut.ParamInfo(
+                'curvrank_max_in_flight',
+                PIPELINE_MAX_IN_FLIGHT,
+                hideif=PIPELINE_MAX_IN_FLIGHT,
+            ),
         ]
+        # the executors do not change the descriptors, hide them from the cfgstr
+        for stage in sorted(STAGE_EXECUTORS):
+            backend = STAGE_EXECUTORS[stage]
+            key = 'curvrank_executor_%s' % (stage,)
+            param_list.append(ut.ParamInfo(key, backend, hideif=backend))
 
         return param_list
 
@@ -1371,8 +1463,12 @@ def wbia_plugin_curvrank_curvature_descriptors_optimized_depc(
     """
     ibs = depc.controller
 
+    max_in_flight = config['curvrank_max_in_flight']
+
     config_ = _convert_depc_config_to_kwargs_config(config)
-    values = ibs.wbia_plugin_curvrank_pipeline_compute(aid_list, config_)
+    values = ibs.wbia_plugin_curvrank_pipeline_compute(
+        aid_list, config_, max_in_flight=max_in_flight
+    )
     success_list, curvature_descriptor_dicts = values
 
     for success, curvature_descriptor_dict in zip(
@@ -38,6 +38,15 @@ def build_scale_matrix(s):
     return S
 
 
+def build_flip_matrix(width):
+    # mirrors x, maps the points of a horizontally flipped image to the original
+    F = np.array(
+        [[-1.0, 0.0, width - 1.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]], dtype=np.float32
+    )
+
+    return F
+
+
 def multiply_matrices(L):
     I = np.eye(3)
     for A in L:
@@ -1,6 +1,8 @@
 #include <queue>
+#include <vector>
 #include <limits>
 #include <cmath>
+#include <utility>
 
 // represents a single pixel
 class Node {
@@ -33,30 +35,47 @@ float l1_norm(int i0, int j0, int i1, int j1) {
   return std::abs(i0 - i1) + std::abs(j0 - j1);
 }
 
-// weights:        flattened h x w grid of costs
-// h, w:           height and width of grid
-// start, goal:    index of start/goal in flattened grid
-// diag_ok:        if true, allows diagonal moves (8-conn.)
-// paths (output): for each node, stores previous node in path
-extern "C" bool astar(
+// weights:         flattened h x w grid of costs
+// h, w:            height and width of grid
+// start, goal:     index of start/goal in flattened grid
+// diag_ok:         if true, allows diagonal moves (8-conn.)
+// costs (buffer):  h x w, cost so far of each node
+// paths (output):  h x w, for each node, stores previous node in path
+// closed (buffer): h x w, set once a node has been expanded
+// expanded (output): number of nodes expanded
+//
+// The queue does not support decrease-key, so a node whose cost improves is
+// pushed again and the outdated entries are skipped when they are popped
+// (lazy deletion).  Skipping them only avoids expansions that could not
+// improve any neighbour, so the search visits nodes in exactly the same order
+// as without the closed set.
+bool astar_search(
       const float* weights, const int h, const int w,
       const int start, const int goal, bool diag_ok,
-      int* paths) {
+      float* costs, int* paths, unsigned char* closed,
+      long* expanded) {
 
   const float INF = std::numeric_limits<float>::infinity();
 
-  Node start_node(start, 0.);
   Node goal_node(goal, 0.);
 
-  float* costs = new float[h * w];
-  for (int i = 0; i < h * w; ++i)
+  for (int i = 0; i < h * w; ++i) {
     costs[i] = INF;
+    closed[i] = 0;
+  }
   costs[start] = 0.;
+  *expanded = 0;
 
-  std::priority_queue<Node> nodes_to_visit;
-  nodes_to_visit.push(start_node);
+  // reserve some room up front to avoid reallocating while the frontier grows
+  std::vector<Node> container;
+  container.reserve(4 * (h + w));
+  std::priority_queue<Node> nodes_to_visit(std::less<Node>(), std::move(container));
+  nodes_to_visit.push(Node(start, 0.));
 
-  int* nbrs = new int[8];
+  int nbrs[8];
+
+  const int goal_row = goal / w;
+  const int goal_col = goal % w;
 
   bool solution_found = false;
   while (!nodes_to_visit.empty()) {
@@ -70,6 +89,12 @@ extern "C" bool astar(
 
     nodes_to_visit.pop();
 
+    // an outdated entry of a node that has already been expanded
+    if (closed[cur.idx])
+      continue;
+    closed[cur.idx] = 1;
+    ++(*expanded);
+
     int row = cur.idx / w;
     int col = cur.idx % w;
     // check bounds and find up to eight neighbors: top to bottom, left to right
@@ -91,17 +116,19 @@ extern "C" bool astar(
           // estimate the cost to the goal based on legal moves
           if (diag_ok) {
             heuristic_cost = linf_norm(nbrs[i] / w, nbrs[i] % w,
-                                       goal    / w, goal    % w);
+                                       goal_row,    goal_col);
           }
           else {
             heuristic_cost = l1_norm(nbrs[i] / w, nbrs[i] % w,
-                                     goal    / w, goal    % w);
+                                     goal_row,    goal_col);
           }
 
           // paths with lower expected cost are explored first
           float priority = new_cost + heuristic_cost;
           nodes_to_visit.push(Node(nbrs[i], priority));
 
+          // a cheaper path to a node reopens it
+          closed[nbrs[i]] = 0;
           costs[nbrs[i]] = new_cost;
           paths[nbrs[i]] = cur.idx;
         }
@@ -109,8 +136,61 @@ extern "C" bool astar(
     }
   }
 
-  delete[] costs;
-  delete[] nbrs;
-
   return solution_found;
 }
+
+// weights:         flattened h x w grid of costs
+// h, w:            height and width of grid
+// start, goal:     index of start/goal in flattened grid
+// diag_ok:         if true, allows diagonal moves (8-conn.)
+// paths (output):  for each node, stores previous node in path
+extern "C" bool astar(
+      const float* weights, const int h, const int w,
+      const int start, const int goal, bool diag_ok,
+      int* paths) {
+
+  std::vector<float> costs(h * w);
+  std::vector<unsigned char> closed(h * w);
+  long expanded;
+
+  return astar_search(weights, h, w, start, goal, diag_ok,
+                      costs.data(), paths, closed.data(), &expanded);
+}
+
+// weights:          flattened h x w grid of costs
+// h, w:             height and width of grid
+// start, goal:      index of start/goal in flattened grid
+// diag_ok:          if true, allows diagonal moves (8-conn.)
+// costs (buffer):   h x w floats, overwritten
+// paths (buffer):   h x w ints, overwritten
+// closed (buffer):  h x w bytes, overwritten
+// path (output):    up to h x w (i, j) pairs, the path from start to goal
+// expanded (output): number of nodes expanded
+// returns:          number of points in the path, 0 if there is no path
+extern "C" int astar_path(
+      const float* weights, const int h, const int w,
+      const int start, const int goal, bool diag_ok,
+      float* costs, int* paths, unsigned char* closed,
+      int* path, long* expanded) {
+
+  bool solution_found = astar_search(weights, h, w, start, goal, diag_ok,
+                                     costs, paths, closed, expanded);
+  if (!solution_found || start == goal)
+    return 0;
+
+  // walk back from the goal once to find the length of the path, and again to
+  // write it out from the start
+  int length = 1;
+  for (int idx = goal; idx != start; idx = paths[idx])
+    ++length;
+
+  int k = length - 1;
+  for (int idx = goal; k >= 0; idx = paths[idx], --k) {
+    path[2 * k] = idx / w;
+    path[2 * k + 1] = idx % w;
+    if (idx == start)
+      break;
+  }
+
+  return length;
+}
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+r"""
+Micro-benchmarks for the CPU stages of the CurvRank pipeline
+
+The suite runs on synthetic masks, segmentations, trailing edges, curvatures
+and descriptor sets, so it needs neither a WBIA database nor the networks.
+Every kernel is timed with warm-up calls and repeats, and the results are
+written as JSON so that two revisions can be compared.
+
+CommandLine:
+    python -m wbia_curvrank.benchmarks
+    python -m wbia_curvrank.benchmarks trailing_edges.pkl
+    python -m wbia_curvrank.benchmarks suite --sizes small medium --output before.json
+    python -m wbia_curvrank.benchmarks compare before.json after.json
+"""
+from __future__ import absolute_import, division, print_function
+from wbia_curvrank import costs, dorsal_utils, pyastar
+import wbia_curvrank.functional as F
+import numpy as np
+import argparse
+import platform
+import tempfile
+import pickle
+import shutil
+import json
+import time
+import cv2
+import sys
+from os.path import join
+
+
+BENCHMARK_SEED = 0
+BENCHMARK_WARMUP = 1
+BENCHMARK_REPEATS = 5
+BENCHMARK_SCALES = np.array([0.04, 0.06, 0.08, 0.10], dtype=np.float32)
+# the refined localizations are the network input upsampled by curvrank_scale
+BENCHMARK_SIZES = {
+    'small': {
+        'height': 256,
+        'width': 256,
+        'num_points': 300,
+        'curv_length': 256,
+        'num_queries': 2,
+        'num_database': 64,
+        'num_names': 16,
+        'descriptors_per_annot': 40,
+        'num_annots': 100,
+    },
+    'medium': {
+        'height': 512,
+        'width': 512,
+        'num_points': 800,
+        'curv_length': 1024,
+        'num_queries': 4,
+        'num_database': 256,
+        'num_names': 64,
+        'descriptors_per_annot': 60,
+        'num_annots': 1000,
+    },
+    'large': {
+        'height': 1024,
+        'width': 1024,
+        'num_points': 2000,
+        'curv_length': 1024,
+        'num_queries': 8,
+        'num_database': 1024,
+        'num_names': 256,
+        'descriptors_per_annot': 80,
+        'num_annots': 4000,
+    },
+}
+
+
+def load_trailing_edges(config=None, aid_list=None):
+    import wbia
+    from wbia.init import sysres
+    from wbia_curvrank._plugin_depc import DEFAULT_DORSAL_TEST_CONFIG
+
+    if config is None:
+        config = DEFAULT_DORSAL_TEST_CONFIG
+
+    dbdir = sysres.ensure_testdb_curvrank()
+    ibs = wbia.opendb(dbdir=dbdir)
+    if aid_list is None:
+        aid_list = ibs.get_valid_aids()
+
+    success_list = ibs.depc_annot.get('trailing_edge', aid_list, 'success', config=config)
+    trailing_edges = ibs.depc_annot.get(
+        'trailing_edge', aid_list, 'trailing_edge', config=config
+    )
+    trailing_edges = [
+        trailing_edge
+        for success, trailing_edge in zip(success_list, trailing_edges)
+        if success
+    ]
+    return trailing_edges
+
+
+def _best_time(func, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.time()
+        result = func()
+        durations.append(time.time() - start)
+    return min(durations), result
+
+
+def benchmark_oriented_curvature(
+    trailing_edges, scales=None, transpose_dims=False, repeats=3
+):
+    r"""
+    Time dorsal_utils.oriented_curvature against the per-point reference loop
+
+    The contours and radii are prepared the same way as in
+    functional.compute_curvature.
+
+    Returns:
+        results (dict): total seconds for both implementations, the speed-up and
+            the largest absolute difference between the curvature matrices
+    """
+    if scales is None:
+        scales = BENCHMARK_SCALES
+
+    results = {
+        'num_contours': len(trailing_edges),
+        'num_points': 0,
+        'reference_seconds': 0.0,
+        'vectorized_seconds': 0.0,
+        'max_abs_diff': 0.0,
+    }
+    for trailing_edge in trailing_edges:
+        contour = trailing_edge[::-1] if transpose_dims else trailing_edge[:, ::-1]
+        radii = scales * (contour[:, 1].max() - contour[:, 1].min())
+
+        duration, curv_ = _best_time(
+            lambda: dorsal_utils.oriented_curvature_reference(contour, radii), repeats
+        )
+        results['reference_seconds'] += duration
+        duration, curv = _best_time(
+            lambda: dorsal_utils.oriented_curvature(contour, radii), repeats
+        )
+        results['vectorized_seconds'] += duration
+
+        results['num_points'] += contour.shape[0]
+        max_abs_diff = float(np.abs(curv - curv_).max())
+        results['max_abs_diff'] = max(results['max_abs_diff'], max_abs_diff)
+
+    results['speedup'] = results['reference_seconds'] / max(
+        results['vectorized_seconds'], 1e-9
+    )
+    return results
+
+
+def time_kernel(func, warmup=BENCHMARK_WARMUP, repeats=BENCHMARK_REPEATS):
+    r"""
+    Returns:
+        timings (dict): min, median, mean and standard deviation in seconds of
+            ``repeats`` calls of func, after ``warmup`` untimed calls
+    """
+    for _ in range(warmup):
+        func()
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    durations = np.array(durations)
+    timings = {
+        'min': float(durations.min()),
+        'median': float(np.median(durations)),
+        'mean': float(durations.mean()),
+        'std': float(durations.std()),
+        'repeats': repeats,
+        'warmup': warmup,
+    }
+    return timings
+
+
+def synthetic_trailing_edge(num_points, height, width, rng):
+    r"""
+    Smooth (num_points, 2) ij contour running down the image, like a trailing edge
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.benchmarks import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> contour = synthetic_trailing_edge(100, 256, 128, rng)
+        >>> assert contour.shape == (100, 2) and contour.dtype == np.float32
+        >>> assert contour[:, 0].min() >= 0 and contour[:, 1].max() < 128
+    """
+    t = np.linspace(0.0, 1.0, num_points)
+    phases = rng.uniform(0.0, 2.0 * np.pi, size=3)
+    amplitudes = rng.uniform(0.02, 0.08, size=3)
+    offset = sum(
+        amplitude * np.sin((idx + 1) * np.pi * t + phase)
+        for idx, (amplitude, phase) in enumerate(zip(amplitudes, phases))
+    )
+    i = 0.1 * height + 0.8 * height * t
+    j = width * (0.3 + 0.4 * t ** 2 + offset)
+    contour = np.vstack((i, np.clip(j, 0, width - 1))).T
+    return contour.astype(np.float32)
+
+
+def synthetic_fin(height, width, num_points, rng):
+    r"""
+    Synthetic refined localization of a fin whose outline is a trailing edge
+
+    Returns:
+        img (np.ndarray): (height, width, 3) uint8 image, bright fin on noise
+        mask (np.ndarray): (height, width) uint8 mask of the valid pixels
+        segm (np.ndarray): (height, width) float32 blurred outline probability
+        start (tuple): ij of the first point of the outline
+        end (tuple): ij of the last point of the outline
+    """
+    contour = synthetic_trailing_edge(num_points, height, width, rng)
+    points = np.round(contour[:, ::-1]).astype(np.int32)  # ij -> xy
+
+    img = rng.randint(0, 64, size=(height, width, 3)).astype(np.uint8)
+    polygon = np.vstack((points, [[0, height - 1], [0, 0]]))
+    cv2.fillPoly(img, [polygon], (200, 200, 200))
+    img = cv2.GaussianBlur(img, (5, 5), 0)
+
+    mask = np.full((height, width), 255, dtype=np.uint8)
+
+    segm = np.zeros((height, width), dtype=np.float32)
+    cv2.polylines(segm, [points], False, 1.0, thickness=3)
+    segm = cv2.GaussianBlur(segm, (0, 0), max(1.0, 0.01 * height))
+    segm /= segm.max()
+
+    start = tuple(int(x) for x in np.round(contour[0]))
+    end = tuple(int(x) for x in np.round(contour[-1]))
+    return img, mask, segm, start, end
+
+
+def synthetic_curvatures(num, curv_length, num_scales, rng):
+    r"""
+    Smooth (num, curv_length, num_scales) float32 curvatures in [0, 1]
+    """
+    noise = rng.randn(num, curv_length, num_scales).astype(np.float32)
+    smoothed = np.cumsum(noise, axis=1)
+    smoothed -= smoothed.min(axis=1, keepdims=True)
+    smoothed /= np.maximum(smoothed.max(axis=1, keepdims=True), 1e-6)
+    return 0.25 + 0.5 * smoothed
+
+
+def synthetic_descriptors(num_annots, descriptors_per_annot, feat_dim, num_names, rng):
+    r"""
+    Returns:
+        descriptors (np.ndarray): unit-norm float32 rows, annotation by annotation
+        names (list): name of the annotation of every row
+    """
+    num = num_annots * descriptors_per_annot
+    descriptors = rng.randn(num, feat_dim).astype(np.float32)
+    descriptors /= np.linalg.norm(descriptors, axis=1, keepdims=True)
+    annot_names = rng.randint(0, num_names, size=num_annots)
+    names = np.repeat(annot_names, descriptors_per_annot).tolist()
+    return descriptors, names
+
+
+def _setup_astar_path(params, rng):
+    img, mask, segm, start, end = synthetic_fin(
+        params['height'], params['width'], params['num_points'], rng
+    )
+    weights = dorsal_utils.dorsal_cost_func(np.full_like(segm, 0.5), segm)
+    weights = np.ascontiguousarray(weights, dtype=np.float32)
+    return lambda: pyastar.astar_path(weights, start, end, allow_diagonal=False)
+
+
+def _setup_extract_outline(params, rng):
+    img, mask, segm, start, end = synthetic_fin(
+        params['height'], params['width'], params['num_points'], rng
+    )
+    return lambda: dorsal_utils.extract_outline(
+        img, mask, segm, dorsal_utils.dorsal_cost_func, start, end, False
+    )
+
+
+def _setup_oriented_curvature(params, rng):
+    contour = synthetic_trailing_edge(
+        params['num_points'], params['height'], params['width'], rng
+    )
+    # trailing edges are A* paths, so integer pixel coordinates
+    contour = np.round(contour).astype(np.intp)
+    return lambda: F.compute_curvature(contour, BENCHMARK_SCALES, False)
+
+
+def _setup_curvature_descriptors(params, rng):
+    (curv,) = synthetic_curvatures(1, params['num_points'], len(BENCHMARK_SCALES), rng)
+    return lambda: F.compute_curvature_descriptors(
+        curv, params['curv_length'], BENCHMARK_SCALES, 32, False, 32
+    )
+
+
+def _setup_dtw_pairwise(params, rng):
+    qcurv, dcurv = synthetic_curvatures(
+        2, params['curv_length'], len(BENCHMARK_SCALES), rng
+    )
+    simfunc = costs.get_cost_func(
+        'dtw-l2', weights=np.ones((params['curv_length'], 1), dtype=np.float32), window=8
+    )
+    return lambda: simfunc(qcurv, dcurv)
+
+
+def _setup_dtw_batch(params, rng):
+    curvs = synthetic_curvatures(
+        params['num_queries'] + params['num_database'],
+        params['curv_length'],
+        len(BENCHMARK_SCALES),
+        rng,
+    )
+    qcurvs, dcurvs = curvs[: params['num_queries']], curvs[params['num_queries'] :]
+    batch_simfunc = costs.get_batch_cost_func(
+        'dtw-l2', weights=np.ones((params['curv_length'], 1), dtype=np.float32), window=8
+    )
+    return lambda: batch_simfunc(qcurvs, dcurvs)
+
+
+def _setup_lnbnn_identify(params, rng, dpath):
+    data, names = synthetic_descriptors(
+        params['num_annots'],
+        params['descriptors_per_annot'],
+        32,
+        params['num_names'],
+        rng,
+    )
+    query, _ = synthetic_descriptors(1, params['descriptors_per_annot'], 32, 1, rng)
+    # loaded indices are cached by path, so every size gets its own file
+    index_fpath = join(dpath, 'lnbnn_%d.ann' % (len(data),))
+    F.build_lnbnn_index(data, index_fpath, num_trees=10)
+    name_index = F.lnbnn_name_index(names)
+    return lambda: F.lnbnn_identify(
+        index_fpath, 2, query, names, search_k=40, name_index=name_index
+    )
+
+
+BENCHMARK_KERNELS = {
+    'astar_path': _setup_astar_path,
+    'extract_outline': _setup_extract_outline,
+    'oriented_curvature': _setup_oriented_curvature,
+    'curvature_descriptors': _setup_curvature_descriptors,
+    'dtw_pairwise': _setup_dtw_pairwise,
+    'dtw_batch': _setup_dtw_batch,
+    'lnbnn_identify': _setup_lnbnn_identify,
+}
+
+
+def benchmark_metadata(seed):
+    metadata = {
+        'timestamp': time.time(),
+        'seed': seed,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+    }
+    return metadata
+
+
+def run_suite(
+    sizes=None,
+    kernels=None,
+    warmup=BENCHMARK_WARMUP,
+    repeats=BENCHMARK_REPEATS,
+    seed=BENCHMARK_SEED,
+    verbose=True,
+):
+    r"""
+    Time every kernel on the synthetic inputs of every size
+
+    The inputs of a (kernel, size) pair only depend on the seed, so two runs
+    with the same seed time the same work.
+
+    Returns:
+        suite (dict): {'metadata': ..., 'results': [...]} with one result per
+            (kernel, size), see time_kernel
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.benchmarks import *  # NOQA
+        >>> suite = run_suite(['small'], warmup=0, repeats=1, verbose=False)
+        >>> result = sorted(result['kernel'] for result in suite['results'])
+        >>> print(result)
+        ['astar_path', 'curvature_descriptors', 'dtw_batch', 'dtw_pairwise', 'extract_outline', 'lnbnn_identify', 'oriented_curvature']
+    """
+    if sizes is None:
+        sizes = ['small', 'medium', 'large']
+    if kernels is None:
+        kernels = sorted(BENCHMARK_KERNELS.keys())
+
+    results = []
+    dpath = tempfile.mkdtemp(prefix='curvrank-benchmarks-')
+    try:
+        for size in sizes:
+            params = BENCHMARK_SIZES[size]
+            for kernel in kernels:
+                rng = np.random.RandomState(seed)
+                setup = BENCHMARK_KERNELS[kernel]
+                if kernel == 'lnbnn_identify':
+                    func = setup(params, rng, dpath)
+                else:
+                    func = setup(params, rng)
+                result = {'kernel': kernel, 'size': size, 'params': params}
+                result.update(time_kernel(func, warmup=warmup, repeats=repeats))
+                results.append(result)
+                if verbose:
+                    print(
+                        '%-22s %-6s median %10.3f ms  min %10.3f ms'
+                        % (kernel, size, 1e3 * result['median'], 1e3 * result['min'])
+                    )
+    finally:
+        shutil.rmtree(dpath, ignore_errors=True)
+
+    suite = {'metadata': benchmark_metadata(seed), 'results': results}
+    return suite
+
+
+def compare_suites(baseline, current, threshold=0.1):
+    r"""
+    Ratio of the median times of the (kernel, size) pairs in both suites
+
+    Returns:
+        comparisons (list): (kernel, size, baseline median, current median,
+            ratio, flag) with flag 'slower' or 'faster' when the ratio is
+            outside 1 +- threshold
+    """
+    baseline_medians = {
+        (result['kernel'], result['size']): result['median']
+        for result in baseline['results']
+    }
+    comparisons = []
+    for result in current['results']:
+        key = (result['kernel'], result['size'])
+        if key not in baseline_medians:
+            continue
+        before, after = baseline_medians[key], result['median']
+        ratio = after / max(before, 1e-12)
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = 'slower'
+        elif ratio < 1.0 - threshold:
+            flag = 'faster'
+        comparisons.append(key + (before, after, ratio, flag))
+    return comparisons
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m wbia_curvrank.benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+
+    suite_parser = subparsers.add_parser('suite', help='time the synthetic kernels')
+    suite_parser.add_argument(
+        '--sizes', nargs='+', default=None, choices=sorted(BENCHMARK_SIZES.keys())
+    )
+    suite_parser.add_argument(
+        '--kernels', nargs='+', default=None, choices=sorted(BENCHMARK_KERNELS.keys())
+    )
+    suite_parser.add_argument('--warmup', type=int, default=BENCHMARK_WARMUP)
+    suite_parser.add_argument('--repeats', type=int, default=BENCHMARK_REPEATS)
+    suite_parser.add_argument('--seed', type=int, default=BENCHMARK_SEED)
+    suite_parser.add_argument('--output', default=None, help='JSON results file')
+
+    compare_parser = subparsers.add_parser('compare', help='compare two JSON results')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'suite':
+        suite = run_suite(
+            sizes=args.sizes,
+            kernels=args.kernels,
+            warmup=args.warmup,
+            repeats=args.repeats,
+            seed=args.seed,
+        )
+        if args.output is None:
+            print(json.dumps(suite, indent=2))
+        else:
+            with open(args.output, 'w') as f:
+                json.dump(suite, f, indent=2)
+    elif args.command == 'compare':
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        with open(args.current, 'r') as f:
+            current = json.load(f)
+        comparisons = compare_suites(baseline, current, threshold=args.threshold)
+        for kernel, size, before, after, ratio, flag in comparisons:
+            print(
+                '%-22s %-6s %10.3f ms -> %10.3f ms  x%.2f %s'
+                % (kernel, size, 1e3 * before, 1e3 * after, ratio, flag)
+            )
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ['suite', 'compare']:
+        main(sys.argv[1:])
+    else:
+        if len(sys.argv) > 1:
+            with open(sys.argv[1], 'rb') as f:
+                trailing_edges = pickle.load(f)
+        else:
+            trailing_edges = load_trailing_edges()
+
+        results = benchmark_oriented_curvature(trailing_edges)
+        for key in sorted(results.keys()):
+            print('%s: %r' % (key, results[key]))
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 import numpy as np
+import threading
 from functools import partial
+from scipy.interpolate import BPoly
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
 
 from wbia_curvrank.pydtw import dtw_weighted_euclidean
 from wbia_curvrank.pydtw import dtw_weighted_chi_square
+from wbia_curvrank.pydtw import dtw_weighted_euclidean_batch
+from wbia_curvrank.pydtw import dtw_weighted_chi_square_batch
 
 
 def get_cost_func_dict():
@@ -23,6 +28,39 @@ def get_cost_func(name, **kwargs):
     return cost_func_dict[name](**kwargs)
 
 
+def get_batch_cost_func_dict():
+    # cost funcs with their own one-vs-many implementation
+    return {
+        'dtw-l2': get_dtw_l2_batch,
+        'dtw-chi2': get_dtw_chi2_batch,
+        'norm-l2': get_norm_l2_batch,
+        'hist': get_hist_batch,
+    }
+
+
+def get_batch_cost_func(name, **kwargs):
+    # batch cost funcs compare (m, n) or (Q, m, n) query curvs with (N, m, n)
+    # database curvs and return (N,) or (Q, N) costs
+    batch_cost_func_dict = get_batch_cost_func_dict()
+    if name in batch_cost_func_dict:
+        return batch_cost_func_dict[name](**kwargs)
+
+    kwargs.pop('num_threads', None)
+    cost_func = get_cost_func(name, **kwargs)
+    return partial(pairwise_batch_cost, cost_func=cost_func)
+
+
+def pairwise_batch_cost(qcurvs, dcurvs, cost_func):
+    costs = np.array(
+        [
+            [cost_func(qcurv, dcurv) for dcurv in dcurvs]
+            for qcurv in qcurvs.reshape((-1,) + dcurvs.shape[1:])
+        ],
+        dtype=np.float32,
+    )
+    return costs[0] if qcurvs.ndim == 2 else costs
+
+
 def get_dtw_l2(**kwargs):
     cost_func = partial(dtw_weighted_euclidean, **kwargs)
     return cost_func
@@ -33,6 +71,16 @@ def get_dtw_chi2(**kwargs):
     return cost_func
 
 
+def get_dtw_l2_batch(**kwargs):
+    cost_func = partial(dtw_weighted_euclidean_batch, **kwargs)
+    return cost_func
+
+
+def get_dtw_chi2_batch(**kwargs):
+    cost_func = partial(dtw_weighted_chi_square_batch, **kwargs)
+    return cost_func
+
+
 def get_norm_l2(**kwargs):
     weights = kwargs.get('weights')
     cost_func = partial(norm_l2, weights=weights)
@@ -49,32 +97,478 @@ def norm_l2(qcurv, dcurv, weights):
     return np.sqrt(np.sum(weights * (qcurv - dcurv) ** 2))
 
 
+def get_norm_l2_batch(**kwargs):
+    weights = kwargs.get('weights')
+    cost_func = NormL2Batch(weights)
+    return cost_func
+
+
+class NormL2Batch(object):
+    r"""
+    Batch norm_l2, see get_batch_cost_func
+
+    The curvatures are scaled by the square root of the weights and flattened,
+    so that the distances to all database curvatures follow from one matrix
+    product through ||a||^2 + ||b||^2 - 2ab.  The features and their product
+    are float32, so every worker keeps a database copy of the size of its
+    float32 curvatures, and the squared norms are accumulated in float64.  The
+    features are centered on the database mean, which the distances do not
+    depend on, to limit the cancellation of the float32 product.  Each cost
+    agrees with norm_l2 to within 1e-3 of the larger norm of the two centered
+    features, so the costs of near duplicates can be far off relatively.  The
+    database features can be computed once with database_features and passed
+    in, see batch_database_features.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.costs import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> weights = rng.rand(64, 1).astype(np.float32)
+        >>> dcurvs = rng.rand(50, 64, 2).astype(np.float32)
+        >>> noise = 1e-4 * rng.randn(2, 64, 2).astype(np.float32)
+        >>> qcurvs = np.vstack((rng.rand(3, 64, 2), dcurvs[:2] + noise)).astype(np.float32)
+        >>> func = NormL2Batch(weights)
+        >>> dfeatures = func.database_features(dcurvs)
+        >>> costs = func(qcurvs, dcurvs, database_features=dfeatures)
+        >>> costs_ = np.array([[norm_l2(q, d, weights) for d in dcurvs] for q in qcurvs])
+        >>> _, qnorms, _ = func.features(qcurvs, dfeatures[2])
+        >>> bound = 1e-3 * np.sqrt(np.maximum(qnorms[:, None], dfeatures[1][None, :]))
+        >>> assert np.all(np.abs(costs - costs_) <= bound)
+        >>> assert np.all(func(qcurvs, dcurvs) == costs)
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def features(self, curvs, center=None):
+        curvs = np.asarray(curvs, dtype=np.float32)
+        scale = np.ones(curvs.shape[-2:], dtype=np.float32)
+        if self.weights is not None:
+            scale = np.sqrt(np.broadcast_to(self.weights, curvs.shape[-2:]))
+            scale = scale.astype(np.float32)
+        feats = (curvs * scale).reshape(curvs.shape[0], -1)
+        if center is None:
+            center = feats.mean(axis=0, dtype=np.float64).astype(np.float32)
+        feats -= center
+        return feats, np.einsum('ij,ij->i', feats, feats, dtype=np.float64), center
+
+    def database_features(self, dcurvs):
+        return self.features(dcurvs)
+
+    def __call__(self, qcurvs, dcurvs, database_features=None, **kwargs):
+        if database_features is None:
+            database_features = self.database_features(dcurvs)
+        dfeats, dnorms, dcenter = database_features
+        qfeats, qnorms, _ = self.features(
+            qcurvs.reshape((-1,) + dcurvs.shape[1:]), dcenter
+        )
+        dists = qnorms[:, None] + dnorms[None, :] - 2.0 * np.dot(qfeats, dfeats.T)
+        costs = np.sqrt(np.maximum(dists, 0.0)).astype(np.float32)
+        return costs[0] if qcurvs.ndim == 2 else costs
+
+
 def random_cost(qcurv, dcurv):
     return np.random.random()
 
 
+HIST_NUM_BINS = 10
+
+
 def get_hist(**kwargs):
     cost_func = hist_intersect
     return cost_func
 
 
+def get_hist_batch(**kwargs):
+    cost_func = HistIntersectBatch()
+    return cost_func
+
+
+def hist_features(curvs, num_bins=HIST_NUM_BINS):
+    r"""
+    Normalized histograms of every scale of (m, n) or (N, m, n) curvatures on
+    num_bins equal bins of [0, 1], flattened to (n * num_bins,) or
+    (N, n * num_bins) float32 features
+
+    The histograms are computed like np.histogram(density=True) followed by
+    normalizing to a unit sum, so that the features match those hist_intersect
+    used to compute for each pair.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.costs import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> curv = rng.rand(64, 2).astype(np.float32)
+        >>> feat = hist_features(curv)
+        >>> hist, _ = np.histogram(curv[:, 1], bins=np.linspace(0, 1, 11), density=True)
+        >>> hist = hist.astype(np.float32)
+        >>> assert np.all(feat[10:] == hist / hist.sum())
+    """
+    curvs = np.asarray(curvs)
+    bins = np.linspace(0, 1, 1 + num_bins)
+    # (..., n, m) so that each histogram is over a contiguous last axis
+    values = np.swapaxes(curvs, -1, -2)
+    # bin k holds bins[k] <= x < bins[k + 1], the last bin also holds x == 1
+    index = np.searchsorted(bins, values, side='right') - 1
+    index[values == bins[-1]] = num_bins - 1
+    valid = (index >= 0) & (index < num_bins)
+
+    num_hists = int(np.prod(values.shape[:-1]))
+    offsets = np.arange(num_hists).reshape(values.shape[:-1] + (1,)) * num_bins
+    counts = np.bincount(
+        (index + offsets)[valid], minlength=num_hists * num_bins
+    ).reshape(values.shape[:-1] + (num_bins,))
+
+    density = counts / np.diff(bins) / counts.sum(axis=-1, keepdims=True)
+    hists = density.astype(np.float32)
+    hists /= hists.sum(axis=-1, keepdims=True)
+
+    return hists.reshape(curvs.shape[:-2] + (-1,))
+
+
 def hist_intersect(qcurv, dcurv):
-    num_bins = 10
-    qhist = np.zeros((qcurv.shape[1], num_bins), dtype=np.float32)
-    dhist = np.zeros((dcurv.shape[1], num_bins), dtype=np.float32)
+    qfeat = hist_features(qcurv)
+    dfeat = hist_features(dcurv)
 
-    for j in range(qcurv.shape[1]):
-        qhist[j], _ = np.histogram(
-            qcurv[:, j], bins=np.linspace(0, 1, 1 + num_bins), density=True
-        )
-        dhist[j], _ = np.histogram(
-            dcurv[:, j], bins=np.linspace(0, 1, 1 + num_bins), density=True
+    return -1.0 * np.sum(np.minimum(qfeat, dfeat))
+
+
+class HistIntersectBatch(object):
+    r"""
+    Batch histogram intersection, see get_batch_cost_func
+
+    Comparing many queries with the same (N, m, n) database computes its
+    histograms only once when database_features is passed in, see
+    batch_database_features.
+    """
+
+    def database_features(self, dcurvs):
+        return hist_features(dcurvs)
+
+    def __call__(self, qcurvs, dcurvs, database_features=None, **kwargs):
+        dfeats = database_features
+        if dfeats is None:
+            dfeats = self.database_features(dcurvs)
+        qfeats = hist_features(qcurvs.reshape((-1,) + dcurvs.shape[1:]))
+        costs = np.empty((len(qfeats), len(dfeats)), dtype=np.float32)
+        for i, qfeat in enumerate(qfeats):
+            costs[i] = -1.0 * np.minimum(qfeat, dfeats).sum(axis=1)
+        return costs[0] if qcurvs.ndim == 2 else costs
+
+
+def batch_database_features(batch_func, dcurvs):
+    r"""
+    Features of the (N, m, n) database curvatures that batch_func can be given
+    as database_features to compare queries with the same dcurvs, or None if it
+    has nothing to precompute
+
+    The features are not tied to dcurvs, they have to be recomputed when the
+    database changes.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.costs import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> qcurvs = rng.rand(3, 32, 2).astype(np.float32)
+        >>> dcurvs = rng.rand(20, 32, 2).astype(np.float32)
+        >>> func = CostFuncHandle('batch', 'hist', 'crc', 32, False)
+        >>> dfeatures = batch_database_features(func, dcurvs)
+        >>> costs = func(qcurvs, dcurvs, database_features=dfeatures)
+        >>> assert np.all(costs == func(qcurvs, dcurvs))
+        >>> dcurvs[:] = 0.5
+        >>> assert not np.all(func(qcurvs, dcurvs) == costs)
+        >>> assert batch_database_features(get_batch_cost_func('dtw-l2'), dcurvs) is None
+    """
+    if isinstance(batch_func, CostFuncHandle):
+        batch_func = batch_func.resolve()
+    database_features = getattr(batch_func, 'database_features', None)
+    if database_features is None:
+        return None
+    return database_features(dcurvs)
+
+
+def get_lower_bound_func_dict():
+    # cost funcs with a lower bound that can be used to skip alignments
+    return {
+        'dtw-l2': get_lb_dtw_l2,
+        'dtw-chi2': get_lb_dtw_chi2,
+    }
+
+
+def get_lower_bound_func(name, **kwargs):
+    lower_bound_func_dict = get_lower_bound_func_dict()
+    return lower_bound_func_dict[name](**kwargs)
+
+
+def get_lb_dtw_l2(**kwargs):
+    return partial(lb_dtw, chi_square=False, **kwargs)
+
+
+def get_lb_dtw_chi2(**kwargs):
+    return partial(lb_dtw, chi_square=True, **kwargs)
+
+
+def dtw_envelopes(dcurvs, weights, window):
+    r"""
+    Sakoe-Chiba envelopes of (N, m, n) database curvatures, computed once per
+    database for lb_dtw
+
+    Row i of an envelope covers the columns max(1, i - window) <= j < i + window
+    that the DTW kernels in dtw.cpp may align with point i; row 0 never costs
+    anything and is left out.
+    """
+    assert window >= 1, 'window = %d < 1' % (window,)
+    size = 2 * window
+    dcurvs = dcurvs.astype(np.float64)
+    curvs = dcurvs[:, 1:]
+    weights = weights[1:, 0].astype(np.float64)
+    return {
+        'lower': minimum_filter1d(curvs, size, axis=1, mode='nearest'),
+        'upper': maximum_filter1d(curvs, size, axis=1, mode='nearest'),
+        'offset': maximum_filter1d(np.abs(curvs - 0.5), size, axis=1, mode='nearest'),
+        'weights': minimum_filter1d(weights, size, mode='nearest'),
+        'first': dcurvs[:, 1],
+        'last': dcurvs[:, -1],
+    }
+
+
+def _point_costs(x, y, wx, wy, chi_square):
+    d2 = (x - y) ** 2
+    if chi_square:
+        return wx * wy * (d2 / (np.abs(x - 0.5) + np.abs(y - 0.5) + 1e-6)).sum(axis=-1)
+    return wx * wy * np.sqrt(d2.sum(axis=-1))
+
+
+def lb_dtw(qcurvs, envelopes, weights, window=None, chi_square=False, chunksize=2 ** 22):
+    r"""
+    Lower bound of the weighted euclidean or chi-square DTW cost of every
+    query curvature against every database curvature
+
+    Every warping path starts with the cell (1, 1), ends with the cell
+    (m - 1, m - 1) and visits every row in between at least once.  The two end
+    cells are costed exactly (LB_Kim); every other row costs at least the
+    distance of the query point to the box spanned by the database envelope of
+    that row (LB_Keogh), scaled by the smallest weight in the window.
+
+    Args:
+        qcurvs (np.ndarray): (Q, m, n) query curvatures
+        envelopes (dict): dtw_envelopes of the (N, m, n) database curvatures
+
+    Returns:
+        bounds (np.ndarray): (Q, N) lower bounds
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.costs import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> qcurvs = rng.rand(3, 64, 2).astype(np.float32)
+        >>> dcurvs = rng.rand(20, 64, 2).astype(np.float32)
+        >>> weights = rng.rand(64, 1).astype(np.float32)
+        >>> envelopes = dtw_envelopes(dcurvs, weights, 8)
+        >>> for name in ['dtw-l2', 'dtw-chi2']:
+        >>>     lb_func = get_lower_bound_func(name, weights=weights, window=8)
+        >>>     batch_func = get_batch_cost_func(name, weights=weights, window=8)
+        >>>     assert np.all(lb_func(qcurvs, envelopes) <= batch_func(qcurvs, dcurvs))
+    """
+    qcurvs = qcurvs.astype(np.float64)
+    weights = weights[:, 0].astype(np.float64)
+    num_q, m, n = qcurvs.shape
+    num_d = envelopes['first'].shape[0]
+
+    bounds = np.zeros((num_q, num_d), dtype=np.float64)
+    if m < 2:
+        return bounds
+
+    # LB_Kim: the first and the last cell of every path
+    bounds += _point_costs(
+        qcurvs[:, None, 1], envelopes['first'][None], weights[1], weights[1], chi_square
+    )
+    if m > 2:
+        bounds += _point_costs(
+            qcurvs[:, None, -1],
+            envelopes['last'][None],
+            weights[-1],
+            weights[-1],
+            chi_square,
         )
+    if m <= 3:
+        return bounds
 
-        qhist[j] /= qhist[j].sum()
-        dhist[j] /= dhist[j].sum()
+    # LB_Keogh: rows 2 to m - 2, envelope rows are shifted by one
+    x = qcurvs[:, None, 2:-1]
+    row_weights = weights[2:-1] * envelopes['weights'][1:-1]
+    step = max(1, chunksize // max(1, num_q * m * n))
+    for start in range(0, num_d, step):
+        stop = min(num_d, start + step)
+        lower = envelopes['lower'][None, start:stop, 1:-1]
+        upper = envelopes['upper'][None, start:stop, 1:-1]
+        d2 = (np.maximum(x - upper, 0.0) + np.maximum(lower - x, 0.0)) ** 2
+        if chi_square:
+            offset = envelopes['offset'][None, start:stop, 1:-1]
+            row_costs = (d2 / (np.abs(x - 0.5) + offset + 1e-6)).sum(axis=-1)
+        else:
+            row_costs = np.sqrt(d2.sum(axis=-1))
+        bounds[:, start:stop] += (row_weights * row_costs).sum(axis=-1)
 
-    qfeat = qhist.flatten()
-    dfeat = dhist.flatten()
+    return bounds
 
-    return -1.0 * np.sum(np.minimum(qfeat, dfeat))
+
+# coefficients of the Bernstein polynomial that weights the points of a
+# curvature vector, fitted on the SDRP Bottlenose and the CRC Humpback datasets
+SPATIAL_WEIGHTS_COEFFS = {
+    'sdrp': [
+        0.0960,
+        0.6537,
+        1.0000,
+        0.7943,
+        1.0000,
+        0.3584,
+        0.4492,
+        0.0000,
+        0.4157,
+        0.0626,
+    ],
+    'crc': [
+        0.0944,
+        0.5629,
+        0.7286,
+        0.6028,
+        0.0000,
+        0.0434,
+        0.6906,
+        0.7316,
+        0.4671,
+        0.0258,
+    ],
+}
+SPATIAL_WEIGHTS_COEFFS['nz'] = SPATIAL_WEIGHTS_COEFFS['sdrp']
+SPATIAL_WEIGHTS_COEFFS['fb'] = SPATIAL_WEIGHTS_COEFFS['crc']
+
+
+def bernstein_weights(coeffs, length):
+    coeffs = np.array(coeffs).reshape(-1, 1)
+    f = BPoly(coeffs, np.array([0, 1]), extrapolate=False)
+    return f(np.linspace(0, 1, length))
+
+
+class CostFuncRegistry(object):
+    r"""
+    Process-wide cache of spatial weights and the cost functions built on them
+
+    The weights are evaluated once per (dataset, curv_length, spatial_weights)
+    and kept as read-only, contiguous (curv_length, 1) float32 arrays that the
+    DTW kernels can use as they are.  Cost functions are cached on the same key
+    plus their kind ('pairwise', 'batch' or 'lower_bound'), name and keyword
+    arguments.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.costs import *  # NOQA
+        >>> registry = CostFuncRegistry()
+        >>> weights = registry.weights('sdrp', 64, True)
+        >>> assert registry.weights('sdrp', 64, True) is weights
+        >>> func1 = registry.get('pairwise', 'dtw-l2', 'sdrp', 64, True, window=8)
+        >>> func2 = registry.get('pairwise', 'dtw-l2', 'sdrp', 64, True, window=8)
+        >>> result = (weights.shape, weights.dtype.name, func1 is func2)
+        >>> print(result)
+        ((64, 1), 'float32', True)
+    """
+
+    def __init__(self):
+        self._weights = {}
+        self._funcs = {}
+        self._lock = threading.RLock()
+
+    def weights(self, dataset, curv_length, spatial_weights):
+        key = (dataset, int(curv_length), bool(spatial_weights))
+        with self._lock:
+            weights = self._weights.get(key, None)
+            if weights is None:
+                if spatial_weights:
+                    assert (
+                        dataset in SPATIAL_WEIGHTS_COEFFS
+                    ), 'No spatial weights for dataset %r' % (dataset,)
+                    weights = bernstein_weights(
+                        SPATIAL_WEIGHTS_COEFFS[dataset], curv_length
+                    )
+                else:
+                    weights = np.ones(curv_length)
+                weights = np.ascontiguousarray(weights.reshape(-1, 1), dtype=np.float32)
+                # shared by every cost function of this process
+                weights.flags.writeable = False
+                self._weights[key] = weights
+        return weights
+
+    def get(self, kind, name, dataset, curv_length, spatial_weights, **kwargs):
+        key = (kind, name, dataset, int(curv_length), bool(spatial_weights))
+        key += tuple(sorted(kwargs.items()))
+        with self._lock:
+            func = self._funcs.get(key, None)
+            if func is None:
+                weights = self.weights(dataset, curv_length, spatial_weights)
+                if kind == 'pairwise':
+                    func = get_cost_func(name, weights=weights, **kwargs)
+                elif kind == 'batch':
+                    func = get_batch_cost_func(name, weights=weights, **kwargs)
+                elif kind == 'lower_bound':
+                    func = get_lower_bound_func(name, weights=weights, **kwargs)
+                else:
+                    raise ValueError('Unknown cost function kind %r' % (kind,))
+                self._funcs[key] = func
+        return func
+
+    def clear(self):
+        with self._lock:
+            self._weights.clear()
+            self._funcs.clear()
+
+
+COST_FUNC_REGISTRY = CostFuncRegistry()
+
+
+class CostFuncHandle(object):
+    r"""
+    Picklable stand-in for a cost function of COST_FUNC_REGISTRY
+
+    Only the arguments of CostFuncRegistry.get are pickled, each process looks
+    the function (and its weights) up in its own registry on first use.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.costs import *  # NOQA
+        >>> import pickle
+        >>> handle = CostFuncHandle('pairwise', 'dtw-l2', 'crc', 32, True, window=4)
+        >>> handle_ = pickle.loads(pickle.dumps(handle))
+        >>> rng = np.random.RandomState(0)
+        >>> qcurv, dcurv = rng.rand(2, 32, 2).astype(np.float32)
+        >>> assert handle(qcurv, dcurv) == handle_(qcurv, dcurv)
+        >>> assert len(pickle.dumps(handle)) < 512
+    """
+
+    def __init__(self, kind, name, dataset, curv_length, spatial_weights, **kwargs):
+        self.args = (kind, name, dataset, curv_length, spatial_weights)
+        self.kwargs = kwargs
+        self._func = None
+
+    def __getstate__(self):
+        return {'args': self.args, 'kwargs': self.kwargs}
+
+    def __setstate__(self, state):
+        self.args = state['args']
+        self.kwargs = state['kwargs']
+        self._func = None
+
+    def __repr__(self):
+        return 'CostFuncHandle%r' % (self.args,)
+
+    @property
+    def weights(self):
+        return COST_FUNC_REGISTRY.weights(*self.args[2:])
+
+    def resolve(self):
+        if self._func is None:
+            self._func = COST_FUNC_REGISTRY.get(*self.args, **self.kwargs)
+        return self._func
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
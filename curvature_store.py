@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+import h5py
+import numpy as np
+import six
+
+
+CURVATURE_STORE_CHUNKSIZE = 1024
+
+
+class CurvatureStore(object):
+    r"""
+    Single HDF5 archive of the resampled curvature matrices of a dataset
+
+    Each image is one row of a chunked (N, curv_length, num_scales) float32
+    dataset, stored next to its fpath and whether its curvature could be
+    computed at all.  Rows are appended in bulk and read back by fpath or in
+    order of insertion, so loading the curvatures of a whole database opens
+    one file instead of one per image.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.curvature_store import *  # NOQA
+        >>> import tempfile
+        >>> from os.path import join
+        >>> rng = np.random.RandomState(0)
+        >>> curvs = rng.rand(3, 16, 2).astype(np.float32)
+        >>> with tempfile.TemporaryDirectory() as dpath:
+        >>>     fpath = join(dpath, 'curvatures.h5')
+        >>>     with CurvatureStore(fpath, scales=[0.04, 0.06], curv_length=16) as store:
+        >>>         store.append(['a.jpg', 'b.jpg'], curvs[:2])
+        >>>         store.append(['c.jpg', 'd.jpg'], [curvs[2], None])
+        >>>     with CurvatureStore(fpath, mode='r') as store:
+        >>>         curvs_, valid = store.get(['c.jpg', 'a.jpg', 'd.jpg'])
+        >>>         chunks = list(store.iter_chunks(chunksize=3))
+        >>> assert np.all(curvs_[0] == curvs[2]) and np.all(curvs_[1] == curvs[0])
+        >>> result = (valid.tolist(), [len(fpaths) for fpaths, _, _ in chunks])
+        >>> print(result)
+        ([True, True, False], [3, 1])
+    """
+
+    def __init__(
+        self,
+        fpath,
+        scales=None,
+        curv_length=None,
+        mode='a',
+        chunksize=CURVATURE_STORE_CHUNKSIZE,
+    ):
+        self.fpath = fpath
+        self.chunksize = chunksize
+        self.h5f = h5py.File(fpath, mode)
+
+        if 'curvatures' not in self.h5f:
+            assert scales is not None, 'scales are needed to create %s' % (fpath,)
+            assert curv_length is not None, 'curv_length is needed to create %s' % (
+                fpath,
+            )
+            shape = (curv_length, len(scales))
+            self.h5f.attrs['scales'] = np.array(scales, dtype=np.float32)
+            self.h5f.attrs['curv_length'] = curv_length
+            self.h5f.create_dataset(
+                'curvatures',
+                shape=(0,) + shape,
+                maxshape=(None,) + shape,
+                chunks=(max(1, min(chunksize, 2 ** 20 // (4 * np.prod(shape)))),) + shape,
+                dtype=np.float32,
+            )
+            self.h5f.create_dataset('valid', shape=(0,), maxshape=(None,), dtype=bool)
+            self.h5f.create_dataset(
+                'fpaths',
+                shape=(0,),
+                maxshape=(None,),
+                dtype=h5py.special_dtype(vlen=six.text_type),
+            )
+
+        self.scales = self.h5f.attrs['scales']
+        self.curv_length = int(self.h5f.attrs['curv_length'])
+        if scales is not None:
+            assert np.allclose(self.scales, scales), 'scales = %r != %r' % (
+                scales,
+                self.scales.tolist(),
+            )
+        if curv_length is not None:
+            assert self.curv_length == curv_length, 'curv_length = %d != %d' % (
+                curv_length,
+                self.curv_length,
+            )
+
+        self.index = {
+            self._decode(fpath): row for row, fpath in enumerate(self.h5f['fpaths'][:])
+        }
+
+    @staticmethod
+    def _decode(fpath):
+        return fpath.decode('utf-8') if isinstance(fpath, bytes) else fpath
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, fpath):
+        return fpath in self.index
+
+    def close(self):
+        self.h5f.close()
+
+    def append(self, fpaths, curvs):
+        r"""
+        Append the curvature matrices of fpaths, a curvature of None marks an
+        image whose curvature could not be computed
+        """
+        assert len(fpaths) == len(curvs), 'len(fpaths) = %d != len(curvs) = %d' % (
+            len(fpaths),
+            len(curvs),
+        )
+        duplicates = [fpath for fpath in fpaths if fpath in self.index]
+        assert not duplicates, '%d fpaths are already stored' % (len(duplicates),)
+        if len(fpaths) == 0:
+            return
+
+        dataset = self.h5f['curvatures']
+        block = np.zeros((len(fpaths),) + dataset.shape[1:], dtype=np.float32)
+        valid = np.zeros(len(fpaths), dtype=bool)
+        for idx, curv in enumerate(curvs):
+            if curv is not None:
+                block[idx] = curv
+                valid[idx] = True
+
+        start = len(self.index)
+        stop = start + len(fpaths)
+        for name in ('curvatures', 'valid', 'fpaths'):
+            self.h5f[name].resize(stop, axis=0)
+        dataset[start:stop] = block
+        self.h5f['valid'][start:stop] = valid
+        self.h5f['fpaths'][start:stop] = list(fpaths)
+
+        for row, fpath in enumerate(fpaths, start=start):
+            self.index[fpath] = row
+
+    def get(self, fpaths):
+        r"""
+        Returns:
+            curvs (np.ndarray): (len(fpaths), curv_length, num_scales) curvatures
+            valid (np.ndarray): False where the curvature could not be computed
+        """
+        rows = np.array([self.index[fpath] for fpath in fpaths], dtype=np.int64)
+        if len(rows) == 0:
+            shape = (0,) + self.h5f['curvatures'].shape[1:]
+            return np.zeros(shape, dtype=np.float32), np.zeros(0, dtype=bool)
+
+        # h5py only reads increasing rows, so read each row once and reorder
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        lo, hi = unique_rows[0], unique_rows[-1] + 1
+        if len(unique_rows) * 2 >= hi - lo:
+            # mostly contiguous, a slice is much faster than a point selection
+            curvs = self.h5f['curvatures'][lo:hi][unique_rows - lo]
+            valid = self.h5f['valid'][lo:hi][unique_rows - lo]
+        else:
+            curvs = self.h5f['curvatures'][unique_rows.tolist()]
+            valid = self.h5f['valid'][unique_rows.tolist()]
+
+        return curvs[inverse], valid[inverse]
+
+    def iter_chunks(self, chunksize=None):
+        r"""
+        Yields (fpaths, curvs, valid) for consecutive rows in order of insertion
+        """
+        if chunksize is None:
+            chunksize = self.chunksize
+        num_rows = len(self.index)
+        for start in range(0, num_rows, chunksize):
+            stop = min(num_rows, start + chunksize)
+            fpaths = [self._decode(fpath) for fpath in self.h5f['fpaths'][start:stop]]
+            curvs = self.h5f['curvatures'][start:stop]
+            valid = self.h5f['valid'][start:stop]
+            yield fpaths, curvs, valid
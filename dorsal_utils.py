@@ -187,38 +187,198 @@ def gaussian(u, s):
     return 1.0 / np.sqrt(2.0 * np.pi * s * s) * np.exp(-u * u / (2.0 * s * s))
 
 
+# relative distance to a float32 rounding boundary below which oriented_curvature
+# recomputes a value, about 1000 times the error of its float64 sums
+CURVATURE_EXACT_TOL = 1e-10
+
+
 # contour: (n, 2) array of (x, y) points
-def oriented_curvature(contour, radii):
-    curvature = np.zeros((contour.shape[0], len(radii)), dtype=np.float32)
-    # define the radii as a fraction of either the x or y extent
-    for i, (x, y) in enumerate(contour):
-        center = np.array([x, y])
-        dists = ((contour - center) ** 2).sum(axis=1)
-        inside = dists[:, np.newaxis] <= (radii * radii)
+def oriented_curvature(contour, radii, chunksize=64):
+    r"""
+    Integral curvature of every contour point at every radius
+
+    For each point, the part of the contour inside the circle of the given
+    radius is rotated so that the chord between its first and last point is
+    horizontal, and the curvature is the fraction of the circle's bounding box
+    that lies under it.
+
+    Instead of rotating every sub-curve and integrating it with np.trapz, the
+    rotation is expanded out of the trapezoid sum, which leaves per-segment
+    sums that do not depend on the angle.  Those are prefix sums along the
+    contour, so a point whose in-circle neighbourhood is a contiguous run of
+    the contour costs O(1) once the run is known; points whose circle cuts the
+    contour more than once fall back to summing over their inside points.  The
+    in-circle tests are vectorized over chunks of ``chunksize`` centers and
+    restricted to the span of the contour the chunk can reach.
+
+    The float64 sums are ordered differently than in
+    oriented_curvature_reference, the original per-point loop, so the values
+    within CURVATURE_EXACT_TOL of a float32 rounding boundary are recomputed
+    with its loop body.  The output then matches it exactly.  The loop does its
+    arithmetic in the contour's precision, so contours of floats narrower than
+    float64 go through it directly.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.dorsal_utils import *  # NOQA
+        >>> t = np.linspace(0, np.pi, 200)
+        >>> contour = np.round(100 * np.vstack((np.cos(t), np.sin(t))).T).astype(np.int64)
+        >>> radii = np.array([0.04, 0.06, 0.08, 0.10], dtype=np.float32) * 100
+        >>> curv = oriented_curvature(contour, radii)
+        >>> curv_ = oriented_curvature_reference(contour, radii)
+        >>> assert curv.dtype == np.float32 and curv.shape == (200, 4)
+        >>> assert np.all(curv == curv_)
+    """
+    if contour.dtype.kind == 'f' and contour.dtype.itemsize < 8:
+        return oriented_curvature_reference(contour, radii)
+
+    num_points = contour.shape[0]
+    if num_points == 0:
+        return np.zeros((num_points, len(radii)), dtype=np.float32)
+    curvature = np.zeros((num_points, len(radii)), dtype=np.float64)
+
+    points = contour.astype(np.float64)
+    X, Y = points[:, 0], points[:, 1]
+    # the in-circle tests compare the squared distances and radii in their own
+    # precision, as the loop does
+    radii_sq = radii * radii
+    max_radius_sq = radii_sq.max(keepdims=True)
+
+    # prefix sums of the angle-independent trapezoid terms between neighbours
+    prefix_xy = np.zeros(num_points)
+    prefix_yx = np.zeros(num_points)
+    np.cumsum((X[1:] - X[:-1]) * (Y[:-1] + Y[1:]), out=prefix_xy[1:])
+    np.cumsum((Y[1:] - Y[:-1]) * (X[:-1] + X[1:]), out=prefix_yx[1:])
+
+    for start in range(0, num_points, chunksize):
+        stop = min(num_points, start + chunksize)
+        cx, cy = X[start:stop], Y[start:stop]
+
+        # neighbouring centers see neighbouring parts of the contour, so only keep
+        # the span of contour indices that falls inside the largest circle
+        dists = ((contour[None, :] - contour[start:stop, None]) ** 2).sum(axis=2)
+        inside = dists <= max_radius_sq
+        lower = inside.argmax(axis=1).min()
+        upper = num_points - inside[:, ::-1].argmax(axis=1).min()
+        dists = dists[:, lower:upper]
+        dx = X[None, lower:upper] - cx[:, None]
+        dy = Y[None, lower:upper] - cy[:, None]
+
+        for j, radius in enumerate(radii):
+            radius = np.float64(radius)
+            inside = dists <= radii_sq[j : j + 1]
+
+            # first and last point of the contour inside the circle
+            first = inside.argmax(axis=1)
+            last = (upper - lower - 1) - inside[:, ::-1].argmax(axis=1)
+            first_, last_ = first + lower, last + lower
+
+            n_x = X[last_] - X[first_]
+            n_y = Y[last_] - Y[first_]
+            theta = np.arctan2(n_y, n_x)
+            cos, sin = np.cos(theta), np.sin(theta)
+
+            sum_xy = prefix_xy[last_] - prefix_xy[first_]
+            sum_yx = prefix_yx[last_] - prefix_yx[first_]
+            broken = np.nonzero(inside.sum(axis=1) != last - first + 1)[0]
+            if len(broken) > 0:
+                sum_xy[broken], sum_yx[broken] = _chained_sums(
+                    X[lower:upper], Y[lower:upper], inside[broken]
+                )
+
+            dx_0, dx_1 = X[first_] - cx, X[last_] - cx
+            dy_0, dy_1 = Y[first_] - cy, Y[last_] - cy
+            sum_ap = dx_1 * dx_1 - dx_0 * dx_0
+            sum_bq = dy_1 * dy_1 - dy_0 * dy_0
+            sum_aq = sum_xy - 2.0 * cy * n_x
+            sum_bp = sum_yx - 2.0 * cx * n_y
+            area = 0.5 * (
+                cos * cos * sum_aq
+                - sin * sin * sum_bp
+                + cos * sin * (sum_bq - sum_ap)
+                + 2.0 * radius * (cos * n_x + sin * n_y)
+            )
+
+            rotated = cos[:, None] * dx + sin[:, None] * dy
+            r0_x = np.maximum(
+                np.where(inside, rotated, np.inf).min(axis=1) + cx, cx - radius
+            )
+            r1_x = np.minimum(
+                np.where(inside, rotated, -np.inf).max(axis=1) + cx, cx + radius
+            )
+            r0_y = cy - radius
+            r1_y = cy + radius
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                curv = area / ((r1_x - r0_x) * (r1_y - r0_y))
 
-        for j, _ in enumerate(radii):
-            curve = contour[inside[:, j]]
             # sometimes only a single point lies inside the circle
-            if curve.shape[0] == 1:
-                curv = 0.5
-            else:
-                n = curve[-1] - curve[0]
-                theta = np.arctan2(n[1], n[0])
-
-                curve_p = reorient(curve, theta, center)
-                center_p = np.squeeze(reorient(center[None], theta, center))
-                r0 = center_p - radii[j]
-                r1 = center_p + radii[j]
-                r0[0] = max(curve_p[:, 0].min(), r0[0])
-                r1[0] = min(curve_p[:, 0].max(), r1[0])
-
-                area = np.trapz(curve_p[:, 1] - r0[1], curve_p[:, 0], axis=0)
-                curv = area / np.prod(r1 - r0)
-            curvature[i, j] = curv
+            curv[first == last] = 0.5
+            curvature[start:stop, j] = curv
+
+    # a value this close to the midpoint of two float32 numbers may round either
+    # way depending on the order of the float64 sums
+    rounded = curvature.astype(np.float32)
+    residual = curvature - rounded
+    half_up = 0.5 * (np.nextafter(rounded, np.float32(np.inf)) - rounded)
+    half_down = 0.5 * (rounded - np.nextafter(rounded, np.float32(-np.inf)))
+    margin = np.minimum(np.abs(half_up - residual), np.abs(half_down + residual))
+    tol = CURVATURE_EXACT_TOL * np.maximum(1.0, np.abs(curvature))
+    for i, j in zip(*np.nonzero(margin <= tol)):
+        rounded[i, j] = _oriented_curvature_at(contour, i, radii, j)
+
+    return rounded
+
+
+def _chained_sums(X, Y, inside):
+    # join each inside point to the next inside point along the contour
+    size = inside.shape[1]
+    index = np.where(inside, np.arange(size), size)
+    following = np.minimum.accumulate(index[:, ::-1], axis=1)[:, ::-1]
+    following = np.hstack((following[:, 1:], np.full((inside.shape[0], 1), size)))
+    valid = inside & (following < size)
+    following = np.minimum(following, size - 1)
+
+    X_next, Y_next = X[following], Y[following]
+    sum_xy = np.where(valid, (X_next - X) * (Y + Y_next), 0.0).sum(axis=1)
+    sum_yx = np.where(valid, (Y_next - Y) * (X + X_next), 0.0).sum(axis=1)
+    return sum_xy, sum_yx
+
+
+def oriented_curvature_reference(contour, radii):
+    curvature = np.zeros((contour.shape[0], len(radii)), dtype=np.float32)
+    # define the radii as a fraction of either the x or y extent
+    for i in range(contour.shape[0]):
+        for j in range(len(radii)):
+            curvature[i, j] = _oriented_curvature_at(contour, i, radii, j)
 
     return curvature
 
 
+def _oriented_curvature_at(contour, i, radii, j):
+    center = np.array(contour[i])
+    dists = ((contour - center) ** 2).sum(axis=1)
+    inside = dists[:, np.newaxis] <= (radii * radii)
+
+    curve = contour[inside[:, j]]
+    # sometimes only a single point lies inside the circle
+    if curve.shape[0] == 1:
+        return 0.5
+
+    n = curve[-1] - curve[0]
+    theta = np.arctan2(n[1], n[0])
+
+    curve_p = reorient(curve, theta, center)
+    center_p = np.squeeze(reorient(center[None], theta, center))
+    r0 = center_p - radii[j]
+    r1 = center_p + radii[j]
+    r0[0] = max(curve_p[:, 0].min(), r0[0])
+    r1[0] = min(curve_p[:, 0].max(), r1[0])
+
+    area = np.trapz(curve_p[:, 1] - r0[1], curve_p[:, 0], axis=0)
+    return area / np.prod(r1 - r0)
+
+
 def diff_of_gauss_descriptor(
     contour, m, s, num_keypoints, feat_dim, contour_length, uniform
 ):
@@ -289,16 +449,22 @@ def reorient(points, theta, center):
 
 
 def load_curv_mat_from_h5py(target, scales, curv_length):
+    with target.open('r') as h5f:
+        curv_matrix = load_curv_mat_from_h5f(h5f, scales, curv_length)
+
+    return curv_matrix
+
+
+def load_curv_mat_from_h5f(h5f, scales, curv_length):
     # each column represents a single scale
     curv_matrix = np.empty((curv_length, len(scales)), dtype=np.float32)
-    with target.open('r') as h5f:
-        # load each scale separately into the curvature matrix
-        for sidx, s in enumerate(scales):
-            curv = h5f['%.3f' % s][:]
-            if curv_length is None or curv.shape[0] == curv_length:
-                curv_matrix[:, sidx] = curv
-            else:
-                curv_matrix[:, sidx] = resample(curv, curv_length)
+    # load each scale separately into the curvature matrix
+    for sidx, s in enumerate(scales):
+        curv = h5f['%.3f' % s][:]
+        if curv_length is None or curv.shape[0] == curv_length:
+            curv_matrix[:, sidx] = curv
+        else:
+            curv_matrix[:, sidx] = resample(curv, curv_length)
 
     return curv_matrix
 
@@ -1,71 +1,145 @@
 #include <iostream>
 #include <algorithm>
+#include <limits>
+#include <vector>
 #include <Eigen/Dense>
 #include <math.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 typedef Eigen::Array<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> ArrayType;
 typedef Eigen::Map<ArrayType> MapType;
 
-extern "C" void weighted_chi_square(float* x1, float* x2, float* w,
-                                    int m, int n, int window,
-                                    float* costs_out) {
-  MapType costs((float*) costs_out, m, m);
+// The Sakoe-Chiba band of row i covers the columns i - window <= j < i + window.
+// Only two rows of the band are kept: cell (i, j) is stored at slot
+// j - (i - window) + 1 of the current row, so that the cells (i - 1, j - 1) and
+// (i - 1, j) are at the same slot and the next one of the previous row.  Slot 0
+// and slot 2 * window + 1 are always infinite and stand in for the cells just
+// outside the band.
+//
+// cost_func(i, j) returns the cost of matching point i of the query with
+// point j of the database curve.  Once every cell of a row costs more than
+// cutoff, the final cost cannot be lower either, so the search is abandoned and
+// infinity is returned.
+template <typename CostFunc>
+float banded_dtw(int m, int window, float cutoff, CostFunc cost_func) {
+  const float INF = std::numeric_limits<float>::infinity();
 
-  MapType X1((float*) x1, m, n);
-  MapType X2((float*) x2, m, n);
-  MapType weights((float*) w, m, 1);
+  if (m == 1)
+    return 0.;
+  if (window < 1)
+    return INF;
 
-  // pre-computed offsets
-  ArrayType X1p = (X1 - 0.5).abs();
-  ArrayType X2p = (X2 - 0.5).abs();
+  const int width = 2 * window + 2;
+  std::vector<float> rows(2 * width, INF);
+  float* prev = rows.data();
+  float* cur = rows.data() + width;
 
-  ArrayType xi, xj, xip, xjp;
-  float wi, wj;
+  // row 0: only the cell (0, 0) is reachable
+  prev[window + 1] = 0.;
 
-  float cost;
   for (int i = 1; i < m; ++i) {
-    for (int j = std::max(1, i - window); j < std::min(m, i + window); ++j) {
-      // original points
-      xi = X1.row(i);
-      xj = X2.row(j);
-      // pre-computed offsets with abs. value
-      xip = X1p.row(i);
-      xjp = X2p.row(j);
-      // spatial weights
-      wi = weights(i, 0);
-      wj = weights(j, 0);
-
-      cost = wi * wj * ((xi - xj) * (xi - xj) / (xip + xjp + 1e-6)).sum();
-      costs(i, j) = cost + std::min(costs(i, j - 1),
-          std::min(costs(i - 1, j), costs(i - 1, j - 1)));
+    const int lo = i - window;
+    const int k_begin = std::max(1, 1 - lo + 1);
+    const int k_end = std::min(2 * window, m - lo);
+
+    float row_min = INF;
+    for (int k = 1; k < k_begin; ++k)
+      cur[k] = INF;
+    for (int k = k_begin; k <= k_end; ++k) {
+      const int j = lo + k - 1;
+      float cost = cost_func(i, j);
+      cur[k] = cost + std::min(cur[k - 1], std::min(prev[k + 1], prev[k]));
+      row_min = std::min(row_min, cur[k]);
     }
+    for (int k = std::max(k_begin, k_end + 1); k <= 2 * window; ++k)
+      cur[k] = INF;
+
+    if (row_min > cutoff)
+      return INF;
+
+    std::swap(prev, cur);
   }
-}
 
-extern "C" void weighted_euclidean(float* x1, float* x2, float* w,
-                                   int m, int n, int window,
-                                   float* costs_out) {
-  MapType costs((float*) costs_out, m, m);
+  // the cell (m - 1, m - 1)
+  return prev[window + 1];
+}
 
+extern "C" float weighted_chi_square_banded(float* x1, float* x2, float* w,
+                                            int m, int n, int window,
+                                            float cutoff) {
   MapType X1((float*) x1, m, n);
   MapType X2((float*) x2, m, n);
   MapType weights((float*) w, m, 1);
 
-  ArrayType xi, xj;
-  float wi, wj;
+  return banded_dtw(m, window, cutoff, [&](int i, int j) {
+    // spatial weights
+    float wi = weights(i, 0);
+    float wj = weights(j, 0);
 
-  float cost;
-  for (int i = 1; i < m; ++i) {
-    for (int j = std::max(1, i - window); j < std::min(m, i + window); ++j) {
-      xi = X1.row(i);
-      xj = X2.row(j);
+    // offsets with abs. value
+    return wi * wj * ((X1.row(i) - X2.row(j)) * (X1.row(i) - X2.row(j)) /
+                      ((X1.row(i) - 0.5).abs() + (X2.row(j) - 0.5).abs() + 1e-6)).sum();
+  });
+}
 
-      wi = weights(i, 0);
-      wj = weights(j, 0);
+extern "C" float weighted_euclidean_banded(float* x1, float* x2, float* w,
+                                           int m, int n, int window,
+                                           float cutoff) {
+  MapType X1((float*) x1, m, n);
+  MapType X2((float*) x2, m, n);
+  MapType weights((float*) w, m, 1);
 
-      cost = wi * wj * sqrt(((xi - xj) * (xi - xj)).sum());
-      costs(i, j) = cost + std::min(costs(i, j - 1),
-          std::min(costs(i - 1, j), costs(i - 1, j - 1)));
-    }
+  return banded_dtw(m, window, cutoff, [&](int i, int j) {
+    float wi = weights(i, 0);
+    float wj = weights(j, 0);
+
+    return wi * wj * sqrt(((X1.row(i) - X2.row(j)) * (X1.row(i) - X2.row(j))).sum());
+  });
+}
+
+// Compare every query curve with every database curve.
+//
+// x1s:          num_q x m x n query curves
+// x2s:          num_d x m x n database curves
+// costs_out:    num_q x num_d output costs
+// num_threads:  OpenMP threads to use, if built with OpenMP
+template <typename CostFunc>
+void banded_dtw_batch(float* x1s, float* x2s, float* w,
+                      int num_q, int num_d, int m, int n, int window,
+                      float cutoff, int num_threads, float* costs_out,
+                      CostFunc cost_func) {
+  const long num = (long) num_q * num_d;
+  const long size = (long) m * n;
+#ifdef _OPENMP
+  if (num_threads > 1) {
+    #pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+    for (long k = 0; k < num; ++k)
+      costs_out[k] = cost_func(x1s + (k / num_d) * size, x2s + (k % num_d) * size,
+                               w, m, n, window, cutoff);
+    return;
   }
+#endif
+  for (long k = 0; k < num; ++k)
+    costs_out[k] = cost_func(x1s + (k / num_d) * size, x2s + (k % num_d) * size,
+                             w, m, n, window, cutoff);
+}
+
+extern "C" void weighted_chi_square_banded_batch(float* x1s, float* x2s, float* w,
+                                                 int num_q, int num_d,
+                                                 int m, int n, int window,
+                                                 float cutoff, int num_threads,
+                                                 float* costs_out) {
+  banded_dtw_batch(x1s, x2s, w, num_q, num_d, m, n, window, cutoff, num_threads,
+                   costs_out, weighted_chi_square_banded);
+}
+
+extern "C" void weighted_euclidean_banded_batch(float* x1s, float* x2s, float* w,
+                                                int num_q, int num_d,
+                                                int m, int n, int window,
+                                                float cutoff, int num_threads,
+                                                float* costs_out) {
+  banded_dtw_batch(x1s, x2s, w, num_q, num_d, m, n, window, cutoff, num_threads,
+                   costs_out, weighted_euclidean_banded);
 }
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+r"""
+Pluggable executors for the per-annotation CPU stages of the CurvRank pipeline
+
+Each stage maps a worker function over zipped per-annotation arguments with
+one of three backends:
+
+    serial     a plain loop in the calling thread
+    threads    a thread pool, the arguments and results are shared zero-copy;
+               this pays off for workers that spend their time in OpenCV or
+               NumPy calls that release the GIL
+    processes  utool's process pool, every argument and result is pickled
+
+Every call records its wall time and the size of the NumPy payload that went
+in and out, which is what the process backend has to serialize, so that the
+cheapest backend can be chosen per stage.
+"""
+from __future__ import absolute_import, division, print_function
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import numpy as np
+import time
+
+
+EXECUTOR_BACKENDS = ('serial', 'threads', 'processes')
+THREAD_WORKERS = None  # ThreadPoolExecutor default
+PROCESS_CHUNKSIZE = 16
+
+
+def payload_bytes(obj):
+    r"""
+    Approximate pickled size of the arrays in obj, other objects count as zero
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.executors import *  # NOQA
+        >>> obj = (np.zeros((4, 4), dtype=np.float32), [np.zeros(8, dtype=np.uint8), None])
+        >>> print(payload_bytes(obj))
+        72
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, (list, tuple)):
+        return sum(payload_bytes(item) for item in obj)
+    if isinstance(obj, dict):
+        return sum(payload_bytes(value) for value in obj.values())
+    return 0
+
+
+class ExecutorStats(object):
+    r"""
+    Per (stage, backend) counters of the executed stages
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.executors import *  # NOQA
+        >>> executor_stats = ExecutorStats()
+        >>> args_list = [(np.ones(10, dtype=np.float32),)] * 3
+        >>> for backend in ['serial', 'threads', 'processes']:
+        >>>     results = run_stage('double', lambda x: 2 * x, args_list[:1] if backend == 'processes' else args_list,
+        >>>                         backend=backend, executor_stats=executor_stats)
+        >>> stats = executor_stats.stats()
+        >>> result = [(key, stats[key]['tasks'], stats[key]['payload_bytes'], stats[key]['serialized_bytes'])
+        >>>           for key in sorted(stats)]
+        >>> print(result)
+        [('double:serial', 4, 320, 0), ('double:threads', 3, 240, 0)]
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = OrderedDict()
+
+    def record(self, stage, backend, num_tasks, duration, nbytes, serialized):
+        with self._lock:
+            key = '%s:%s' % (stage, backend)
+            entry = self._stats.setdefault(
+                key,
+                {
+                    'calls': 0,
+                    'tasks': 0,
+                    'wall_time': 0.0,
+                    'payload_bytes': 0,
+                    'serialized_bytes': 0,
+                },
+            )
+            entry['calls'] += 1
+            entry['tasks'] += num_tasks
+            entry['wall_time'] += duration
+            entry['payload_bytes'] += nbytes
+            if serialized:
+                entry['serialized_bytes'] += nbytes
+
+    def stats(self):
+        with self._lock:
+            stats = OrderedDict()
+            for key, entry in self._stats.items():
+                entry = dict(entry)
+                entry['mean_task_time'] = entry['wall_time'] / max(1, entry['tasks'])
+                stats[key] = entry
+        return stats
+
+
+EXECUTOR_STATS = ExecutorStats()
+
+
+def run_stage(
+    stage,
+    func,
+    args_list,
+    backend='processes',
+    num_workers=THREAD_WORKERS,
+    chunksize=PROCESS_CHUNKSIZE,
+    progkw=None,
+    executor_stats=EXECUTOR_STATS,
+):
+    r"""
+    Apply func to every tuple of args_list with the given backend, the stats
+    are recorded under the backend that actually ran
+
+    Returns:
+        results (list): func(*args) for each args, in order
+    """
+    assert backend in EXECUTOR_BACKENDS, 'Unknown executor backend %r' % (backend,)
+    args_list = list(args_list)
+
+    # a single task is not worth a pool, it is recorded as the serial run it is
+    if len(args_list) <= 1:
+        backend = 'serial'
+
+    start = time.time()
+    if backend == 'serial':
+        results = [func(*args) for args in args_list]
+        serialized = False
+    elif backend == 'threads':
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(lambda args: func(*args), args_list))
+        serialized = False
+    else:
+        import utool as ut
+
+        if progkw is None:
+            progkw = {'freq': 10}
+        generator = ut.generate2(
+            func,
+            args_list,
+            nTasks=len(args_list),
+            ordered=True,
+            chunksize=chunksize,
+            force_serial=False,
+            progkw=progkw,
+        )
+        results = list(generator)
+        serialized = True
+    duration = time.time() - start
+
+    nbytes = payload_bytes(args_list) + payload_bytes(results)
+    executor_stats.record(stage, backend, len(args_list), duration, nbytes, serialized)
+
+    return results
@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 from wbia_curvrank import affine, dorsal_utils, imutils
+from wbia_curvrank.registry import INDEX_REGISTRY
+from wbia_curvrank.instrumentation import INSTRUMENTATION
+from concurrent.futures import ThreadPoolExecutor
 import annoy
 import cv2
 import numpy as np
-from itertools import combinations
 from scipy.signal import argrelextrema
 from scipy.ndimage import gaussian_filter1d
-import tqdm
 import time
 
 
@@ -22,62 +23,115 @@ def preprocess_image(img, flip, height, width):
     return resz, mask, M
 
 
-def localize(imgs, masks, height, width, func):
-    X = np.empty((len(imgs), 3, height, width), dtype=np.float32)
-    for i, img in enumerate(imgs):
-        X[i] = img.astype(np.float32).transpose(2, 0, 1) / 255.0
-    L, Z = func(X)
-    imgs_out, masks_out, xforms_out = [], [], []
-    for i in range(X.shape[0]):
-        M = np.vstack((L[i].reshape((2, 3)), np.array([0.0, 0.0, 1.0])))
-        A = affine.multiply_matrices(
-            (
-                affine.build_upsample_matrix(height, width),
-                M,
-                affine.build_downsample_matrix(height, width),
+def get_batch_size(num, height, width, batch_size=None, max_bytes=None):
+    # The network input is a (batch_size, 3, height, width) float32 tensor
+    if batch_size is None:
+        batch_size = num
+    if max_bytes is not None:
+        sample_bytes = 3 * height * width * np.dtype(np.float32).itemsize
+        batch_size = min(batch_size, max_bytes // sample_bytes)
+    return max(1, int(batch_size))
+
+
+def localize_iter(imgs, masks, height, width, func, batch_size=None, max_bytes=None):
+    num = len(imgs)
+    batch_size = get_batch_size(num, height, width, batch_size, max_bytes)
+
+    X = np.empty((min(num, batch_size), 3, height, width), dtype=np.float32)
+    for start in range(0, num, batch_size):
+        stop = min(num, start + batch_size)
+        for i, img in enumerate(imgs[start:stop]):
+            X[i] = img.astype(np.float32).transpose(2, 0, 1) / 255.0
+        with INSTRUMENTATION.measure('localization_batch', stop - start) as measurement:
+            L, Z = func(X[: stop - start])
+            measurement.update((L, Z))
+        for i in range(stop - start):
+            M = np.vstack((L[i].reshape((2, 3)), np.array([0.0, 0.0, 1.0])))
+            A = affine.multiply_matrices(
+                (
+                    affine.build_upsample_matrix(height, width),
+                    M,
+                    affine.build_downsample_matrix(height, width),
+                )
             )
-        )
 
-        mask = cv2.warpAffine(
-            masks[i].astype(np.float32),
-            A[:2],
-            (width, height),
-            flags=cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR,
-        )
+            mask = cv2.warpAffine(
+                masks[start + i].astype(np.float32),
+                A[:2],
+                (width, height),
+                flags=cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR,
+            )
 
-        imgs_out.append((Z[i] * 255.0).transpose(1, 2, 0).astype(np.uint8))
+            img_out = (Z[i] * 255.0).transpose(1, 2, 0).astype(np.uint8)
+            yield img_out, mask, M
+
+
+def localize(imgs, masks, height, width, func, batch_size=None, max_bytes=None):
+    imgs_out, masks_out, xforms_out = [], [], []
+    generator = localize_iter(imgs, masks, height, width, func, batch_size, max_bytes)
+    for img_out, mask, M in generator:
+        imgs_out.append(img_out)
         masks_out.append(mask)
         xforms_out.append(M)
 
     return imgs_out, masks_out, xforms_out
 
 
-def refine_localization(img, flip, pre_xform, loc_xform, scale, height, width):
-    if flip:
-        img = img[:, ::-1]
-    msk = np.full(img.shape[0:2], 255, dtype=np.uint8)
-
+def refine_localization(
+    img, flip, pre_xform, loc_xform, scale, height, width, compact=False, out=None
+):
+    # With compact, the flip is part of the warp and the mask is filled in from
+    # the outline of the image, so the full-resolution image is neither copied
+    # nor converted
     img_refn, msk_refn = imutils.refine_localization(
-        img, msk, pre_xform, loc_xform, scale, height, width
+        img,
+        None,
+        pre_xform,
+        loc_xform,
+        scale,
+        height,
+        width,
+        flip=flip,
+        compact=compact,
+        out=out,
     )
 
     return img_refn, msk_refn
 
 
-def segment_contour(imgs, masks, scale, height, width, func):
-    X = np.empty((len(imgs), 3, height, width), dtype=np.float32)
-    for i, img in enumerate(imgs):
-        img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
-        X[i] = img.astype(np.float32).transpose(2, 0, 1) / 255.0
-    S = func(X)
-
+def segment_contour_iter(
+    imgs, masks, scale, height, width, func, batch_size=None, max_bytes=None
+):
+    num = len(imgs)
+    batch_size = get_batch_size(num, height, width, batch_size, max_bytes)
+
+    X = np.empty((min(num, batch_size), 3, height, width), dtype=np.float32)
+    for start in range(0, num, batch_size):
+        stop = min(num, start + batch_size)
+        for i, img in enumerate(imgs[start:stop]):
+            img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+            X[i] = img.astype(np.float32).transpose(2, 0, 1) / 255.0
+        with INSTRUMENTATION.measure('segmentation_batch', stop - start) as measurement:
+            S = func(X[: stop - start])
+            measurement.update(S)
+
+        for i in range(stop - start):
+            segm = S[i].transpose(1, 2, 0)
+            refn = imutils.refine_segmentation(segm, scale)
+            mask = masks[start + i]
+            refn[mask < 255] = 0.0
+
+            yield segm, refn
+
+
+def segment_contour(
+    imgs, masks, scale, height, width, func, batch_size=None, max_bytes=None
+):
     segms_out, refns_out = [], []
-    for i in range(X.shape[0]):
-        segm = S[i].transpose(1, 2, 0)
-        refn = imutils.refine_segmentation(segm, scale)
-        mask = masks[i]
-        refn[mask < 255] = 0.0
-
+    generator = segment_contour_iter(
+        imgs, masks, scale, height, width, func, batch_size, max_bytes
+    )
+    for segm, refn in generator:
         segms_out.append(segm)
         refns_out.append(refn)
 
@@ -132,7 +186,7 @@ def compute_curvature(contour, scales, transpose_dims):
 
 
 def compute_curvature_descriptors(
-    curv, curv_length, scales, num_keypoints, uniform, feat_dim
+    curv, curv_length, scales, num_keypoints, uniform, feat_dim, check_norm=True
 ):
     if curv.shape[0] == curv_length:
         resampled = curv
@@ -179,71 +233,446 @@ def compute_curvature_descriptors(
             keypts[0], keypts[-1] = 0, resampled.shape[0]
             keypts[1:-1] = sorted_extrema_idx
 
-        endpts = list(combinations(keypts, 2))
-        # each entry stores the features for one scale
-        descriptors = np.empty((len(endpts), feat_dim), dtype=np.float32)
-        for i, (idx0, idx1) in enumerate(endpts):
-            subcurv = resampled[idx0:idx1, sidx]
+        descriptors = resample_subcurves(resampled[:, sidx], keypts, feat_dim)
+        if check_norm:
+            feat_norm = np.linalg.norm(descriptors, axis=1)
+            assert np.allclose(feat_norm, 1.0), 'norm(feat) = %.6f' % (
+                feat_norm[np.abs(feat_norm - 1.0).argmax()],
+            )
+        feat_mats.append(descriptors)
+
+    return feat_mats
+
+
+def resample_subcurves(curv, keypts, feat_dim, out=None):
+    r"""
+    Resample the sub-curve between every pair of keypoints to feat_dim points
+
+    Row i of the output is the l2-normalized
+    dorsal_utils.resample(curv[idx0:idx1], feat_dim) for the i-th pair of
+    itertools.combinations(keypts, 2).  All pairs are interpolated in a single
+    gather with the same float32 / float64 arithmetic as scipy's interp1d, and
+    each row is normalized by its own np.linalg.norm like the per-pair path, so
+    the rows match it exactly.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.functional import *  # NOQA
+        >>> from itertools import combinations
+        >>> curv = np.random.RandomState(0).rand(1024).astype(np.float32)
+        >>> keypts = np.array([0, 100, 350, 351 + 3, 900, 1024], dtype=np.int32)
+        >>> descriptors = resample_subcurves(curv, keypts, 32)
+        >>> for i, (idx0, idx1) in enumerate(combinations(keypts, 2)):
+        >>>     feat = dorsal_utils.resample(curv[idx0:idx1], 32)
+        >>>     feat /= np.linalg.norm(feat)
+        >>>     assert np.all(descriptors[i] == feat.astype(np.float32))
+    """
+    idx0, idx1 = np.triu_indices(len(keypts), k=1)
+    idx0, idx1 = keypts[idx0].astype(np.int64), keypts[idx1].astype(np.int64)
+    num_pairs = idx0.shape[0]
+    if out is None:
+        out = np.empty((num_pairs, feat_dim), dtype=np.float32)
+    assert out.shape == (num_pairs, feat_dim), 'out.shape = %r != %r' % (
+        out.shape,
+        (num_pairs, feat_dim),
+    )
+    if num_pairs == 0:
+        return out
+
+    lengths = np.minimum(idx1, curv.shape[0]) - idx0
+    if lengths.min() < 2:
+        raise ValueError('Cannot resample a sub-curve with fewer than two points')
+
+    # the sub-curve samples sit on np.linspace(0, feat_dim, length, dtype=np.float32)
+    step = (feat_dim / (lengths - 1.0))[:, None]
+    last = (lengths - 1)[:, None]
+
+    def grid(k):
+        x = (k * step).astype(np.float32)
+        x[k == last] = feat_dim
+        return x
+
+    # first grid point >= each query point (searchsorted), corrected for rounding
+    query = np.arange(feat_dim, dtype=np.float64)[None, :]
+    k = np.minimum(np.ceil(query / step).astype(np.int64), last)
+    for _ in range(2):
+        k = np.where((k > 0) & (grid(np.maximum(k - 1, 0)) >= query), k - 1, k)
+        k = np.where((k < last) & (grid(k) < query), k + 1, k)
+    hi = np.clip(k, 1, last)
+    lo = hi - 1
+
+    x_lo, x_hi = grid(lo), grid(hi)
+    y_lo, y_hi = curv[idx0[:, None] + lo], curv[idx0[:, None] + hi]
+    slope = (y_hi - y_lo) / (x_hi - x_lo)
+    feat = slope * (query - x_lo) + y_lo
+
+    # l2-norm across the feature dimension, one np.linalg.norm (a BLAS dot) per
+    # row since a vectorized sum adds the squares in another order
+    for row in feat:
+        row /= np.linalg.norm(row)
+    out[...] = feat
+
+    return out
+
+
+class LNBNNIndexBuilder(object):
+    r"""
+    Build an LNBNN (Annoy) index from a stream of descriptor chunks
+
+    Items are numbered in the order they are added.  With on_disk=True the
+    index is built directly in fpath with Annoy's on-disk build mode, so the
+    memory use does not grow with the size of the database; otherwise the index
+    is built in memory and saved to fpath at the end.  The trees are built with
+    n_jobs threads (-1 for all cores).  The time spent adding items and building
+    the trees is kept in add_time and build_time.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.functional import *  # NOQA
+        >>> import tempfile
+        >>> from os.path import join
+        >>> data = np.random.RandomState(0).rand(100, 8).astype(np.float32)
+        >>> with tempfile.TemporaryDirectory() as dpath:
+        >>>     builder = LNBNNIndexBuilder(join(dpath, 'index.ann'), num_trees=4)
+        >>>     builder.add(data[:60])
+        >>>     builder.add(data[60:])
+        >>>     index = builder.build()
+        >>>     result = (builder.num_items, index.get_nns_by_vector(data[70], 1))
+        >>>     index.unload()
+        >>> print(result)
+        (100, [70])
+    """
+
+    def __init__(self, fpath, num_trees=10, n_jobs=-1, on_disk=True):
+        self.fpath = fpath
+        self.num_trees = num_trees
+        self.n_jobs = n_jobs
+        self.on_disk = on_disk
+        self.index = None
+        self.num_items = 0
+        self.add_time = 0.0
+        self.build_time = 0.0
+
+    def add(self, descriptors):
+        start = time.time()
+        if self.index is None:
+            f = descriptors.shape[1]  # feature dimension
+            self.index = annoy.AnnoyIndex(f, metric='euclidean')
+            if self.on_disk:
+                self.index.on_disk_build(self.fpath)
+
+        # Annoy only adds one item at a time, converting the whole chunk to Python
+        # floats up front is cheaper than letting it unpack every NumPy row
+        for offset, vector in enumerate(descriptors.tolist()):
+            self.index.add_item(self.num_items + offset, vector)
+        self.num_items += len(descriptors)
+        self.add_time += time.time() - start
+
+    def build(self):
+        assert self.index is not None, 'No descriptors were added to the index'
+        start = time.time()
+        self.index.build(self.num_trees, self.n_jobs)
+        if not self.on_disk:
+            self.index.save(self.fpath)
+        self.build_time = time.time() - start
+        print(
+            'Built index of %d items (add %0.2f seconds, build %0.2f seconds)'
+            % (self.num_items, self.add_time, self.build_time)
+        )
+        return self.index
+
+
+def build_lnbnn_index(
+    data, fpath, num_trees=10, n_jobs=-1, on_disk=True, chunksize=2 ** 16
+):
+    r"""
+    Args:
+        data (np.ndarray or iterable): descriptors, either one array or an iterable
+            of arrays that are added in order
+    """
+    if isinstance(data, np.ndarray):
+        chunks = (data[i : i + chunksize] for i in range(0, len(data), chunksize))
+    else:
+        chunks = data
+
+    builder = LNBNNIndexBuilder(
+        fpath, num_trees=num_trees, n_jobs=n_jobs, on_disk=on_disk
+    )
+    for chunk in chunks:
+        builder.add(chunk)
+    return builder.build()
+
+
+def lnbnn_index_items(index, chunksize=2 ** 16):
+    r"""
+    Yield the vectors stored in an Annoy index, in item order and in chunks
+    """
+    num_items = index.get_n_items()
+    for start in range(0, num_items, chunksize):
+        stop = min(num_items, start + chunksize)
+        yield np.array(
+            [index.get_item_vector(i) for i in range(start, stop)], dtype=np.float32
+        )
 
-            feat = dorsal_utils.resample(subcurv, feat_dim)
 
-            # l2-norm across the feature dimension
-            # feat /= np.sqrt(np.sum(feat * feat, axis=0))
-            feat /= np.linalg.norm(feat)
-            assert feat.shape[0] == feat_dim, 'f.shape[0] = %d != feat_dim' % (
-                feat.shape[0],
-                feat_dim,
+def lnbnn_name_index(names):
+    r"""
+    Integer name index for the items of an LNBNN index
+
+    Returns:
+        unique_names (list): distinct names in order of first occurrence
+        name_codes (np.ndarray): position in unique_names of each item's name
+    """
+    names_ = np.asarray(names)
+    if names_.shape[0] == 0:
+        return [], np.zeros((0,), dtype=np.int64)
+    _, first_index, inverse = np.unique(names_, return_index=True, return_inverse=True)
+    order = np.argsort(first_index)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+    unique_names = [names[i] for i in first_index[order]]
+    name_codes = rank[inverse.reshape(-1)]
+    return unique_names, name_codes
+
+
+def lnbnn_exhaustive(data, descriptors, k, blocksize=4096):
+    r"""
+    Exact (euclidean) k nearest neighbours of every descriptor among the rows of data
+
+    The distances are computed against blocksize rows of data at a time and the
+    k nearest of each block are merged with those of the previous blocks, so the
+    memory used is (num descriptors, blocksize + k) regardless of len(data).
+
+    Returns:
+        ids (np.ndarray): (num descriptors, min(k, len(data))) rows of data, nearest
+            first
+        dists (np.ndarray): distance to each of those rows
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.functional import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> data = rng.rand(50, 8).astype(np.float32)
+        >>> descriptors = rng.rand(5, 8).astype(np.float32)
+        >>> ids, dists = lnbnn_exhaustive(data, descriptors, 3)
+        >>> dists_ = np.linalg.norm(descriptors[:, None] - data[None, :], axis=2)
+        >>> assert np.all(ids == np.argsort(dists_, axis=1)[:, :3])
+        >>> assert np.allclose(dists, np.sort(dists_, axis=1)[:, :3])
+        >>> ids_, dists_ = lnbnn_exhaustive(data, descriptors, 3, blocksize=7)
+        >>> assert np.all(ids == ids_) and np.allclose(dists, dists_)
+    """
+    descriptors = np.asarray(descriptors, dtype=np.float64)
+    num = descriptors.shape[0]
+    k = min(k, len(data))
+    desc_sq_norms = (descriptors ** 2).sum(axis=1)[:, None]
+
+    best_ids = np.zeros((num, 0), dtype=np.int64)
+    best_sq_dists = np.zeros((num, 0), dtype=np.float64)
+    for start in range(0, len(data), blocksize):
+        block = np.asarray(data[start : start + blocksize], dtype=np.float64)
+        sq_dists = np.dot(descriptors, -2.0 * block.T)
+        sq_dists += desc_sq_norms
+        sq_dists += (block ** 2).sum(axis=1)[None, :]
+        np.maximum(sq_dists, 0.0, out=sq_dists)
+
+        if k < block.shape[0]:
+            ids = np.argpartition(sq_dists, k - 1, axis=1)[:, :k]
+        else:
+            ids = np.tile(np.arange(block.shape[0]), (num, 1))
+        sq_dists = np.take_along_axis(sq_dists, ids, axis=1)
+
+        # earlier blocks come first, so equal distances keep the lower row
+        ids = np.hstack((best_ids, ids + start))
+        sq_dists = np.hstack((best_sq_dists, sq_dists))
+        order = np.argsort(sq_dists, axis=1, kind='stable')[:, :k]
+        best_ids = np.take_along_axis(ids, order, axis=1)
+        best_sq_dists = np.take_along_axis(sq_dists, order, axis=1)
+
+    return best_ids, np.sqrt(best_sq_dists)
+
+
+def lnbnn_merge(lengths, ids, dists, ids_, dists_, k):
+    r"""
+    Merge two sets of per-row neighbours, keeping the k nearest of each row
+
+    Args:
+        lengths (np.ndarray): number of neighbours of each row in ids and dists
+        ids (np.ndarray): flat neighbour ids, row by row, nearest first
+        dists (np.ndarray): flat neighbour distances
+        ids_ (np.ndarray): (num rows, m) neighbour ids of the second set
+        dists_ (np.ndarray): (num rows, m) distances of the second set
+
+    Returns:
+        lengths, ids, dists: the merged neighbours in the same flat layout; on
+            equal distances the first set comes first
+    """
+    num = lengths.shape[0]
+    width = int(lengths.max()) if num > 0 else 0
+    valid = np.arange(width)[None, :] < lengths[:, None]
+
+    ids_padded = np.full((num, width), -1, dtype=np.int64)
+    ids_padded[valid] = ids
+    dists_padded = np.full((num, width), np.inf, dtype=np.float64)
+    dists_padded[valid] = dists
+
+    ids_padded = np.hstack((ids_padded, ids_.astype(np.int64)))
+    dists_padded = np.hstack((dists_padded, dists_.astype(np.float64)))
+    order = np.argsort(dists_padded, axis=1, kind='stable')[:, :k]
+    ids_padded = np.take_along_axis(ids_padded, order, axis=1)
+    dists_padded = np.take_along_axis(dists_padded, order, axis=1)
+
+    valid = np.isfinite(dists_padded)
+    return valid.sum(axis=1), ids_padded[valid], dists_padded[valid]
+
+
+def lnbnn_query(
+    index, descriptors, k, search_k=-1, num_workers=1, delta=None, executor=None
+):
+    r"""
+    Query the k + 1 nearest neighbours of every descriptor
+
+    With num_workers > 1 the descriptors are split into contiguous chunks that
+    are queried from a thread pool (Annoy releases the GIL while searching);
+    the chunks are merged back in order, so the result does not depend on the
+    number of workers.  The pool is executor if given, so that many queries can
+    share one instead of starting a pool each.
+
+    The rows of delta, if given, are treated as extra items of the index with
+    ids following the index's own; they are searched exhaustively and their
+    neighbours merged with the index's before the k + 1 nearest are kept.
+
+    Returns:
+        rows (np.ndarray): descriptor row of each of the (up to) k neighbours
+        ids (np.ndarray): item id of each neighbour
+        dists (np.ndarray): distance to each neighbour
+        norms (np.ndarray): per-row normalizing distance, the (k + 1)-th neighbour
+    """
+    num = len(descriptors)
+
+    def _query(chunk):
+        return [
+            index.get_nns_by_vector(
+                descriptors[i], k + 1, search_k=search_k, include_distances=True
             )
-            feat_norm = np.linalg.norm(feat, axis=0)
-            assert np.allclose(feat_norm, 1.0), 'norm(feat) = %.6f' % (feat_norm)
+            for i in chunk
+        ]
+
+    num_workers = min(num_workers, num)
+    if num_workers > 1:
+        chunks = np.array_split(np.arange(num), num_workers)
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor_:
+                chunk_results = list(executor_.map(_query, chunks))
+        else:
+            chunk_results = list(executor.map(_query, chunks))
+        results = [result for chunk in chunk_results for result in chunk]
+    else:
+        results = _query(range(num))
 
-            descriptors[i] = feat
-        feat_mats.append(descriptors)
+    lengths = np.array([len(ind) for ind, _ in results], dtype=np.int64)
+    ids = np.fromiter(
+        (idx for ind, _ in results for idx in ind), dtype=np.int64, count=lengths.sum()
+    )
+    dists = np.fromiter(
+        (d for _, dist in results for d in dist), dtype=np.float64, count=lengths.sum()
+    )
+    if delta is not None and len(delta) > 0:
+        delta_ids, delta_dists = lnbnn_exhaustive(delta, descriptors, k + 1)
+        delta_ids += index.get_n_items()
+        lengths, ids, dists = lnbnn_merge(
+            lengths, ids, dists, delta_ids, delta_dists, k + 1
+        )
 
-    return feat_mats
+    # the last neighbour of each row is only used to normalize the others
+    ends = np.cumsum(lengths)
+    norms = np.zeros((num,), dtype=np.float64)
+    norms[lengths > 0] = dists[ends[lengths > 0] - 1]
+    keep = np.ones(ids.shape[0], dtype=bool)
+    keep[ends[lengths > 0] - 1] = False
+    rows = np.repeat(np.arange(num), lengths)[keep]
+
+    return rows, ids[keep], dists[keep], norms
 
 
-def build_lnbnn_index(data, fpath, num_trees=10):
-    print('Adding data to index...')
-    f = data.shape[1]  # feature dimension
-    index = annoy.AnnoyIndex(f, metric='euclidean')
-    for i, _ in tqdm.tqdm(list(enumerate(data))):
-        index.add_item(i, data[i])
-    print('...done')
-    print('Building indices...')
-    start = time.time()
-    index.build(num_trees)
-    end = time.time()
-    print('...done (took %r seconds' % (end - start,))
-    print('Saving indices...')
-    index.save(fpath)
-    print('...done')
-    return index
+def lnbnn_scores(rows, ids, dists, norms, name_codes, num_names):
+    # Within each row, only the nearest neighbour of each name votes
+    keys = rows * num_names + name_codes[ids]
+    keys, first = np.unique(keys, return_index=True)
+    votes = dists[first] - norms[rows[first]]
+    # keys are sorted by row, so each name accumulates its votes in row order
+    return np.bincount(keys % num_names, weights=votes, minlength=num_names)
 
 
 # LNBNN classification using: www.cs.ubc.ca/~lowe/papers/12mccannCVPR.pdf
 # Performance is about the same using: https://arxiv.org/abs/1609.06323
-def lnbnn_identify(index_fpath, k, descriptors, names, search_k=-1):
-    print('Loading Annoy index...')
+def lnbnn_identify(
+    index_fpath,
+    k,
+    descriptors,
+    names,
+    search_k=-1,
+    name_index=None,
+    num_workers=1,
+    delta=None,
+    executor=None,
+):
+    r"""
+    Args:
+        name_index (tuple): lnbnn_name_index(names), pass it in to avoid
+            recomputing it for every query against the same index
+        num_workers (int): number of threads used for the nearest-neighbour
+            lookups, see lnbnn_query
+        executor (ThreadPoolExecutor): pool for those lookups, pass one in to
+            share it between calls
+        delta (np.ndarray): descriptors added since the index was built, searched
+            exhaustively; names lists the index's items followed by these rows
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.functional import *  # NOQA
+        >>> import tempfile
+        >>> from os.path import join
+        >>> rng = np.random.RandomState(0)
+        >>> data = rng.rand(200, 8).astype(np.float32)
+        >>> names = list(rng.randint(0, 10, 200))
+        >>> descriptors = rng.rand(25, 8).astype(np.float32)
+        >>> with tempfile.TemporaryDirectory() as dpath:
+        >>>     index_fpath = join(dpath, 'index.ann')
+        >>>     index = build_lnbnn_index(data, index_fpath, num_trees=4)
+        >>>     scores = lnbnn_identify(index_fpath, 3, descriptors, names)
+        >>> # the per-descriptor loop this replaced
+        >>> scores_ = {name: 0.0 for name in names}
+        >>> for vector in descriptors:
+        >>>     ind, dist = index.get_nns_by_vector(vector, 4, include_distances=True)
+        >>>     classes = np.array([names[idx] for idx in ind[:-1]])
+        >>>     for c in np.unique(classes):
+        >>>         (j,) = np.where(classes == c)
+        >>>         scores_[c] += dist[j.min()] - dist[-1]
+        >>> assert list(scores.keys()) == list(scores_.keys())
+        >>> assert list(scores.values()) == list(scores_.values())
+    """
+    # Loaded indices are shared by every call in this process
     fdim = descriptors.shape[1]
-    index = annoy.AnnoyIndex(fdim, metric='euclidean')
-    index.load(index_fpath)
+    index = INDEX_REGISTRY.get(index_fpath, fdim)
 
     # NOTE: Names may contain duplicates.  This works, but is it confusing?
-    print('Performing inference...')
-    scores = {name: 0.0 for name in names}
-    for data in tqdm.tqdm(list(descriptors)):
-        ind, dist = index.get_nns_by_vector(
-            data, k + 1, search_k=search_k, include_distances=True
-        )
-        # entry at k + 1 is the normalizing distance
-        classes = np.array([names[idx] for idx in ind[:-1]])
-        for c in np.unique(classes):
-            (j,) = np.where(classes == c)
-            # multiple descriptors in the top-k may belong to the
-            # same class
-            score = dist[j.min()] - dist[-1]
-            scores[c] += score
+    if name_index is None:
+        name_index = lnbnn_name_index(names)
+    unique_names, name_codes = name_index
+    if len(unique_names) == 0:
+        return {}
+
+    rows, ids, dists, norms = lnbnn_query(
+        index,
+        descriptors,
+        k,
+        search_k=search_k,
+        num_workers=num_workers,
+        delta=delta,
+        executor=executor,
+    )
+    totals = lnbnn_scores(rows, ids, dists, norms, name_codes, len(unique_names))
+    scores = dict(zip(unique_names, totals.tolist()))
 
     return scores
 
@@ -261,3 +690,154 @@ def dtwsw_identify(query_curvs, database_curvs, names, simfunc):
         scores[name] = S.min(axis=None)
 
     return scores
+
+
+def dtwsw_stack_database(database_curvs, names):
+    r"""
+    Stack the database curvatures of names into one (N, m, n) array
+
+    Returns:
+        dcurvs (np.ndarray): curvatures of all names, name by name
+        bounds (np.ndarray): dcurvs[bounds[i]:bounds[i + 1]] belong to names[i]
+    """
+    counts = [len(database_curvs[name]) for name in names]
+    assert min(counts, default=1) > 0, 'Every name needs at least one curvature'
+    bounds = np.hstack(([0], np.cumsum(counts))).astype(np.int64)
+    dcurvs = [dcurv for name in names for dcurv in database_curvs[name]]
+    if len(dcurvs) > 0:
+        dcurvs = np.ascontiguousarray(np.stack(dcurvs), dtype=np.float32)
+    else:
+        dcurvs = np.zeros((0, 0, 0), dtype=np.float32)
+    return dcurvs, bounds
+
+
+def dtwsw_identify_batch(
+    query_curvs,
+    database_curvs,
+    names,
+    batch_simfunc,
+    stacked=None,
+    database_features=None,
+):
+    r"""
+    Same as dtwsw_identify, but every query curvature is compared with all
+    database curvatures in a single batch_simfunc call
+
+    Args:
+        batch_simfunc (func): compares (Q, m, n) query curvatures with (N, m, n)
+            database curvatures, see costs.get_batch_cost_func
+        stacked (tuple): dtwsw_stack_database(database_curvs, names), pass it in
+            to avoid stacking the database for every query
+        database_features: costs.batch_database_features(batch_simfunc,
+            stacked[0]), pass it in with stacked to avoid recomputing the
+            features of the database for every query
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.functional import *  # NOQA
+        >>> from wbia_curvrank import costs
+        >>> rng = np.random.RandomState(0)
+        >>> weights = np.ones((32, 1), dtype=np.float32)
+        >>> database_curvs = {
+        >>>     name: list(rng.rand(rng.randint(1, 4), 32, 2).astype(np.float32))
+        >>>     for name in ['a', 'b', 'c']
+        >>> }
+        >>> query_curvs = list(rng.rand(2, 32, 2).astype(np.float32))
+        >>> simfunc = costs.get_cost_func('dtw-l2', weights=weights, window=4)
+        >>> batch_simfunc = costs.get_batch_cost_func('dtw-l2', weights=weights, window=4)
+        >>> scores = dtwsw_identify_batch(query_curvs, database_curvs, ['a', 'b', 'c'], batch_simfunc)
+        >>> scores_ = dtwsw_identify(query_curvs, database_curvs, ['a', 'b', 'c'], simfunc)
+        >>> assert scores == scores_
+    """
+    names = list(names)
+    if len(names) == 0:
+        return {}
+    if stacked is None:
+        stacked = dtwsw_stack_database(database_curvs, names)
+    dcurvs, bounds = stacked
+
+    qcurvs = np.ascontiguousarray(np.stack(query_curvs), dtype=np.float32)
+    # (Q, N) costs, reduced over the queries and then over each name's curvatures
+    if database_features is None:
+        S = batch_simfunc(qcurvs, dcurvs)
+    else:
+        S = batch_simfunc(qcurvs, dcurvs, database_features=database_features)
+    mins = S.min(axis=0)
+    name_mins = np.minimum.reduceat(mins, bounds[:-1])
+
+    scores = {name: score for name, score in zip(names, name_mins)}
+
+    return scores
+
+
+def dtwsw_identify_pruned(
+    query_curvs, names, simfunc, lower_bound_func, stacked, envelopes, slack=1e-3
+):
+    r"""
+    Same as dtwsw_identify, but skips the alignments that cannot beat the best
+    cost found so far for a name
+
+    The pairs of a name are aligned in order of increasing lower bound, and each
+    alignment is abandoned as soon as it costs more than the current best.  Once
+    the lower bound of the next pair exceeds the best cost by more than slack,
+    the remaining pairs are skipped.  The slack covers the float32 rounding of
+    the DTW kernels, so the scores are the same as those of dtwsw_identify.
+
+    Args:
+        simfunc (func): pairwise cost func that takes a cutoff, see
+            costs.get_cost_func
+        lower_bound_func (func): see costs.get_lower_bound_func
+        stacked (tuple): dtwsw_stack_database(database_curvs, names)
+        envelopes (dict): costs.dtw_envelopes of the stacked curvatures
+
+    Returns:
+        scores (dict): the lowest cost of each name
+        num_pruned (int): number of pairs that were not aligned
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.functional import *  # NOQA
+        >>> from wbia_curvrank import costs
+        >>> rng = np.random.RandomState(0)
+        >>> weights = np.ones((32, 1), dtype=np.float32)
+        >>> database_curvs = {
+        >>>     name: list(rng.rand(rng.randint(1, 4), 32, 2).astype(np.float32))
+        >>>     for name in ['a', 'b', 'c']
+        >>> }
+        >>> query_curvs = list(rng.rand(2, 32, 2).astype(np.float32))
+        >>> simfunc = costs.get_cost_func('dtw-l2', weights=weights, window=4)
+        >>> lower_bound_func = costs.get_lower_bound_func('dtw-l2', weights=weights, window=4)
+        >>> stacked = dtwsw_stack_database(database_curvs, ['a', 'b', 'c'])
+        >>> envelopes = costs.dtw_envelopes(stacked[0], weights, 4)
+        >>> scores, num_pruned = dtwsw_identify_pruned(
+        >>>     query_curvs, ['a', 'b', 'c'], simfunc, lower_bound_func, stacked, envelopes)
+        >>> scores_ = dtwsw_identify(query_curvs, database_curvs, ['a', 'b', 'c'], simfunc)
+        >>> assert scores == scores_
+    """
+    names = list(names)
+    if len(names) == 0:
+        return {}, 0
+    dcurvs, bounds = stacked
+
+    qcurvs = np.ascontiguousarray(np.stack(query_curvs), dtype=np.float32)
+    # (Q, N) lower bounds, the pair (i, j) is query i and database curvature j
+    LB = lower_bound_func(qcurvs, envelopes)
+
+    scores = {}
+    num_pruned = 0
+    for idx, name in enumerate(names):
+        start, stop = bounds[idx], bounds[idx + 1]
+        lower_bounds = LB[:, start:stop].ravel()
+        order = np.argsort(lower_bounds, kind='stable')
+
+        best = np.inf
+        for rank, pair in enumerate(order):
+            if lower_bounds[pair] * (1.0 - slack) > best:
+                num_pruned += len(order) - rank
+                break
+            i, j = divmod(pair, stop - start)
+            cost = simfunc(qcurvs[i], dcurvs[start + j], cutoff=best)
+            best = min(best, cost)
+        scores[name] = np.float32(best)
+
+    return scores, num_pruned
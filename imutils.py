@@ -46,7 +46,58 @@ def refine_segmentation(segm, s):
     return segm_refined
 
 
-def refine_localization(img, mask, M, L, s, height, width):
+def refine_localization(
+    img, mask, M, L, s, height, width, flip=False, compact=False, out=None
+):
+    r"""
+    Warp the full-resolution image to the refined localization, s times the
+    size of the network input
+
+    By default the image and the mask are warped as float32, a mask of None
+    being all 255.  With compact, uint8 images are warped as uint8, the flip
+    is folded into the warp instead of copying img and a mask of None is not
+    warped but filled in from the outline of the image: it is 255 where the
+    sample point is at least one pixel inside the image, so all the pixels
+    used for the interpolation are in the image, and 0 elsewhere.  The
+    outline is also moved in by one refined pixel for the rasterization, so
+    no pixel below 255 in the warped mask is 255 in the filled one.  In
+    exchange, a band about one image pixel plus one refined pixel wide is lost
+    along the border of the warped mask.
+
+    Args:
+        flip (bool): img is the original of a horizontally flipped image
+        compact (bool): warp uint8 images as uint8 and fill in the mask, the
+            outputs round differently than the default float32 ones
+        out (tuple): (loc_refined, mask_refined) buffers to write to, they are
+            used when their shapes and dtypes match the outputs
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.imutils import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> img = rng.randint(0, 256, size=(300, 400, 3)).astype(np.uint8)
+        >>> M = center_pad_with_transform(img, 64, 64)[1]
+        >>> L = np.array([[0.8, 0.1, 0.05], [-0.1, 0.7, 0.0]])
+        >>> loc, msk = refine_localization(img, None, M, L, 4, 64, 64, flip=True)
+        >>> loc_, msk_ = refine_localization(img, None, M, L, 4, 64, 64, flip=True, compact=True)
+        >>> assert loc.dtype == np.float32 and loc_.dtype == np.uint8 and msk_.dtype == np.uint8
+        >>> # the mirrored coordinates only round differently
+        >>> assert np.abs(loc - loc_).max() <= 1
+        >>> assert not np.any((msk_ == 255) & (msk != 255))
+        >>> # the filled outline is inside the warped mask over random transforms
+        >>> for _ in range(50):
+        >>>     shape = rng.randint(40, 400, size=2)
+        >>>     size = rng.randint(16, 64)
+        >>>     M = center_pad_with_transform(np.zeros(shape, dtype=np.uint8), size, size)[1]
+        >>>     theta, zoom = rng.uniform(-0.5, 0.5), rng.uniform(0.3, 1.5)
+        >>>     L = np.array([[zoom * np.cos(theta), -zoom * np.sin(theta), rng.uniform(-0.3, 0.3)],
+        >>>                   [zoom * np.sin(theta), zoom * np.cos(theta), rng.uniform(-0.3, 0.3)]])
+        >>>     args = (np.zeros(shape, dtype=np.uint8), None, M, L, rng.choice([1, 2, 4]), size, size)
+        >>>     flip = rng.rand() < 0.5
+        >>>     msk = refine_localization(*args, flip=flip)[1]
+        >>>     msk_ = refine_localization(*args, flip=flip, compact=True)[1]
+        >>>     assert not np.any((msk_ == 255) & (msk != 255))
+    """
     out_height, out_width = (s * np.ceil((height, width))).astype(np.int32)
 
     T10 = affine.build_downsample_matrix(height, width)
@@ -56,21 +107,68 @@ def refine_localization(img, mask, M, L, s, height, width):
     T70 = affine.build_scale_matrix(s)
 
     T70i = cv2.invertAffineTransform(T70[:2])
-    A = affine.multiply_matrices([T43, T32, T21, T10, T70i])
-
+    matrices = [T43, T32, T21, T10, T70i]
+    if flip and compact:
+        matrices = [affine.build_flip_matrix(img.shape[1])] + matrices
+    elif flip:
+        img = img[:, ::-1]
+        if mask is not None:
+            mask = mask[:, ::-1]
+    A = affine.multiply_matrices(matrices)
+
+    if not compact or img.dtype != np.uint8:
+        img = img.astype(np.float32)
+    loc_out, mask_out = (None, None) if out is None else out
+
+    shape = (out_height, out_width) + img.shape[2:]
+    if loc_out is not None and (loc_out.shape != shape or loc_out.dtype != img.dtype):
+        loc_out = None
     loc_refined = cv2.warpAffine(
-        img.astype(np.float32),
+        img,
         A[:2],
         (out_width, out_height),
+        dst=loc_out,
         flags=cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR,
     )
 
-    mask_refined = cv2.warpAffine(
-        mask.astype(np.float32),
-        A[:2],
-        (out_width, out_height),
-        flags=cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR,
-    )
+    if mask is not None or not compact:
+        if mask is None:
+            mask = np.full(img.shape[0:2], 255, dtype=np.float32)
+        mask_refined = cv2.warpAffine(
+            mask.astype(np.float32),
+            A[:2],
+            (out_width, out_height),
+            flags=cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR,
+        )
+    else:
+        shape = (out_height, out_width)
+        if mask_out is None or mask_out.shape != shape or mask_out.dtype != np.uint8:
+            mask_out = np.empty(shape, dtype=np.uint8)
+        mask_refined = mask_out
+        mask_refined.fill(0)
+
+        # the image corners in the refined localization, as fixed point, moved
+        # in by one image pixel for the interpolation and by one refined pixel
+        # for the rasterization of the outline
+        shift = 8
+        img_height, img_width = img.shape[0:2]
+        dx = 1.0 + abs(A[0, 0]) + abs(A[0, 1])
+        dy = 1.0 + abs(A[1, 0]) + abs(A[1, 1])
+        corners = np.array(
+            [
+                [dx, dy],
+                [img_width - 1.0 - dx, dy],
+                [img_width - 1.0 - dx, img_height - 1.0 - dy],
+                [dx, img_height - 1.0 - dy],
+            ]
+        )
+        if corners[0, 0] < corners[1, 0] and corners[0, 1] < corners[2, 1]:
+            Ai = np.linalg.inv(A)
+            points = affine.transform_points(Ai, corners)
+            points = np.round(points * (1 << shift)).astype(np.int32)
+            cv2.fillConvexPoly(
+                mask_refined, points, 255, lineType=cv2.LINE_8, shift=shift
+            )
 
     return loc_refined, mask_refined
 
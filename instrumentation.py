@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+r"""
+Per-stage timing and memory counters of the CurvRank pipeline
+
+Disabled by default, in which case every hook is a single attribute check.
+Enable it with CURVRANK_INSTRUMENT=1 in the environment or with
+INSTRUMENTATION.enable(), then read the counters back with
+INSTRUMENTATION.to_json() or INSTRUMENTATION.to_prometheus().
+"""
+from __future__ import absolute_import, division, print_function
+from collections import OrderedDict, deque
+from wbia_curvrank.executors import payload_bytes
+import functools
+import threading
+import json
+import time
+import sys
+import os
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+INSTRUMENTATION_MAX_BATCHES = 1024
+INSTRUMENTATION_COUNTERS = (
+    'calls',
+    'items',
+    'failures',
+    'wall_time',
+    'cpu_time',
+    'output_bytes',
+)
+
+
+def peak_rss_bytes():
+    r"""
+    Peak resident set size of this process so far, 0 when it is unknown
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _NullMeasurement(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def update(self, outputs=None, num_items=None, num_failures=None):
+        pass
+
+
+NULL_MEASUREMENT = _NullMeasurement()
+
+
+class Measurement(object):
+    r"""
+    Context manager timing one call of a stage, see Instrumentation.measure
+    """
+
+    def __init__(self, instrumentation, stage, num_items):
+        self.instrumentation = instrumentation
+        self.stage = stage
+        self.num_items = num_items
+        self.num_failures = 0
+        self.output_bytes = 0
+
+    def __enter__(self):
+        self.rss_start = peak_rss_bytes()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record = {
+            'stage': self.stage,
+            'items': self.num_items,
+            # an exception fails the whole call
+            'failures': self.num_items if exc_type is not None else self.num_failures,
+            'wall_time': time.time() - self.wall_start,
+            'cpu_time': time.process_time() - self.cpu_start,
+            'peak_rss_delta': peak_rss_bytes() - self.rss_start,
+            'output_bytes': self.output_bytes,
+        }
+        self.instrumentation.record(record)
+        return False
+
+    def update(self, outputs=None, num_items=None, num_failures=None):
+        if outputs is not None:
+            self.output_bytes += payload_bytes(outputs)
+        if num_items is not None:
+            self.num_items = num_items
+        if num_failures is not None:
+            self.num_failures = num_failures
+
+
+class Instrumentation(object):
+    r"""
+    Wall time, CPU time, item and failure counts, peak RSS growth and the bytes
+    of the arrays produced by each pipeline stage, aggregated per stage and
+    kept per call for the last ``max_batches`` calls
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.instrumentation import *  # NOQA
+        >>> import numpy as np
+        >>> instrumentation = Instrumentation(enabled=True)
+        >>> with instrumentation.measure('preprocessing', 2) as measurement:
+        >>>     measurement.update(outputs=[np.zeros(16, dtype=np.uint8)] * 2)
+        >>> stage = instrumentation.instrument_stage('keypoints', success_index=0)
+        >>> keypoints = stage(lambda num: ([True] * (num - 1) + [False], [None] * num))
+        >>> success_list, _ = keypoints(5)
+        >>> stats = instrumentation.stats()
+        >>> result = [(stage, stats[stage]['items'], stats[stage]['failures'], stats[stage]['output_bytes'])
+        >>>           for stage in stats]
+        >>> print(result)
+        [('preprocessing', 2, 0, 32), ('keypoints', 5, 1, 0)]
+        >>> print(instrumentation.to_prometheus().splitlines()[2])
+        curvrank_stage_calls_total{stage="preprocessing"} 1
+    """
+
+    def __init__(self, enabled=False, max_batches=INSTRUMENTATION_MAX_BATCHES):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.max_batches = max_batches
+        self.reset_stats()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = OrderedDict()
+            self._batches = deque(maxlen=self.max_batches)
+
+    def measure(self, stage, num_items=0):
+        r"""
+        Returns a context manager timing the enclosed call of stage, its update
+        method sets the outputs, item count and failure count of the call
+        """
+        if not self.enabled:
+            return NULL_MEASUREMENT
+        return Measurement(self, stage, num_items)
+
+    def instrument_stage(self, stage, success_index=None):
+        r"""
+        Decorator for a stage returning a tuple of per-item lists, the length
+        of the first list is the item count and the False values of
+        result[success_index] are the failures
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.measure(stage) as measurement:
+                    result = func(*args, **kwargs)
+                    num_failures = None
+                    if success_index is not None:
+                        num_failures = sum(
+                            not success for success in result[success_index]
+                        )
+                    measurement.update(result, len(result[0]), num_failures)
+                return result
+
+            return wrapper
+
+        return decorator
+
+    def record(self, record):
+        with self._lock:
+            self._batches.append(record)
+            entry = self._stats.get(record['stage'], None)
+            if entry is None:
+                entry = {key: 0 for key in INSTRUMENTATION_COUNTERS}
+                entry['peak_rss_delta'] = 0
+                self._stats[record['stage']] = entry
+            entry['calls'] += 1
+            for key in INSTRUMENTATION_COUNTERS[1:]:
+                entry[key] += record[key]
+            entry['peak_rss_delta'] = max(
+                entry['peak_rss_delta'], record['peak_rss_delta']
+            )
+
+    def stats(self):
+        with self._lock:
+            stats = OrderedDict(
+                (stage, dict(entry)) for stage, entry in self._stats.items()
+            )
+        return stats
+
+    def batches(self):
+        with self._lock:
+            return list(self._batches)
+
+    def to_json(self, indent=None, include_batches=False):
+        snapshot = {'timestamp': time.time(), 'stages': self.stats()}
+        if include_batches:
+            snapshot['batches'] = self.batches()
+        return json.dumps(snapshot, indent=indent)
+
+    def to_prometheus(self, prefix='curvrank_stage'):
+        r"""
+        Prometheus text exposition format snapshot of the per-stage counters
+        """
+        metrics = [
+            ('calls', 'counter', '_total', 'Number of calls'),
+            ('items', 'counter', '_total', 'Number of items processed'),
+            ('failures', 'counter', '_total', 'Number of items that failed'),
+            ('wall_time', 'counter', '_seconds_total', 'Wall clock time'),
+            ('cpu_time', 'counter', '_seconds_total', 'Process CPU time'),
+            ('output_bytes', 'counter', '_total', 'Bytes of arrays produced'),
+            ('peak_rss_delta', 'gauge', '_bytes', 'Largest peak RSS growth of a call'),
+        ]
+        stats = self.stats()
+        lines = []
+        for key, kind, suffix, help_ in metrics:
+            name = '%s_%s%s' % (prefix, key, suffix)
+            lines.append('# HELP %s %s' % (name, help_))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for stage, entry in stats.items():
+                lines.append('%s{stage="%s"} %r' % (name, stage, entry[key]))
+        return '\n'.join(lines) + '\n'
+
+
+INSTRUMENTATION = Instrumentation(
+    enabled=os.environ.get('CURVRANK_INSTRUMENT', '0').lower() in ('1', 'true')
+)
+instrument_stage = INSTRUMENTATION.instrument_stage
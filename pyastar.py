@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 import ctypes
+import threading
 import numpy as np
 from os.path import split, abspath, join
 
@@ -24,39 +25,101 @@ astar.argtypes = [
     ndmat_i_type,
 ]
 
+astar_path_ = lib.astar_path
+grid_f_type = np.ctypeslib.ndpointer(dtype=np.float32, flags='C_CONTIGUOUS')
+grid_u_type = np.ctypeslib.ndpointer(dtype=np.uint8, flags='C_CONTIGUOUS')
+grid_i_type = np.ctypeslib.ndpointer(dtype=np.int32, flags='C_CONTIGUOUS')
+astar_path_.restype = ctypes.c_int
+astar_path_.argtypes = [
+    grid_f_type,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_bool,
+    grid_f_type,
+    grid_i_type,
+    grid_u_type,
+    grid_i_type,
+    ctypes.POINTER(ctypes.c_long),
+]
+
+
+_local = threading.local()
+
 
-def astar_path(weights, start, goal, allow_diagonal=False):
+def get_buffers(size):
+    r"""
+    Scratch buffers for a grid of size nodes, owned by the calling thread
+
+    The buffers only grow, so repeated searches on grids of the same (or a
+    smaller) size do not allocate.
+    """
+    buffers = getattr(_local, 'buffers', None)
+    if buffers is None or buffers[0].shape[0] < size:
+        buffers = (
+            np.empty(size, dtype=np.float32),  # costs
+            np.empty(size, dtype=np.int32),  # paths
+            np.empty(size, dtype=np.uint8),  # closed
+            np.empty((size, 2), dtype=np.int32),  # path
+        )
+        _local.buffers = buffers
+    return buffers
+
+
+def astar_path(weights, start, goal, allow_diagonal=False, return_expanded=False):
+    r"""
+    Args:
+        weights (np.ndarray): h x w grid of costs, at least 1.0; float32 C-contiguous
+            grids are searched in place
+        start (tuple): (i, j) of the start of the path
+        goal (tuple): (i, j) of the end of the path
+        return_expanded (bool): also return the number of nodes expanded
+
+    Returns:
+        path (np.ndarray): (n, 2) ij points from start to goal, or an empty array
+            if there is no path
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.pyastar import *  # NOQA
+        >>> weights = np.ones((4, 5), dtype=np.float32)
+        >>> weights[1:, 2] = 10.0
+        >>> path, expanded = astar_path(weights, (3, 0), (3, 4), return_expanded=True)
+        >>> print(path.tolist())
+        [[3, 0], [3, 1], [2, 1], [1, 1], [0, 1], [0, 2], [0, 3], [0, 4], [1, 4], [2, 4], [3, 4]]
+    """
     assert weights.min(axis=None) >= 1.0, 'weights.min() = %.2f != 1' % weights.min(
         axis=None
     )
+    weights = np.ascontiguousarray(weights, dtype=np.float32)
     height, width = weights.shape
     start_idx = np.ravel_multi_index(start, (height, width))
     goal_idx = np.ravel_multi_index(goal, (height, width))
 
-    # The C++ code writes the solution to the paths array
-    paths = np.full(height * width, -1, dtype=np.int32)
-    success = astar(
-        weights.flatten(),
+    # The C++ code writes the solution to the path buffer
+    costs, paths, closed, path = get_buffers(height * width)
+    expanded = ctypes.c_long(0)
+    length = astar_path_(
+        weights,
         height,
         width,
         start_idx,
         goal_idx,
         allow_diagonal,
-        paths,  # output parameter
+        costs,
+        paths,
+        closed,
+        path,  # output parameter
+        ctypes.byref(expanded),  # output parameter
     )
-    if not success:
-        return np.array([])
-
-    coordinates = []
-    path_idx = goal_idx
-    while path_idx != start_idx:
-        pi, pj = np.unravel_index(path_idx, (height, width))
-        coordinates.append((pi, pj))
 
-        path_idx = paths[path_idx]
-
-    if coordinates:
-        coordinates.append(np.unravel_index(start_idx, (height, width)))
-        return np.vstack(coordinates[::-1])
+    if length > 0:
+        # Copy out of the reused buffer
+        path = path[:length].astype(np.intp)
     else:
-        return np.array([])
+        path = np.array([])
+
+    if return_expanded:
+        return path, expanded.value
+    return path
@@ -14,9 +14,10 @@ ndmat_f_type = np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags='C_CONTIGU
 ndmat_i_type = np.ctypeslib.ndpointer(dtype=np.int32, ndim=2, flags='C_CONTIGUOUS')
 
 
-dtw_chi_square_cpp = costs_lib.weighted_chi_square
-dtw_weighted_euclidean_cpp = costs_lib.weighted_euclidean
+dtw_chi_square_cpp = costs_lib.weighted_chi_square_banded
+dtw_weighted_euclidean_cpp = costs_lib.weighted_euclidean_banded
 
+dtw_chi_square_cpp.restype = ctypes.c_float
 dtw_chi_square_cpp.argtypes = [
     ndmat_f_type,
     ndmat_f_type,
@@ -24,9 +25,10 @@ dtw_chi_square_cpp.argtypes = [
     ctypes.c_int,
     ctypes.c_int,
     ctypes.c_int,
-    ndmat_f_type,
+    ctypes.c_float,
 ]
 
+dtw_weighted_euclidean_cpp.restype = ctypes.c_float
 dtw_weighted_euclidean_cpp.argtypes = [
     ndmat_f_type,
     ndmat_f_type,
@@ -34,11 +36,51 @@ dtw_weighted_euclidean_cpp.argtypes = [
     ctypes.c_int,
     ctypes.c_int,
     ctypes.c_int,
+    ctypes.c_float,
+]
+
+
+ndarr_f_type = np.ctypeslib.ndpointer(dtype=np.float32, flags='C_CONTIGUOUS')
+
+dtw_chi_square_batch_cpp = costs_lib.weighted_chi_square_banded_batch
+dtw_weighted_euclidean_batch_cpp = costs_lib.weighted_euclidean_banded_batch
+
+dtw_chi_square_batch_cpp.argtypes = [
+    ndarr_f_type,
+    ndarr_f_type,
+    ndmat_f_type,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_float,
+    ctypes.c_int,
     ndmat_f_type,
 ]
 
+dtw_weighted_euclidean_batch_cpp.argtypes = [
+    ndarr_f_type,
+    ndarr_f_type,
+    ndmat_f_type,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_float,
+    ctypes.c_int,
+    ndmat_f_type,
+]
+
+
+def dtw_weighted_chi_square(qcurv, dcurv, weights, window, cutoff=np.inf):
+    r"""
+    Weighted chi-square DTW cost, constrained to a Sakoe-Chiba band of width window
 
-def dtw_weighted_chi_square(qcurv, dcurv, weights, window):
+    The C++ kernel only keeps two rows of the band.  If every cell of a row of
+    the cost matrix exceeds cutoff the comparison is abandoned and inf returned.
+    """
     assert qcurv.dtype == np.float32, 'qcurv.dtype = %s' % qcurv.dtype
     assert dcurv.dtype == np.float32, 'dcurv.dtype = %s' % dcurv.dtype
     assert weights.dtype == np.float32, 'weights.dtype = %s' % weights.dtype
@@ -50,14 +92,30 @@ def dtw_weighted_chi_square(qcurv, dcurv, weights, window):
     assert qcurv.ndim == dcurv.ndim == weights.ndim == 2
 
     m, n = qcurv.shape
-    costs_out = np.full((m, m), np.inf, dtype=np.float32)
-    costs_out[0, 0] = 0.0
-    dtw_chi_square_cpp(qcurv, dcurv, weights, m, n, window, costs_out)
-
-    return costs_out[-1, -1]
-
-
-def dtw_weighted_euclidean(qcurv, dcurv, weights, window):
+    cost = dtw_chi_square_cpp(qcurv, dcurv, weights, m, n, window, cutoff)
+
+    return np.float32(cost)
+
+
+def dtw_weighted_euclidean(qcurv, dcurv, weights, window, cutoff=np.inf):
+    r"""
+    Weighted euclidean DTW cost, constrained to a Sakoe-Chiba band of width window
+
+    The C++ kernel only keeps two rows of the band.  If every cell of a row of
+    the cost matrix exceeds cutoff the comparison is abandoned and inf returned.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.pydtw import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> qcurv = rng.rand(64, 2).astype(np.float32)
+        >>> dcurv = rng.rand(64, 2).astype(np.float32)
+        >>> weights = np.ones((64, 1), dtype=np.float32)
+        >>> cost = dtw_weighted_euclidean(qcurv, dcurv, weights, 8)
+        >>> assert dtw_weighted_euclidean(qcurv, qcurv, weights, 8) == 0.0
+        >>> assert dtw_weighted_euclidean(qcurv, dcurv, weights, 8, cutoff=cost) == cost
+        >>> assert dtw_weighted_euclidean(qcurv, dcurv, weights, 8, cutoff=cost / 2) == np.inf
+    """
     assert qcurv.dtype == np.float32, 'qcurv.dtype = %s' % qcurv.dtype
     assert dcurv.dtype == np.float32, 'dcurv.dtype = %s' % dcurv.dtype
     assert weights.dtype == np.float32, 'weights.dtype = %s' % weights.dtype
@@ -69,8 +127,100 @@ def dtw_weighted_euclidean(qcurv, dcurv, weights, window):
     assert qcurv.ndim == dcurv.ndim == weights.ndim == 2
 
     m, n = qcurv.shape
-    costs_out = np.full((m, m), np.inf, dtype=np.float32)
-    costs_out[0, 0] = 0.0
-    dtw_weighted_euclidean_cpp(qcurv, dcurv, weights, m, n, window, costs_out)
+    cost = dtw_weighted_euclidean_cpp(qcurv, dcurv, weights, m, n, window, cutoff)
+
+    return np.float32(cost)
 
-    return costs_out[-1, -1]
+
+def _dtw_batch(batch_func, qcurvs, dcurvs, weights, window, cutoff, num_threads):
+    assert qcurvs.dtype == np.float32, 'qcurvs.dtype = %s' % qcurvs.dtype
+    assert dcurvs.dtype == np.float32, 'dcurvs.dtype = %s' % dcurvs.dtype
+    assert weights.dtype == np.float32, 'weights.dtype = %s' % weights.dtype
+    assert weights.flags.c_contiguous
+    assert qcurvs.ndim in (2, 3)
+    assert dcurvs.ndim == 3 and weights.ndim == 2
+    assert qcurvs.shape[-2:] == dcurvs.shape[1:]
+    assert dcurvs.shape[1] == weights.shape[0]
+
+    single = qcurvs.ndim == 2
+    qcurvs = np.ascontiguousarray(qcurvs.reshape((-1,) + dcurvs.shape[1:]))
+    dcurvs = np.ascontiguousarray(dcurvs)
+
+    num_q, num_d = qcurvs.shape[0], dcurvs.shape[0]
+    _, m, n = dcurvs.shape
+    costs_out = np.empty((num_q, num_d), dtype=np.float32)
+    if num_q > 0 and num_d > 0:
+        batch_func(
+            qcurvs,
+            dcurvs,
+            weights,
+            num_q,
+            num_d,
+            m,
+            n,
+            window,
+            cutoff,
+            num_threads,
+            costs_out,
+        )
+
+    return costs_out[0] if single else costs_out
+
+
+def dtw_weighted_chi_square_batch(
+    qcurvs, dcurvs, weights, window, cutoff=np.inf, num_threads=1
+):
+    r"""
+    dtw_weighted_chi_square of every query curve against every database curve
+
+    Args:
+        qcurvs (np.ndarray): one (m, n) query curve or a stack of (Q, m, n)
+        dcurvs (np.ndarray): stack of (N, m, n) database curves
+        num_threads (int): OpenMP threads used for the comparisons
+
+    Returns:
+        costs (np.ndarray): (N,) costs for a single query curve, (Q, N) otherwise
+    """
+    return _dtw_batch(
+        dtw_chi_square_batch_cpp, qcurvs, dcurvs, weights, window, cutoff, num_threads
+    )
+
+
+def dtw_weighted_euclidean_batch(
+    qcurvs, dcurvs, weights, window, cutoff=np.inf, num_threads=1
+):
+    r"""
+    dtw_weighted_euclidean of every query curve against every database curve
+
+    Args:
+        qcurvs (np.ndarray): one (m, n) query curve or a stack of (Q, m, n)
+        dcurvs (np.ndarray): stack of (N, m, n) database curves
+        num_threads (int): OpenMP threads used for the comparisons
+
+    Returns:
+        costs (np.ndarray): (N,) costs for a single query curve, (Q, N) otherwise
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.pydtw import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> qcurvs = rng.rand(3, 64, 2).astype(np.float32)
+        >>> dcurvs = rng.rand(5, 64, 2).astype(np.float32)
+        >>> weights = np.ones((64, 1), dtype=np.float32)
+        >>> costs = dtw_weighted_euclidean_batch(qcurvs, dcurvs, weights, 8)
+        >>> costs_ = [
+        >>>     [dtw_weighted_euclidean(qcurv, dcurv, weights, 8) for dcurv in dcurvs]
+        >>>     for qcurv in qcurvs
+        >>> ]
+        >>> assert np.all(costs == np.array(costs_))
+        >>> assert np.all(dtw_weighted_euclidean_batch(qcurvs[0], dcurvs, weights, 8) == costs[0])
+    """
+    return _dtw_batch(
+        dtw_weighted_euclidean_batch_cpp,
+        qcurvs,
+        dcurvs,
+        weights,
+        window,
+        cutoff,
+        num_threads,
+    )
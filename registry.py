@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+from collections import OrderedDict
+import threading
+import annoy
+import hashlib
+import time
+import os
+
+
+MODEL_REGISTRY_CAPACITY = 8
+INDEX_REGISTRY_CAPACITY = 16
+
+
+def hash_file(fpath, blocksize=2 ** 20):
+    hasher = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class ModelRegistry(object):
+    r"""
+    Process-wide cache of compiled inference functions
+
+    Building the Lasagne graph, loading the weights and compiling the Theano
+    function takes far longer than running a depc chunk through the network,
+    so each network is compiled once per process and shared by every later
+    call.  Entries are keyed on (model_type, model_tag, height, width,
+    weights hash) and evicted in least-recently-used order once more than
+    ``capacity`` networks are held.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.registry import *  # NOQA
+        >>> import tempfile
+        >>> registry = ModelRegistry(capacity=1)
+        >>> with tempfile.NamedTemporaryFile() as weights:
+        >>>     build_func = lambda height, width, fpath: (height, width)
+        >>>     func1 = registry.get('dorsal', 'localization', 256, 256, weights.name, build_func)
+        >>>     func2 = registry.get('dorsal', 'localization', 256, 256, weights.name, build_func)
+        >>>     func3 = registry.get('fluke', 'segmentation', 192, 384, weights.name, build_func)
+        >>> stats = registry.stats()
+        >>> result = (stats['hits'], stats['misses'], stats['evictions'], stats['size'])
+        >>> print(result)
+        (1, 2, 1, 1)
+    """
+
+    def __init__(self, capacity=MODEL_REGISTRY_CAPACITY):
+        self.capacity = capacity
+        self._cache = OrderedDict()
+        self._hashes = {}
+        self._lock = threading.RLock()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.compile_time = 0.0
+            self.compile_times = {}
+
+    def weights_hash(self, weight_filepath):
+        # Hashing the weights is cheap compared to a compile, but it is still a
+        # full read of the file, so memoize on its modification time and size
+        stat = os.stat(weight_filepath)
+        memo_key = (os.path.realpath(weight_filepath), stat.st_mtime, stat.st_size)
+        with self._lock:
+            weights_hash = self._hashes.get(memo_key, None)
+            if weights_hash is None:
+                weights_hash = hash_file(weight_filepath)
+                self._hashes[memo_key] = weights_hash
+        return weights_hash
+
+    def key(self, model_type, model_tag, height, width, weight_filepath):
+        weights_hash = self.weights_hash(weight_filepath)
+        return (model_type, model_tag, int(height), int(width), weights_hash)
+
+    def get(self, model_type, model_tag, height, width, weight_filepath, build_func):
+        key = self.key(model_type, model_tag, height, width, weight_filepath)
+        # Compile while holding the lock so that two threads asking for the same
+        # network do not both pay for the compilation
+        with self._lock:
+            if key in self._cache:
+                func = self._cache.pop(key)
+                self._cache[key] = func
+                self.hits += 1
+                return func
+
+            self.misses += 1
+            start = time.time()
+            func = build_func(height, width, weight_filepath)
+            duration = time.time() - start
+            self.compile_time += duration
+            self.compile_times[key] = self.compile_times.get(key, 0.0) + duration
+
+            self._cache[key] = func
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+        return func
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'capacity': self.capacity,
+                'size': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'compile_time': self.compile_time,
+                'compile_times': {
+                    '%s:%s:%dx%d:%s' % key: duration
+                    for key, duration in self.compile_times.items()
+                },
+                'keys': list(self._cache.keys()),
+            }
+        return stats
+
+
+class IndexRegistry(object):
+    r"""
+    Process-wide cache of loaded Annoy indices
+
+    Loading an index mmaps the file, so loaded indices can be shared by every
+    query and thread in the process.  Each entry remembers the inode, size and
+    modification time of its file, and the index is reloaded when the cache
+    directory is swapped for a rebuilt one.  The least-recently-used index is
+    dropped once more than ``capacity`` indices are held.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.registry import *  # NOQA
+        >>> import tempfile
+        >>> from os.path import join
+        >>> registry = IndexRegistry()
+        >>> index = annoy.AnnoyIndex(2, metric='euclidean')
+        >>> index.add_item(0, [0.0, 1.0])
+        >>> index.add_item(1, [1.0, 0.0])
+        >>> index.build(1)
+        >>> with tempfile.TemporaryDirectory() as dpath:
+        >>>     fpath = join(dpath, 'index.ann')
+        >>>     index.save(fpath)
+        >>>     index_ = registry.get(fpath, 2)
+        >>>     assert registry.get(fpath, 2) is index_
+        >>>     assert index_.get_nns_by_vector([0.0, 0.9], 1) == [0]
+        >>> stats = registry.stats()
+        >>> result = (stats['loads'], stats['hits'], stats['reloads'])
+        >>> print(result)
+        (1, 1, 0)
+    """
+
+    def __init__(self, capacity=INDEX_REGISTRY_CAPACITY, metric='euclidean'):
+        self.capacity = capacity
+        self.metric = metric
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.loads = 0
+            self.reloads = 0
+            self.evictions = 0
+            self.load_time = 0.0
+
+    def get(self, index_fpath, fdim):
+        index_fpath = os.path.realpath(index_fpath)
+        stat = os.stat(index_fpath)
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+        key = (index_fpath, fdim)
+
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None:
+                signature_, index = entry
+                if signature_ == signature:
+                    self._cache[key] = entry
+                    self.hits += 1
+                    return index
+                # The index was rebuilt and swapped in, queries that still hold the
+                # old index keep their (unlinked) mmap until they are done with it
+                self.reloads += 1
+
+            start = time.time()
+            index = annoy.AnnoyIndex(fdim, self.metric)
+            index.load(index_fpath)
+            self.load_time += time.time() - start
+            self.loads += 1
+
+            self._cache[key] = (signature, index)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+        return index
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.loads
+            stats = {
+                'capacity': self.capacity,
+                'size': len(self._cache),
+                'hits': self.hits,
+                'loads': self.loads,
+                'reloads': self.reloads,
+                'evictions': self.evictions,
+                'load_time': self.load_time,
+                'mean_load_time': self.load_time / max(1, self.loads),
+                'reuse_rate': self.hits / max(1, requests),
+                'keys': list(self._cache.keys()),
+            }
+        return stats
+
+
+MODEL_REGISTRY = ModelRegistry()
+INDEX_REGISTRY = IndexRegistry()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 from wbia_curvrank import costs, datasets, model
+from wbia_curvrank.curvature_store import CurvatureStore, CURVATURE_STORE_CHUNKSIZE
 import cv2
 import h5py
 import pandas as pd
@@ -8,6 +9,9 @@ import luigi
 import logging
 import multiprocessing as mp
 import numpy as np
+import os
+import shutil
+import tempfile
 
 from collections import defaultdict
 from functools import partial
@@ -923,6 +927,91 @@ class BlockCurvature(luigi.Task):
         logger.info('%s completed in %.3fs' % (self.__class__.__name__, t_end - t_start))
 
 
+@inherits(PrepareData)
+@inherits(BlockCurvature)
+class ConsolidateCurvature(luigi.Task):
+    curv_length = luigi.IntParameter(
+        default=128,
+        description='Number of spatial points in curvature ' 'vectors after resampling.',
+    )
+
+    def requires(self):
+        return {
+            'PrepareData': self.clone(PrepareData),
+            'BlockCurvature': self.clone(BlockCurvature),
+        }
+
+    def get_incomplete(self):
+        input_filepaths = self.requires()['PrepareData'].get_input_list()
+        fpaths = [fpath for fpath, _, _, _ in input_filepaths]
+
+        # an image is incomplete if it has not been appended to the archive yet
+        target = self.output()['curvature']
+        if target.exists():
+            with CurvatureStore(target.path, mode='r') as store:
+                to_process = [fpath for fpath in fpaths if fpath not in store]
+        else:
+            to_process = fpaths
+
+        logger.info(
+            '%s has %d of %d images to process'
+            % (self.__class__.__name__, len(to_process), len(input_filepaths))
+        )
+
+        return to_process
+
+    def complete(self):
+        to_process = self.get_incomplete()
+        return not bool(to_process)
+
+    def output(self):
+        basedir = join('data', self.dataset, self.__class__.__name__)
+        curvdir = ','.join(['%.3f' % s for s in self.curv_scales])
+        return {
+            'curvature': HDF5LocalTarget(
+                join(basedir, curvdir, '%d.h5py' % self.curv_length)
+            ),
+        }
+
+    def run(self):
+        import dorsal_utils
+
+        t_start = time()
+        curv_targets = self.requires()['BlockCurvature'].output()
+        output = self.output()['curvature']
+        to_process = self.get_incomplete()
+
+        output.makedirs()
+        with CurvatureStore(
+            output.path, scales=self.curv_scales, curv_length=self.curv_length
+        ) as store:
+            # append in chunks so that the archive is never more than one chunk
+            # behind the per-image files
+            for start in tqdm(
+                range(0, len(to_process), CURVATURE_STORE_CHUNKSIZE), leave=False
+            ):
+                fpaths = to_process[start : start + CURVATURE_STORE_CHUNKSIZE]
+                curvs = []
+                for fpath in fpaths:
+                    target = curv_targets[fpath]['curvature']
+                    # each per-image file is opened once, both to find the
+                    # failed images and to read the curvatures
+                    with target.open('r') as h5f:
+                        # empty datasets are written for failed images
+                        if any(h5f[key].shape is None for key in h5f.keys()):
+                            curvs.append(None)
+                        else:
+                            curvs.append(
+                                dorsal_utils.load_curv_mat_from_h5f(
+                                    h5f, self.curv_scales, self.curv_length
+                                )
+                            )
+                store.append(fpaths, curvs)
+
+        t_end = time()
+        logger.info('%s completed in %.3fs' % (self.__class__.__name__, t_end - t_start))
+
+
 @inherits(PrepareData)
 @inherits(SeparateEdges)
 class SeparateDatabaseQueries(luigi.Task):
@@ -1434,16 +1523,12 @@ class DescriptorsId(luigi.Task):
 
 
 @inherits(PrepareData)
-@inherits(BlockCurvature)
+@inherits(ConsolidateCurvature)
 @inherits(SeparateDatabaseQueries)
 class TimeWarpingId(luigi.Task):
     window = luigi.IntParameter(
         default=8, description='Sakoe-Chiba bound for time-warping alignment.'
     )
-    curv_length = luigi.IntParameter(
-        default=128,
-        description='Number of spatial points in curvature ' 'vectors after resampling.',
-    )
     serial = luigi.BoolParameter(default=False)
     cost_func = luigi.ChoiceParameter(
         choices=costs.get_cost_func_dict().keys(),
@@ -1451,11 +1536,18 @@ class TimeWarpingId(luigi.Task):
         description='Function to compute similarity of two curvature vectors.',
     )
     spatial_weights = luigi.BoolParameter(default=False)
+    dtw_threads = luigi.IntParameter(
+        default=1, description='Threads used by each batched time-warping call.'
+    )
+    prune = luigi.BoolParameter(
+        default=False,
+        description='Skip alignments ruled out by LB_Kim/LB_Keogh lower bounds.',
+    )
 
     def requires(self):
         return {
             'PrepareData': self.clone(PrepareData),
-            'BlockCurvature': self.clone(BlockCurvature),
+            'ConsolidateCurvature': self.clone(ConsolidateCurvature),
             'SeparateDatabaseQueries': self.clone(SeparateDatabaseQueries),
         }
 
@@ -1482,23 +1574,25 @@ class TimeWarpingId(luigi.Task):
         to_process = self.get_incomplete()
         return not bool(to_process)
 
-    def output(self):
+    def output_dir(self, run_idx):
         basedir = join('data', self.dataset, self.__class__.__name__)
         curvdir = ','.join(['%.3f' % s for s in self.curv_scales])
         curvdir = join(self.cost_func, curvdir)
         weightdir = 'weighted' if self.spatial_weights else 'uniform'
+        return join(
+            basedir,
+            self.eval_dir,
+            weightdir,
+            curvdir,
+            '%s' % self.num_db_encounters,
+            '%s' % run_idx,
+        )
 
+    def output(self):
         db_qr_target = self.requires()['SeparateDatabaseQueries']
         output = {}
         for i in range(self.runs):
-            outdir = join(
-                basedir,
-                self.eval_dir,
-                weightdir,
-                curvdir,
-                '%s' % self.num_db_encounters,
-                '%s' % i,
-            )
+            outdir = self.output_dir(i)
             qr_fpath_dict_target = db_qr_target.output()['queries'][i]
             if not qr_fpath_dict_target.exists():
                 self.requires()['SeparateDatabaseQueries'].run()
@@ -1520,73 +1614,47 @@ class TimeWarpingId(luigi.Task):
         return output
 
     def run(self):
-        import dorsal_utils
-        from scipy.interpolate import BPoly
-        from workers import identify_encounter_star
+        from workers import init_identify_pool, identify_encounter_shared
+        from workers import IDENTIFY_POOL_STATE
+        from workers import save_identify_arrays
+        import wbia_curvrank.functional as F
 
-        curv_targets = self.requires()['BlockCurvature'].output()
+        curv_target = self.requires()['ConsolidateCurvature'].output()['curvature']
         db_qr_target = self.requires()['SeparateDatabaseQueries']
         db_targets = db_qr_target.output()['database']
         qr_targets = db_qr_target.output()['queries']
 
-        # coefficients for the sum of polynomials
-        # coeffs for the SDRP Bottlenose dataset
-        if self.dataset in ('sdrp', 'nz'):
-            coeffs = np.array(
-                [
-                    0.0960,
-                    0.6537,
-                    1.0000,
-                    0.7943,
-                    1.0000,
-                    0.3584,
-                    0.4492,
-                    0.0000,
-                    0.4157,
-                    0.0626,
-                ]
-            )
-        # coeffs for the CRC Humpback dataset
-        elif self.dataset in ('crc', 'fb'):
-            coeffs = np.array(
-                [
-                    0.0944,
-                    0.5629,
-                    0.7286,
-                    0.6028,
-                    0.0000,
-                    0.0434,
-                    0.6906,
-                    0.7316,
-                    0.4671,
-                    0.0258,
-                ]
-            )
-        coeffs = coeffs.reshape(coeffs.shape[0], 1)
-
-        def bernstein_poly(x, coeffs):
-            interval = np.array([0, 1])
-            f = BPoly(coeffs, interval, extrapolate=False)
-
-            return f(x)
-
-        if self.spatial_weights:
-            # coefficients to weights on the interval [0, 1]
-            weights = bernstein_poly(np.linspace(0, 1, self.curv_length), coeffs)
-        else:
-            weights = np.ones(self.curv_length, dtype=np.float32)
-        weights = weights.reshape(-1, 1).astype(np.float32)
+        # the weights and cost functions are built once per process, tasks only
+        # carry handles to them
+        weights = costs.COST_FUNC_REGISTRY.weights(
+            self.dataset, self.curv_length, self.spatial_weights
+        )
+        func_args = (self.cost_func, self.dataset, self.curv_length, self.spatial_weights)
 
-        # set the appropriate distance measure for time-warping alignment
-        cost_func = costs.get_cost_func(
-            self.cost_func, weights=weights, window=self.window
+        # set the appropriate distance measure for time-warping alignment, every
+        # query curvature of an encounter is compared with the whole database at once
+        cost_func = costs.CostFuncHandle(
+            'batch', *func_args, window=self.window, num_threads=self.dtw_threads
         )
+        # pruning aligns the pairs one by one, in order of their lower bounds
+        prune = self.prune and self.cost_func in costs.get_lower_bound_func_dict()
+        if prune:
+            simfunc = costs.CostFuncHandle('pairwise', *func_args, window=self.window)
+            lower_bound_func = costs.CostFuncHandle(
+                'lower_bound', *func_args, window=self.window
+            )
 
         t_start = time()
         logger.info(
             'Using cost function = %s and spatial weights = %s'
             % (self.cost_func, self.spatial_weights)
         )
+        store = CurvatureStore(
+            curv_target.path,
+            scales=self.curv_scales,
+            curv_length=self.curv_length,
+            mode='r',
+        )
         for run_idx, (db_target, qr_target) in enumerate(zip(db_targets, qr_targets)):
             with db_target.open('rb') as f:
                 db_fpath_dict = pickle.load(f, encoding='latin1')
@@ -1599,16 +1667,14 @@ class TimeWarpingId(luigi.Task):
                 'Loading %d curv vectors for %d database individuals'
                 % (num_db_curvs, len(db_fpath_dict))
             )
-            for dind in tqdm(db_fpath_dict, leave=False):
-                if dind not in db_curv_dict:
-                    db_curv_dict[dind] = []
-                for fpath in db_fpath_dict[dind]:
-                    curv_matrix = dorsal_utils.load_curv_mat_from_h5py(
-                        curv_targets[fpath]['curvature'],
-                        self.curv_scales,
-                        self.curv_length,
-                    )
-                    db_curv_dict[dind].append(curv_matrix)
+            # read all curvatures of the split at once, then hand out the rows
+            db_fpaths = [fpath for dind in db_fpath_dict for fpath in db_fpath_dict[dind]]
+            db_curvs, _ = store.get(db_fpaths)
+            offset = 0
+            for dind in db_fpath_dict:
+                count = len(db_fpath_dict[dind])
+                db_curv_dict[dind] = list(db_curvs[offset : offset + count])
+                offset += count
 
             qr_curv_dict = {}
             num_qr_curvs = np.sum(
@@ -1622,19 +1688,20 @@ class TimeWarpingId(luigi.Task):
                 'Loading %d curv vectors for %d query individuals'
                 % (num_qr_curvs, len(qr_fpath_dict))
             )
-            for qind in tqdm(qr_fpath_dict, leave=False):
-                if qind not in qr_curv_dict:
-                    qr_curv_dict[qind] = {}
+            qr_fpaths = [
+                fpath
+                for qind in qr_fpath_dict
+                for qenc in qr_fpath_dict[qind]
+                for fpath in qr_fpath_dict[qind][qenc]
+            ]
+            qr_curvs, _ = store.get(qr_fpaths)
+            offset = 0
+            for qind in qr_fpath_dict:
+                qr_curv_dict[qind] = {}
                 for qenc in qr_fpath_dict[qind]:
-                    if qenc not in qr_curv_dict[qind]:
-                        qr_curv_dict[qind][qenc] = []
-                    for fpath in qr_fpath_dict[qind][qenc]:
-                        curv_matrix = dorsal_utils.load_curv_mat_from_h5py(
-                            curv_targets[fpath]['curvature'],
-                            self.curv_scales,
-                            self.curv_length,
-                        )
-                        qr_curv_dict[qind][qenc].append(curv_matrix)
+                    count = len(qr_fpath_dict[qind][qenc])
+                    qr_curv_dict[qind][qenc] = list(qr_curvs[offset : offset + count])
+                    offset += count
 
             db_curvs_list = [len(db_curv_dict[ind]) for ind in db_curv_dict]
             qr_curvs_list = []
@@ -1660,24 +1727,61 @@ class TimeWarpingId(luigi.Task):
                 )
             )
             output = self.output()[run_idx]
-            partial_identify_encounters = partial(
-                identify_encounter_star,
-                qr_curv_dict=qr_curv_dict,
-                db_curv_dict=db_curv_dict,
-                simfunc=cost_func,
-                output_targets=output,
-            )
+            db_names = list(db_curv_dict.keys())
+            db_stacked = F.dtwsw_stack_database(db_curv_dict, db_names)
+            db_envelopes = None
+            if prune:
+                db_envelopes = costs.dtw_envelopes(db_stacked[0], weights, self.window)
+
+            # workers memory-map the packed curvatures instead of receiving them
+            # with every task, the files are kept next to the results of the run
+            # rather than in a possibly small system temp directory
+            outdir = self.output_dir(run_idx)
+            if not exists(outdir):
+                os.makedirs(outdir)
+            store_dpath = tempfile.mkdtemp(dir=outdir, prefix='.identify-')
+            try:
+                qr_index = save_identify_arrays(
+                    store_dpath, db_stacked, qr_curv_dict, to_process, db_envelopes
+                )
+                # the workers only need the store
+                del db_curv_dict, qr_curv_dict, db_stacked, db_envelopes
+                initargs = (store_dpath, qr_index, db_names, output)
+                if prune:
+                    initargs += (None, simfunc, lower_bound_func)
+                else:
+                    initargs += (cost_func,)
 
-            if self.serial:
-                for qind, qenc in tqdm(to_process, total=len(qindivs), leave=False):
-                    partial_identify_encounters((qind, qenc))
-            else:
-                try:
-                    pool = mp.Pool(processes=None)
-                    pool.map(partial_identify_encounters, to_process)
-                finally:
-                    pool.close()
-                    pool.join()
+                if self.serial:
+                    init_identify_pool(*initargs)
+                    results = []
+                    for qind, qenc in tqdm(to_process, total=len(qindivs), leave=False):
+                        results.append(identify_encounter_shared((qind, qenc)))
+                else:
+                    try:
+                        pool = mp.Pool(
+                            processes=None,
+                            initializer=init_identify_pool,
+                            initargs=initargs,
+                        )
+                        results = pool.map(identify_encounter_shared, to_process)
+                    finally:
+                        pool.close()
+                        pool.join()
+            finally:
+                # drop the memory maps the serial run set up in this process
+                # before their files are deleted
+                IDENTIFY_POOL_STATE.clear()
+                shutil.rmtree(store_dpath, ignore_errors=True)
+
+            if prune:
+                num_pruned = sum(result[0] for result in results)
+                num_pairs = sum(result[1] for result in results)
+                logger.info(
+                    'Pruned %d of %d alignments (%.2f%%)'
+                    % (num_pruned, num_pairs, 100.0 * num_pruned / max(1, num_pairs))
+                )
+        store.close()
 
         t_end = time()
         logger.info('%s completed in %.3fs' % (self.__class__.__name__, t_end - t_start))
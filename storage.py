@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+r"""
+Compact storage of the image-sized depc externs
+
+The localization and segmentation tables store float probability maps and
+masks, 8 MB per annotation for a 1024 x 1024 float64 map.  With
+curvrank_storage they are stored as
+
+    native    the array as computed
+    float16   floating arrays as float16, relative error <= 2 ** -11, so at
+              most 2.4e-4 for probabilities and 0.0625 for 0 - 255 masks
+    uint8     floating arrays as round(value / scale), absolute error
+              <= scale / 2, so at most 0.002 for probabilities (scale 1 / 255)
+              and 0.5 for 0 - 255 masks (scale 1)
+
+uint8 arrays are always stored as they are.  A '.npz' ext compresses the
+files.  Every column has a fixed scale, so a uint8 file of a floating column
+is always a quantized one and is converted back to float32 when loaded.
+Files are read eagerly: depc loads whole columns at once, and a memory-mapped
+array per row holds a file descriptor open for as long as the row is alive.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+
+
+STORAGE_FORMATS = ('native', 'float16', 'uint8')
+STORAGE_PROBABILITY_SCALE = 1.0 / 255.0
+STORAGE_MASK_SCALE = 1.0
+
+
+def encode_array(arr, storage='native', scale=STORAGE_PROBABILITY_SCALE):
+    r"""
+    Args:
+        arr (np.ndarray): array to store, None is passed through
+        storage (str): one of STORAGE_FORMATS
+        scale (float): value of one uint8 step
+
+    Returns:
+        encoded (np.ndarray): the array to save
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_curvrank.storage import *  # NOQA
+        >>> import tempfile
+        >>> from os.path import join
+        >>> rng = np.random.RandomState(0)
+        >>> segm = rng.rand(64, 64, 1)
+        >>> errors = []
+        >>> with tempfile.TemporaryDirectory() as dpath:
+        >>>     for storage in STORAGE_FORMATS:
+        >>>         for ext in ['.npy', '.npz']:
+        >>>             fpath = join(dpath, 'segm_%s%s' % (storage, ext))
+        >>>             save_array(fpath, encode_array(segm, storage))
+        >>>             segm_ = load_array(fpath, scale=STORAGE_PROBABILITY_SCALE)
+        >>>             errors.append(np.abs(segm_ - segm).max())
+        >>> assert errors[0] == errors[1] == 0.0
+        >>> assert max(errors[2:4]) <= 2.0 ** -12
+        >>> assert max(errors[4:6]) <= 0.5 / 255
+    """
+    assert storage in STORAGE_FORMATS, 'Unknown storage %r' % (storage,)
+    if arr is None or storage == 'native':
+        return arr
+    if not np.issubdtype(arr.dtype, np.floating):
+        return arr
+    if storage == 'float16':
+        return arr.astype(np.float16)
+    codes = np.clip(np.round(arr / scale), 0, 255)
+    return codes.astype(np.uint8)
+
+
+def save_array(fpath, arr):
+    r"""
+    np.save, or np.savez_compressed for a '.npz' fpath
+    """
+    if fpath.endswith('.npz'):
+        np.savez_compressed(fpath, arr)
+    else:
+        np.save(fpath, arr)
+
+
+def load_array(fpath, scale=None):
+    r"""
+    Load an array written by save_array
+
+    Args:
+        scale (float): scale of the column, uint8 files are converted back to
+            float32 when given
+    """
+    if fpath.endswith('.npz'):
+        with np.load(fpath) as data:
+            arr = data['arr_0']
+    else:
+        arr = np.load(fpath)
+    if scale is not None and arr.dtype == np.uint8:
+        arr = np.array(arr, dtype=np.float32)
+        arr *= scale
+    return arr
@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
-from wbia_curvrank import dorsal_utils
-import annoy
+from wbia_curvrank import costs, dorsal_utils
 import cv2
 import numpy as np
+import os
+from os.path import join, splitext
 
 # import fluke_utils
 import wbia_curvrank.functional as F
@@ -128,6 +129,11 @@ def refine_localization_star(
     )
 
 
+# outputs of the previous refine_localization call in this process, they are
+# encoded right away so the next image of the same size is warped into them
+REFINE_LOCALIZATION_BUFFERS = {}
+
+
 # input1_targets: preprocess_images_targets
 # input2_targets: localization_targets
 def refine_localization(
@@ -143,9 +149,11 @@ def refine_localization(
     img_orig = cv2.imread(fpath)
     flip = side.lower() == 'right'
 
+    out = REFINE_LOCALIZATION_BUFFERS.get('out', None)
     img_refn, msk_refn = F.refine_localization(
-        img_orig, flip, pre_transform, loc_transform, scale, height, width
+        img_orig, flip, pre_transform, loc_transform, scale, height, width, out=out
     )
+    REFINE_LOCALIZATION_BUFFERS['out'] = (img_refn, msk_refn)
 
     loc_hr_target = output_targets[fpath]['refn']
     mask_target = output_targets[fpath]['mask']
@@ -443,13 +451,8 @@ def build_annoy_index_star(data_fpath):
     return build_annoy_index(*data_fpath)
 
 
-def build_annoy_index(data, fpath):
-    f = data.shape[1]  # feature dimension
-    index = annoy.AnnoyIndex(f, metric='euclidean')
-    for i, _ in enumerate(data):
-        index.add_item(i, data[i])
-    index.build(10)
-    index.save(fpath)
+def build_annoy_index(data, fpath, n_jobs=-1):
+    F.build_lnbnn_index(data, fpath, num_trees=10, n_jobs=n_jobs)
 
 
 def identify_encounter_descriptors(
@@ -506,6 +509,133 @@ def identify_encounter(qind, qenc, qr_curv_dict, db_curv_dict, simfunc, output_t
         pickle.dump(scores, f, pickle.HIGHEST_PROTOCOL)
 
 
+# The curvatures of a TimeWarpingId run are packed into .npy files that every
+# pool worker memory-maps once, so the tasks themselves are only (qind, qenc).
+# Plain files work with any start method and are shared through the page cache,
+# without a shared memory segment that has to be unlinked by whoever created it
+IDENTIFY_POOL_STATE = {}
+
+
+def save_identify_arrays(dpath, db_stacked, qr_curv_dict, qr_keys, db_envelopes=None):
+    r"""
+    Write the stacked database curvatures, the curvatures of the query
+    encounters qr_keys and the optional dtw envelopes to dpath
+
+    Returns:
+        qr_index (dict): (qind, qenc) -> row of the encounter in queries_bounds
+    """
+    dcurvs, db_bounds = db_stacked
+    np.save(join(dpath, 'database.npy'), dcurvs)
+    np.save(join(dpath, 'database_bounds.npy'), db_bounds)
+
+    counts = [len(qr_curv_dict[qind][qenc]) for qind, qenc in qr_keys]
+    qr_bounds = np.hstack(([0], np.cumsum(counts))).astype(np.int64)
+    shape = dcurvs.shape[1:]
+    if len(qr_keys) > 0:
+        qind, qenc = qr_keys[0]
+        shape = np.shape(qr_curv_dict[qind][qenc][0])
+    # fill the file in place instead of stacking the queries in memory first
+    qcurvs = np.lib.format.open_memmap(
+        join(dpath, 'queries.npy'),
+        mode='w+',
+        dtype=np.float32,
+        shape=(int(qr_bounds[-1]),) + tuple(shape),
+    )
+    for idx, (qind, qenc) in enumerate(qr_keys):
+        if counts[idx] > 0:
+            qcurvs[qr_bounds[idx] : qr_bounds[idx + 1]] = qr_curv_dict[qind][qenc]
+    qcurvs.flush()
+    del qcurvs
+    np.save(join(dpath, 'queries_bounds.npy'), qr_bounds)
+
+    if db_envelopes is not None:
+        for key, envelope in db_envelopes.items():
+            np.save(join(dpath, 'envelope_%s.npy' % key), envelope)
+
+    return {qind_qenc: idx for idx, qind_qenc in enumerate(qr_keys)}
+
+
+def load_identify_arrays(dpath):
+    store = {}
+    for fname in os.listdir(dpath):
+        key, ext = splitext(fname)
+        if ext == '.npy':
+            store[key] = np.load(join(dpath, fname), mmap_mode='r')
+    return store
+
+
+def init_identify_pool(
+    store_dpath,
+    qr_index,
+    db_names,
+    output_targets,
+    batch_simfunc=None,
+    simfunc=None,
+    lower_bound_func=None,
+):
+    store = load_identify_arrays(store_dpath)
+    db_envelopes = {
+        key[len('envelope_') :]: value
+        for key, value in store.items()
+        if key.startswith('envelope_')
+    }
+    db_features = None
+    if batch_simfunc is not None:
+        db_features = costs.batch_database_features(batch_simfunc, store['database'])
+    IDENTIFY_POOL_STATE.clear()
+    IDENTIFY_POOL_STATE.update(
+        {
+            'qr_curvs': store['queries'],
+            'qr_bounds': store['queries_bounds'],
+            'qr_index': qr_index,
+            'db_names': db_names,
+            'db_stacked': (store['database'], store['database_bounds']),
+            'db_envelopes': db_envelopes,
+            'db_features': db_features,
+            'output_targets': output_targets,
+            'batch_simfunc': batch_simfunc,
+            'simfunc': simfunc,
+            'lower_bound_func': lower_bound_func,
+        }
+    )
+
+
+# uses the state set up by init_identify_pool, lower bounds are only used when
+# the pool was given a lower_bound_func
+def identify_encounter_shared(qind_qenc):
+    state = IDENTIFY_POOL_STATE
+    qind, qenc = qind_qenc
+    idx = state['qr_index'][qind_qenc]
+    qr_bounds = state['qr_bounds']
+    qcurvs = state['qr_curvs'][qr_bounds[idx] : qr_bounds[idx + 1]]
+    db_stacked = state['db_stacked']
+
+    if state['lower_bound_func'] is None:
+        scores = F.dtwsw_identify_batch(
+            qcurvs,
+            None,
+            state['db_names'],
+            state['batch_simfunc'],
+            stacked=db_stacked,
+            database_features=state['db_features'],
+        )
+        num_pruned = 0
+    else:
+        scores, num_pruned = F.dtwsw_identify_pruned(
+            qcurvs,
+            state['db_names'],
+            state['simfunc'],
+            state['lower_bound_func'],
+            db_stacked,
+            state['db_envelopes'],
+        )
+
+    with state['output_targets'][qind][qenc].open('wb') as f:
+        pickle.dump(scores, f, pickle.HIGHEST_PROTOCOL)
+
+    return num_pruned, len(qcurvs) * len(db_stacked[0])
+
+
 # input1_targets: evaluation_targets (the result dicts)
 # input2_targets: edges_targets (the separate_edges visualizations)
 # input3_targets: block_curv_targets (the curvature vectors)